@@ -0,0 +1,339 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Async serving mode for the stops API.
+
+PUT /stops, GET /stops/<stop_id>, GET /stops/batch, GET /operator-profile/<stop_id> and GET /guide
+spend nearly all of their time waiting on db.transport and Gemini.  Here they run as coroutines on one asyncio event
+loop, with AsyncTransportClient for db.transport and generate_content_async for Gemini, so thousands
+of requests can be waiting on upstream at once without holding a thread each.
+
+The handlers run the same flows as the Flask app in z5390780 (see run_flow there), parse their
+args with the same parsers and answer with the same responses, only the calls are made differently:
+upstream calls are awaited on the loop, and the SQLite calls run on a small thread pool so they
+never block it.  Every other route is handed to the Flask app itself on the same pool.
+
+    pip install aiohttp
+    python async_server.py --port 5000
+"""
+
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from aiohttp import web
+from multidict import CIMultiDict
+from werkzeug.exceptions import HTTPException
+
+import z5390780 as service
+from transport_client import AsyncTransportClient
+
+
+# how many threads do the SQLite work and serve the routes that are left to the Flask app
+ASYNC_DB_THREADS = int(os.environ.get("ASYNC_DB_THREADS", "8"))
+# how many connections to db.transport can be open at once, requests past that wait for one without a thread
+ASYNC_TRANSPORT_POOL_SIZE = int(os.environ.get("ASYNC_TRANSPORT_POOL_SIZE", "100"))
+
+
+# the Flask rule for each route served here, to label their metrics the same way
+ROUTE_LABELS = {
+    "/stops": "/stops",
+    "/stops/batch": "/stops/batch",
+    "/stops/{stop_id}": "/stops/<int:stop_id>",
+    "/operator-profile/{stop_id}": "/operator-profile/<int:stop_id>",
+    "/guide": "/guide",
+}
+
+
+def respond(result):
+    # a response from one of the shared handlers (a body, status code and maybe headers, or just a body) as JSON
+    body, status, *headers = result if isinstance(result, tuple) else (result, 200)
+    return web.json_response(body, status=status, headers=headers[0] if headers else None)
+
+
+class AsyncStopsAPI:
+    """
+    The upstream bound routes as coroutines, plus a fallback that sends everything else to the Flask app.
+    """
+
+    def __init__(self, flask_app=None, db_threads=ASYNC_DB_THREADS, pool_size=ASYNC_TRANSPORT_POOL_SIZE):
+        self.flask_app = flask_app or service.app
+        self.executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix="async-db")
+        # same upstream settings and circuit breaker as the Flask app's client, so both agree when upstream is down
+        self.transport = AsyncTransportClient(
+            base_url=service.transport.base_url,
+            timeouts=service.transport.timeouts,
+            max_retries=service.transport.max_retries,
+            pool_size=pool_size,
+            breaker=service.transport.breaker,
+            observer=service.transport.observer,
+            budget=service.transport.budget,
+        )
+
+    def routes(self):
+        return [
+            web.put("/stops", self.put_stops),
+            web.get("/stops/batch", self.get_stops_batch),
+            web.get(r"/stops/{stop_id:\d+}", self.get_stop),
+            web.get(r"/operator-profile/{stop_id:\d+}", self.get_operator_profile),
+            web.get("/guide", self.get_guide),
+            web.route("*", "/{tail:.*}", self.wsgi_fallback),
+        ]
+
+    @web.middleware
+    async def record_metrics(self, request, handler):
+        # the same route labels as the Flask app, whose own hooks record the requests handed to it
+        route = ROUTE_LABELS.get(request.match_info.route.resource.canonical if request.match_info.route.resource else None)
+        if (route is None):
+            return await handler(request)
+
+        start = time.perf_counter()
+        status = "500"
+        service.requests_in_flight.inc(route)
+        try:
+            response = await handler(request)
+            status = str(response.status)
+            return response
+        except web.HTTPException as e:
+            status = str(e.status)
+            raise
+        finally:
+            service.requests_in_flight.dec(route)
+            service.request_duration.observe(time.perf_counter() - start, route, request.method, status)
+
+    @web.middleware
+    async def shed_when_busy(self, request, handler):
+        # the same answer as the Flask app gives when the upstream budget sheds a call
+        try:
+            return await handler(request)
+        except service.UpstreamBusy as e:
+            body, status, headers = service.upstream_busy(e)
+            return web.json_response(body, status=status, headers=headers)
+
+    async def in_db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.call_in_db, fn, args)
+
+    def call_in_db(self, fn, args):
+        # on a db thread, which gives its connection back to the pool as soon as it's done
+        try:
+            return fn(*args)
+        finally:
+            service.db.release()
+
+    async def close(self, app=None):
+        await self.transport.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def parse_args(self, parser, request):
+        """
+        Parse a route's args with the Flask route's own reqparse parser, so both servers take the same
+        args and reject bad ones with the same response.
+
+        Returns the args and None, or None and the error response.
+        """
+        body = await request.read()
+        with self.flask_app.test_request_context(request.path, method=request.method, query_string=request.query_string,
+                                                 data=body, content_type=request.headers.get("Content-Type")):
+            try:
+                return parser.parse_args(), None
+            except HTTPException as e:
+                return None, respond((getattr(e, "data", None) or {"message": e.description}, e.code))
+
+    async def run_flow(self, flow):
+        """
+        Run one of the flows shared with the Flask app (see service.run_flow), with the upstream calls
+        awaited on the loop and the db calls made on the db threads.
+        """
+        result, error = None, None
+        while True:
+            try:
+                step = flow.throw(error) if error is not None else flow.send(result)
+            except StopIteration as e:
+                return e.value
+            result, error = None, None
+            try:
+                if (step.kind == "upstream"):
+                    result = await getattr(self.transport, step.target)(*step.args, **step.kwargs)
+                elif (step.kind == "concurrently"):
+                    result = await self.run_concurrently(step.target, *step.args)
+                else:
+                    result = await self.in_db(functools.partial(step.target, *step.args, **step.kwargs))
+            except Exception as e:
+                error = e
+
+    async def run_concurrently(self, flows, limit, until=None):
+        # the concurrently step for run_flow, as tasks, the ones still waiting are cancelled once `until` is met
+        semaphore = asyncio.Semaphore(limit)
+
+        async def run(key, flow):
+            async with semaphore:
+                return key, await self.run_flow(flow)
+
+        tasks = [asyncio.ensure_future(run(key, flow)) for key, flow in flows.items()]
+        finished = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                key, result = await next_done
+                finished.append((key, result))
+                if (until is not None and until(result)):
+                    break
+            return finished
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def put_stops(self, request):
+        args, error = await self.parse_args(service.q1_parser, request)
+        if (error):
+            return error
+        return respond(await self.run_flow(service.put_stops_flow(args.get('query'), args.get('local_first'))))
+
+    async def get_stop(self, request):
+        args, error = await self.parse_args(service.q2_parser, request)
+        if (error):
+            return error
+        stop_id = int(request.match_info['stop_id'])
+        return respond(await self.run_flow(service.get_stop_flow(stop_id, args.get('include'))))
+
+    async def get_operator_profile(self, request):
+        stop_id = int(request.match_info['stop_id'])
+        error, operators = await self.run_flow(service.operator_stop_flow(stop_id))
+        if (error):
+            return respond(error)
+
+        # ask gemini about each of the unique operators it hasn't got a stored profile for
+        profiles = await self.in_db(service.read_operator_profiles, operators)
+        missing = [operator for operator in operators if operator not in profiles]
+        if (missing):
+            limit = asyncio.Semaphore(service.OPERATOR_PROFILE_CONCURRENCY)
+
+            async def generate(operator):
+                async with limit:
+                    return (await service.gemini.generate_content_async(service.operator_question(operator))).text
+
+            generated = dict(zip(missing, await asyncio.gather(*map(generate, missing))))
+            await self.in_db(service.store_operator_profiles, generated)
+            profiles.update(generated)
+
+        return respond(service.operator_profiles_response(stop_id, operators, profiles))
+
+    async def get_guide(self, request):
+        error, guide = await self.run_flow(service.guide_flow())
+        if (error):
+            return respond(error)
+        guide_key, questions = guide
+        guide_path = os.path.join(service.guides_dir, f"{guide_key}.txt")
+        headers = service.guide_headers(guide_key)
+
+        # this guide has been made before, so send the stored file (or a 304 if the client already has it)
+        if (os.path.exists(guide_path)):
+            if (any(etag.value == guide_key for etag in request.if_none_match or ())):
+                return web.Response(status=304, headers={"ETag": headers["ETag"]})
+            text = await self.in_db(read_text, guide_path)
+            return web.Response(text=text, content_type="text/plain", headers=headers)
+
+        # ask gemini all three questions at once, and send each section as soon as it (and the ones before it) is ready
+        tasks = [asyncio.ensure_future(service.gemini.generate_content_async(question)) for question in questions]
+        response = web.StreamResponse(headers=headers)
+        response.content_type = "text/plain"
+        await response.prepare(request)
+        sections = []
+        try:
+            for (heading, ending), task in zip(service.GUIDE_SECTIONS, tasks):
+                section = heading + (await task).text + ending
+                sections.append(section)
+                await response.write(section.encode("utf-8"))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # the whole guide was sent, so keep it for the next request
+        await self.in_db(service.write_guide, guide_path, "".join(sections))
+        await response.write_eof()
+        return response
+
+    async def get_stops_batch(self, request):
+        args, error = await self.parse_args(service.batch_parser, request)
+        if (error):
+            return error
+        return respond(await self.run_flow(service.stops_batch_flow(args['ids'], args.get('include'))))
+
+    async def wsgi_fallback(self, request):
+        """
+        Hand a request for any other route to the Flask app, on the db threads.
+        """
+        body = await request.read()
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            # WSGI wants the decoded path as latin-1
+            "PATH_INFO": request.path.encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": request.query_string,
+            "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "SERVER_NAME": request.url.host or "localhost",
+            "SERVER_PORT": str(request.url.port or 80),
+            "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+            "REMOTE_ADDR": request.remote or "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": request.scheme,
+            "wsgi.input": BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name in request.headers.keys():
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if (key not in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH")):
+                environ[key] = ",".join(request.headers.getall(name))
+
+        def call():
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started['status'] = int(status.split()[0])
+                started['headers'] = headers
+
+            chunks = self.flask_app(environ, start_response)
+            try:
+                content = b"".join(chunks)
+            finally:
+                if (hasattr(chunks, "close")):
+                    chunks.close()
+            return started['status'], started['headers'], content
+
+        status, headers, content = await self.in_db(call)
+        headers = CIMultiDict((name, value) for name, value in headers if name.lower() != "content-length")
+        return web.Response(status=status, body=content, headers=headers)
+
+
+def read_text(path):
+    with open(path) as f:
+        return f.read()
+
+
+def make_app(flask_app=None):
+    api = AsyncStopsAPI(flask_app)
+    app = web.Application(middlewares=[api.record_metrics, api.shed_when_busy])
+    app.add_routes(api.routes())
+    app.on_cleanup.append(api.close)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    web.run_app(make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,756 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the stops API.  Each one runs against a fresh database in a temporary directory.
+
+stops
+    Starts the app on a threaded local server, seeds it with stops, then has 1, 8 and 32 concurrent
+    clients hammer GET /stops/<id> for a fixed amount of time each.  The requests use `include`
+    without next_departure so that only the database path is measured, not the upstream departures API.
+
+        python benchmark.py stops --stops 5000 --seconds 5
+
+guide
+    Times the /guide journey validation for 2, 5, 10 and 20 stops, against a local stand-in for the
+    db.transport /journeys endpoint that answers after a fixed latency.  The all-pairs check is timed
+    one check at a time and with the configured concurrency, and the root-based check with a cold
+    reachability cache, a warm one, and after one more stop is added.
+
+        python benchmark.py guide --latency 50
+
+inflight
+    Fires 500 up to 4000 GET /stops/<id> requests at once, each for a different stop whose departures
+    aren't cached, against a stand-in for db.transport that answers after a fixed latency.  Run with
+    --mode async for async_server.py, or --mode threaded for the Flask app on a threaded server, and
+    compare the peak thread count and how much the process grew.  The clients run in the same
+    process, so the memory includes theirs, which is the same in both modes.
+
+        python benchmark.py inflight --mode async --latency 500
+
+startup
+    Imports the app in a fresh interpreter with no GOOGLE_API_KEY, a few times over, and fails if
+    the slowest import is over budget, or if importing it opened the db or imported Gemini.  Also
+    prints the slowest top level imports from python -X importtime.
+
+        python benchmark.py startup --budget-ms 500
+
+replica
+    Seeds the database with --stops stops (a million by default), loads them all into the in-memory
+    stops replica and reports the memory that took, measured with tracemalloc and as the replica
+    estimates it for /metrics, and whether a million stops fit in --budget-mb.  Then times reading
+    stops with the replica and straight from SQLite.
+
+        python benchmark.py replica --stops 1000000 --budget-mb 512
+
+routes
+    Runs every route (or the ones given with --routes) at 1, 8 and 32 concurrent clients, with the
+    database seeded with --stops stops, and prints the throughput and p50/p95/p99 latency of each,
+    along with how many upstream calls they made.  Nothing leaves the machine: a local stand-in for
+    db.transport replays the recorded answers in benchmark_payloads/ after --latency ms, and Gemini
+    is replaced by one that answers after --gemini-latency ms.  --output saves the results as JSON.
+
+        python benchmark.py routes --server flask --output before.json
+
+compare
+    Compares two saved routes results route by route, and fails if throughput dropped or p99 went
+    up by more than --threshold percent.
+
+        python benchmark.py compare before.json after.json --threshold 10
+
+record
+    Replaces the recorded answers in benchmark_payloads/ with fresh ones from the real db.transport,
+    starting from a stop search.
+
+        python benchmark.py record --query "Berlin"
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from werkzeug.serving import make_server
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+
+# the recorded db.transport answers the fake upstream serves, `python benchmark.py record` replaces them
+PAYLOADS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_payloads")
+PAYLOAD_ENDPOINTS = ("locations", "departures", "journeys", "nearby")
+
+
+def load_app(workdir):
+    # the app keeps its database next to the working directory, so give it a fresh one
+    os.chdir(workdir)
+    # the stand-ins for db.transport have no rate limit, so the app needn't keep to one
+    os.environ.setdefault("UPSTREAM_RATE", "1000000")
+    os.environ.setdefault("UPSTREAM_BURST", "1000000")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import z5390780
+    return z5390780
+
+
+def seed_stops(module, count):
+    # insert the stops directly, the links are not needed to read a stop back
+    rows = []
+    for i in range(count):
+        stop_id = 8000000 + i
+        rows.append((stop_id, f"Stop {i}", 52.0 + i / 10000, 13.0 + i / 10000,
+                     "2024-01-01-00:00:00", f"http://localhost:5000/stops/{stop_id}"))
+    with module.db.write() as cursor:
+        cursor.executemany("""INSERT OR REPLACE INTO stops(stop_id, name, latitude, longitude, last_updated, self_link)
+                              VALUES (?, ?, ?, ?, ?, ?)""", rows)
+    return [row[0] for row in rows]
+
+
+def percentile(latencies, fraction):
+    # latencies must already be sorted
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+def run_clients(make_request, clients, seconds):
+    """
+    Have `clients` threads each call make_request(session) back to back for `seconds`, and return
+    the throughput and latency percentiles. Any response that isn't a 2xx or 304 counts as an error.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        session = requests.Session()
+        mine = []
+        failed = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                res = make_request(session)
+                ok = res.status_code < 300 or res.status_code == 304
+            except requests.RequestException:
+                ok = False
+            mine.append(time.perf_counter() - start)
+            if (not ok):
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "errors": sum(errors),
+        "throughput": len(latencies) / seconds,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+class FakeUpstream:
+    """
+    A local stand-in for db.transport that answers /locations, /stops/<id>/departures, /journeys
+    and /locations/nearby with the recorded payloads after a fixed latency, and counts the calls to
+    each endpoint. The recorded departures are moved so that the first one always leaves a minute
+    from now, otherwise they would all be in the past and the app would find no next departure.
+    """
+
+    def __init__(self, payloads, latency):
+        self.latency = latency
+        self.bodies = {endpoint: json.dumps(payload).encode() for endpoint, payload in payloads.items()
+                       if endpoint != "departures"}
+        self.departures = payloads["departures"]
+        self.departure_bodies = {}
+        self.lock = threading.Lock()
+        self.calls = {endpoint: 0 for endpoint in payloads}
+        self.server = None
+
+    def start(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # the headers and body are separate writes, which Nagle would hold up for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                endpoint = upstream.endpoint(self.path.split("?")[0])
+                time.sleep(upstream.latency)
+                if (endpoint is None):
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = upstream.body(endpoint)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def endpoint(self, path):
+        if (path == "/locations/nearby"):
+            return "nearby"
+        if (path == "/locations"):
+            return "locations"
+        if (path == "/journeys"):
+            return "journeys"
+        if (path.startswith("/stops/") and path.endswith("/departures")):
+            return "departures"
+        return None
+
+    def body(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+        if (endpoint != "departures"):
+            return self.bodies[endpoint]
+
+        # the departures only move once a second, so encode them once a second
+        now = int(time.time())
+        body = self.departure_bodies.get(now)
+        if (body is None):
+            body = json.dumps(shift_departures(self.departures, now + 60)).encode()
+            self.departure_bodies = {now: body}
+        return body
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+def shift_departures(payload, first):
+    # move every departure by the same amount, so that the earliest one leaves at the epoch time `first`
+    times = [datetime.fromisoformat(d["when"] or d["plannedWhen"]) for d in payload["departures"]]
+    shift = timedelta(seconds=first - min(times).timestamp())
+    departures = []
+    for departure in payload["departures"]:
+        departure = dict(departure)
+        for key in ("when", "plannedWhen"):
+            if (departure.get(key)):
+                departure[key] = (datetime.fromisoformat(departure[key]) + shift).isoformat()
+        departures.append(departure)
+    return dict(payload, departures=departures)
+
+
+def load_payloads(directory):
+    payloads = {}
+    for endpoint in PAYLOAD_ENDPOINTS:
+        with open(os.path.join(directory, f"{endpoint}.json")) as f:
+            payloads[endpoint] = json.load(f)
+    return payloads
+
+
+class FakeAnswer:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGemini:
+    """
+    Stands in for the Gemini model, answering every question after a fixed latency.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, question):
+        self.calls += 1
+        time.sleep(self.latency)
+        return FakeAnswer(f"A made up answer to: {question}")
+
+    async def generate_content_async(self, question):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return FakeAnswer(f"A made up answer to: {question}")
+
+
+def serve_in_thread(app):
+    # run an aiohttp app on its own event loop in a daemon thread, returns the port it is listening on
+    started = threading.Event()
+    ports = []
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0, backlog=8192)
+        loop.run_until_complete(site.start())
+        ports.append(runner.addresses[0][1])
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return ports[0]
+
+
+def start_fake_departures(latency):
+    # answers every /departures request with one departure after `latency` seconds, without a thread per request
+    async def departures(request):
+        await asyncio.sleep(latency)
+        when = time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(time.time() + 300))
+        return web.json_response({"departures": [{
+            "when": when, "platform": "1", "direction": "Somewhere",
+            "line": {"name": "S1", "operator": {"name": "Operator"}},
+        }]})
+
+    app = web.Application()
+    app.add_routes([web.get("/stops/{stop_id}/departures", departures)])
+    return serve_in_thread(app)
+
+
+def memory_sampler(samples, stop):
+    # record the process's resident memory (in kB) and thread count until stop is set
+    while not stop.is_set():
+        with open("/proc/self/status") as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        samples.append((rss, threading.active_count()))
+        time.sleep(0.05)
+
+
+async def fire_requests(base_url, stop_ids):
+    latencies = []
+    errors = 0
+
+    async def one(session, stop_id):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            async with session.get(f"{base_url}/stops/{stop_id}?include=next_departure") as res:
+                await res.read()
+                if (res.status != 200):
+                    errors += 1
+        except aiohttp.ClientError:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        await asyncio.gather(*(one(session, stop_id) for stop_id in stop_ids))
+    return latencies, errors
+
+
+def bench_inflight(args):
+    if (aiohttp is None):
+        sys.exit("the inflight benchmark needs aiohttp, pip install aiohttp")
+    os.environ["TRANSPORT_BASE_URL"] = f"http://127.0.0.1:{start_fake_departures(args.latency / 1000)}"
+    module = load_app(tempfile.mkdtemp())
+    stop_ids = seed_stops(module, max(args.requests))
+
+    if (args.mode == "async"):
+        import async_server
+        base_url = f"http://127.0.0.1:{serve_in_thread(async_server.make_app(module.app))}"
+    else:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, module.app, threaded=True)
+        server.socket.listen(8192)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"{args.mode}: N concurrent GET /stops/<id>?include=next_departure, {args.latency} ms per upstream call")
+    print(f"{'in flight':>9} {'errors':>7} {'seconds':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'threads':>8} {'+RSS MB':>8}")
+    for n in args.requests:
+        # every request has to go upstream
+        for stop_id in stop_ids:
+            module.departures_cache.invalidate(stop_id)
+
+        samples = []
+        stop = threading.Event()
+        sampler = threading.Thread(target=memory_sampler, args=(samples, stop))
+        with open("/proc/self/status") as f:
+            rss_before = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        sampler.start()
+        start = time.perf_counter()
+        latencies, errors = asyncio.run(fire_requests(base_url, stop_ids[:n]))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+
+        latencies.sort()
+        peak_rss = max(rss for rss, _ in samples)
+        peak_threads = max(threads for _, threads in samples)
+        print(f"{n:>9} {errors:>7} {elapsed:>8.2f} {n / elapsed:>8.1f} {statistics.median(latencies) * 1000:>8.1f} "
+              f"{latencies[int(len(latencies) * 0.99) - 1] * 1000:>8.1f} {peak_threads:>8} "
+              f"{(peak_rss - rss_before) / 1024:>8.1f}")
+
+
+# what the startup benchmark runs in a fresh interpreter
+IMPORT_PROBE = """
+import os, sys, time
+start = time.perf_counter()
+import z5390780
+elapsed = time.perf_counter() - start
+print(elapsed, os.path.exists(z5390780.db_file), "google.generativeai" in sys.modules)
+"""
+
+
+def bench_startup(args):
+    env = {name: value for name, value in os.environ.items() if name != "GOOGLE_API_KEY"}
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+
+    timings = []
+    for _ in range(args.runs):
+        workdir = tempfile.mkdtemp()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT_PROBE], cwd=workdir, env=env,
+                                capture_output=True, text=True)
+        if (result.returncode != 0):
+            sys.exit(f"importing the app failed:\n{result.stderr[-2000:]}")
+        elapsed, opened_db, imported_gemini = result.stdout.split()
+        timings.append(float(elapsed) * 1000)
+
+    # the modules the app imports itself by cumulative time, from the last run. importtime lists a
+    # module after everything it imports, which are indented one level more
+    imports = []
+    children = []
+    for line in result.stderr.splitlines():
+        if (line.startswith("import time:") and "|" in line):
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if (not cumulative.strip().isdigit()):
+                continue
+            depth = (len(name) - len(name.lstrip())) // 2
+            if (depth == 1):
+                children.append((int(cumulative) / 1000, name.strip()))
+            elif (depth == 0):
+                if (name.strip() == "z5390780"):
+                    imports = children
+                children = []
+    imports.sort(reverse=True)
+
+    print(f"importing the app: best {min(timings):.1f} ms, worst {max(timings):.1f} ms over {args.runs} runs, "
+          f"budget {args.budget_ms:.0f} ms")
+    for cumulative, name in imports[:args.top]:
+        print(f"{cumulative:>9.1f} ms  {name}")
+
+    failures = []
+    if (max(timings) > args.budget_ms):
+        failures.append(f"the slowest import took {max(timings):.1f} ms")
+    if (opened_db == "True"):
+        failures.append("importing the app created the db file")
+    if (imported_gemini == "True"):
+        failures.append("importing the app imported google.generativeai")
+    if (failures):
+        sys.exit("over budget: " + ", ".join(failures))
+
+
+def bench_stops(args):
+    module = load_app(tempfile.mkdtemp())
+    stop_ids = seed_stops(module, args.stops)
+
+    # the per-request access log would swamp the results
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"GET /stops/<id> with {args.stops} stops, {args.seconds}s per level")
+    print(f"{'clients':>8} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for clients in args.clients:
+        result = run_clients(lambda session: session.get(
+            f"{base_url}/stops/{random.choice(stop_ids)}?include=name,latitude,longitude"), clients, args.seconds)
+        print(f"{result['clients']:>8} {result['requests']:>9} {result['errors']:>7} "
+              f"{result['throughput']:>9.1f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+
+    server.shutdown()
+
+
+def bench_guide(args):
+    fake = FakeUpstream(load_payloads(args.payloads), args.latency / 1000)
+    os.environ["TRANSPORT_BASE_URL"] = fake.start()
+    module = load_app(tempfile.mkdtemp())
+
+    print(f"/guide journey validation, {args.latency} ms per upstream /journeys call")
+    print("all pairs checked one at a time and concurrently, then the root-based check with an empty")
+    print("reachability cache, with a warm cache, and after adding one more stop")
+    print(f"{'stops':>6} {'pairs':>6} {'serial ms':>10} {f'x{module.GUIDE_CONCURRENCY} ms':>10} "
+          f"{'cold ms':>9} {'warm ms':>9} {'+1 ms':>9}")
+    for n in args.sizes:
+        stop_ids = list(range(8000000, 8000000 + n))
+        pairs = [(a, b) for a in stop_ids for b in stop_ids if a != b]
+        timings = []
+        for concurrency in (1, module.GUIDE_CONCURRENCY):
+            start = time.perf_counter()
+            assert module.check_journeys(pairs, concurrency)[0] is None
+            timings.append((time.perf_counter() - start) * 1000)
+
+        with module.db.write() as cursor:
+            cursor.execute("DELETE FROM reachability")
+        for ids in (stop_ids, stop_ids, stop_ids + [8000000 + n]):
+            start = time.perf_counter()
+            assert module.check_strong_connectivity(ids) is None
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{n:>6} {len(pairs):>6} " + " ".join(f"{t:>9.1f}" for t in timings))
+
+    fake.shutdown()
+
+# how a client requests each route, given its session, the server's url and the seeded stop_ids.
+# put adds the recorded stops to the database, so it runs last
+ROUTES = {
+    "stop": lambda session, base_url, stop_ids:
+        session.get(f"{base_url}/stops/{random.choice(stop_ids)}"),
+    "stop-fields": lambda session, base_url, stop_ids:
+        session.get(f"{base_url}/stops/{random.choice(stop_ids)}?include=name,latitude,longitude"),
+    "list": lambda session, base_url, stop_ids:
+        session.get(f"{base_url}/stops?after={random.choice(stop_ids)}&limit=20"),
+    "nearby": lambda session, base_url, stop_ids:
+        session.get(f"{base_url}/stops/nearby?lat={52.0 + random.random() * len(stop_ids) / 10000}"
+                    f"&lon={13.0 + random.random() * len(stop_ids) / 10000}&k=10"),
+    "search": lambda session, base_url, stop_ids:
+        session.get(f"{base_url}/stops/search?q=Stop {random.randint(0, 99)}"),
+    "operator-profile": lambda session, base_url, stop_ids:
+        session.get(f"{base_url}/operator-profile/{random.choice(stop_ids)}"),
+    "guide": lambda session, base_url, stop_ids:
+        session.get(f"{base_url}/guide"),
+    "put": lambda session, base_url, stop_ids:
+        session.put(f"{base_url}/stops?query=stop {random.randint(0, 1000000)}"),
+}
+
+
+def git_version():
+    result = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.strip() or None
+
+
+def bench_routes(args):
+    fake = FakeUpstream(load_payloads(args.payloads), args.latency / 1000)
+    os.environ["TRANSPORT_BASE_URL"] = fake.start()
+    module = load_app(tempfile.mkdtemp())
+    module.gemini.model = FakeGemini(args.gemini_latency / 1000)
+    stop_ids = seed_stops(module, args.stops)
+
+    if (args.server == "async"):
+        if (aiohttp is None):
+            sys.exit("the async server needs aiohttp, pip install aiohttp")
+        import async_server
+        base_url = f"http://127.0.0.1:{serve_in_thread(async_server.make_app(module.app))}"
+    else:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, module.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"{args.server} server, {args.stops} stops, {args.latency} ms per upstream call, "
+          f"{args.gemini_latency} ms per Gemini answer, {args.seconds}s per level")
+    print(f"{'route':<17} {'clients':>7} {'requests':>9} {'errors':>7} {'req/s':>9} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'upstream':>9}")
+    results = []
+    for route in [route for route in ROUTES if route in args.routes]:
+        make_request = ROUTES[route]
+        # one untimed request first, so the first level doesn't pay for the app's lazy setup or the empty caches
+        make_request(requests, base_url, stop_ids)
+        for clients in args.clients:
+            before = fake.stats()
+            result = run_clients(lambda session: make_request(session, base_url, stop_ids), clients, args.seconds)
+            result["route"] = route
+            result["upstream_calls"] = {endpoint: calls - before[endpoint]
+                                        for endpoint, calls in fake.stats().items() if calls > before[endpoint]}
+            results.append(result)
+            print(f"{route:<17} {clients:>7} {result['requests']:>9} {result['errors']:>7} "
+                  f"{result['throughput']:>9.1f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+                  f"{result['p99_ms']:>8.2f} {sum(result['upstream_calls'].values()):>9}")
+
+    fake.shutdown()
+    if (args.output):
+        settings = {name: value for name, value in vars(args).items() if name not in ("run", "output")}
+        with open(args.output, "w") as f:
+            json.dump({
+                "version": git_version(),
+                "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "settings": settings,
+                "results": results,
+            }, f, indent=2)
+        print(f"saved the results to {args.output}")
+
+
+def bench_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    old = {(result["route"], result["clients"]): result for result in before["results"]}
+
+    print(f"{before['version']} ({before['created_at']}) -> {after['version']} ({after['created_at']})")
+    for name, value in after["settings"].items():
+        if (before["settings"].get(name) != value):
+            print(f"warning: {name} was {before['settings'].get(name)} and is now {value}")
+    print(f"{'route':<17} {'clients':>7} {'req/s':>18} {'change':>8} {'p99 ms':>18} {'change':>8}")
+
+    regressions = 0
+    for result in after["results"]:
+        previous = old.get((result["route"], result["clients"]))
+        if (previous is None):
+            continue
+        # a regression is less throughput or a slower p99, by more than the threshold
+        throughput = (result["throughput"] - previous["throughput"]) / previous["throughput"] * 100
+        p99 = (result["p99_ms"] - previous["p99_ms"]) / previous["p99_ms"] * 100
+        regressed = throughput < -args.threshold or p99 > args.threshold
+        regressions += regressed
+        print(f"{result['route']:<17} {result['clients']:>7} "
+              f"{previous['throughput']:>8.1f} -> {result['throughput']:>6.1f} {throughput:>+7.1f}% "
+              f"{previous['p99_ms']:>8.2f} -> {result['p99_ms']:>6.2f} {p99:>+7.1f}%"
+              + ("  REGRESSION" if regressed else ""))
+    if (regressions):
+        sys.exit(f"{regressions} regressions over {args.threshold}%")
+
+
+def bench_record(args):
+    # save fresh answers from the real db.transport for the fake one to serve
+    base_url = args.base_url.rstrip("/")
+    session = requests.Session()
+
+    def record(endpoint, path, params):
+        res = session.get(f"{base_url}{path}", params=params, timeout=30)
+        res.raise_for_status()
+        with open(os.path.join(args.payloads, f"{endpoint}.json"), "w") as f:
+            json.dump(res.json(), f, indent=1)
+        print(f"recorded {endpoint} from {res.url}")
+        return res.json()
+
+    stops = record("locations", "/locations", {"poi": "false", "addresses": "false", "query": args.query,
+                                               "results": 5})
+    if (len(stops) < 2):
+        sys.exit(f"'{args.query}' needs to match at least two stops")
+    first, second = stops[0], stops[1]
+    record("departures", f"/stops/{first['id']}/departures", {"duration": 120})
+    record("journeys", "/journeys", {"from": first["id"], "to": second["id"]})
+    record("nearby", "/locations/nearby", {"latitude": first["location"]["latitude"],
+                                           "longitude": first["location"]["longitude"], "poi": "true"})
+
+
+def bench_replica(args):
+    module = load_app(tempfile.mkdtemp())
+    start = time.perf_counter()
+    stop_ids = seed_stops(module, args.stops)
+    print(f"seeded {args.stops} stops in {time.perf_counter() - start:.1f}s")
+
+    # what loading every stop into the replica really allocates, against its own estimate
+    replica = module.stops_replica
+    replica.enabled = True
+    tracemalloc.start()
+    start = time.perf_counter()
+    replica.load()
+    elapsed = time.perf_counter() - start
+    measured = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    footprint = replica.footprint()
+    print(f"loaded {footprint['records']} stops in {elapsed:.2f}s, {measured / 2 ** 20:.1f} MB measured "
+          f"({measured / max(footprint['records'], 1):.0f} bytes a stop), "
+          f"{footprint['bytes'] / 2 ** 20:.1f} MB estimated by footprint()")
+    per_million = measured / max(footprint['records'], 1) * 1000000 / 2 ** 20
+    print(f"1M stops would take about {per_million:.0f} MB, "
+          f"{'within' if per_million <= args.budget_mb else 'over'} the {args.budget_mb:.0f} MB budget")
+
+    # reading a stop the way GET /stops/<stop_id>?include=name does, with and without the replica
+    sample = [random.choice(stop_ids) for _ in range(args.reads)]
+    for enabled in (False, True):
+        replica.enabled = enabled
+        start = time.perf_counter()
+        for stop_id in sample:
+            module.read_stop_for_response(stop_id, "name")
+        print(f"{'replica' if enabled else 'sqlite':>8}: {(time.perf_counter() - start) / len(sample) * 1e6:.1f} us a read")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    stops = benchmarks.add_parser("stops", help="GET /stops/<id> throughput")
+    stops.add_argument("--stops", type=int, default=5000, help="number of stops to seed the database with")
+    stops.add_argument("--seconds", type=float, default=5, help="how long to run each concurrency level for")
+    stops.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32], help="concurrency levels to run")
+    stops.set_defaults(run=bench_stops)
+
+    guide = benchmarks.add_parser("guide", help="/guide journey validation latency")
+    guide.add_argument("--latency", type=float, default=50, help="latency of each upstream /journeys call in ms")
+    guide.add_argument("--sizes", type=int, nargs="+", default=[2, 5, 10, 20], help="numbers of stops to validate")
+    guide.add_argument("--payloads", default=PAYLOADS_DIR, help="directory of recorded upstream answers")
+    guide.set_defaults(run=bench_guide)
+
+    inflight = benchmarks.add_parser("inflight", help="upstream bound requests in flight at once, async or threaded")
+    inflight.add_argument("--mode", choices=["async", "threaded"], default="async", help="which server to run")
+    inflight.add_argument("--latency", type=float, default=500, help="latency of each upstream /departures call in ms")
+    inflight.add_argument("--requests", type=int, nargs="+", default=[500, 1000, 2000, 4000],
+                          help="numbers of requests to have in flight at once")
+    inflight.set_defaults(run=bench_inflight)
+
+    startup = benchmarks.add_parser("startup", help="how long importing the app takes, against a budget")
+    startup.add_argument("--budget-ms", type=float, default=500, help="the most an import may take, in ms")
+    startup.add_argument("--runs", type=int, default=5, help="how many fresh interpreters to import it in")
+    startup.add_argument("--top", type=int, default=8, help="how many of the slowest imports to list")
+    startup.set_defaults(run=bench_startup)
+
+    replica = benchmarks.add_parser("replica", help="memory and read time of the in-memory stops replica")
+    replica.add_argument("--stops", type=int, default=1000000, help="number of stops to seed the database with")
+    replica.add_argument("--budget-mb", type=float, default=512, help="memory a worker can give the replica, in MB")
+    replica.add_argument("--reads", type=int, default=100000, help="how many stops to read with and without it")
+    replica.set_defaults(run=bench_replica)
+
+    routes = benchmarks.add_parser("routes", help="every route against a fake db.transport and Gemini")
+    routes.add_argument("--routes", nargs="+", choices=list(ROUTES), default=list(ROUTES), help="routes to run")
+    routes.add_argument("--stops", type=int, default=1000, help="number of stops to seed the database with")
+    routes.add_argument("--seconds", type=float, default=5, help="how long to run each concurrency level for")
+    routes.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32], help="concurrency levels to run")
+    routes.add_argument("--latency", type=float, default=20, help="latency of each upstream call in ms")
+    routes.add_argument("--gemini-latency", type=float, default=200, help="latency of each Gemini answer in ms")
+    routes.add_argument("--server", choices=["flask", "async"], default="flask", help="which server to run")
+    routes.add_argument("--payloads", default=PAYLOADS_DIR, help="directory of recorded upstream answers")
+    routes.add_argument("--output", help="save the results as JSON to this file, to compare later")
+    routes.set_defaults(run=bench_routes)
+
+    compare = benchmarks.add_parser("compare", help="compare two saved routes results")
+    compare.add_argument("before", help="results JSON from the earlier version")
+    compare.add_argument("after", help="results JSON from the later version")
+    compare.add_argument("--threshold", type=float, default=10,
+                         help="percent change in throughput or p99 that counts as a regression")
+    compare.set_defaults(run=bench_compare)
+
+    record = benchmarks.add_parser("record", help="record the upstream answers from the real db.transport")
+    record.add_argument("--query", default="Berlin", help="stop search that the recordings start from")
+    record.add_argument("--base-url", default="https://v6.db.transport.rest", help="db.transport to record from")
+    record.add_argument("--payloads", default=PAYLOADS_DIR, help="directory to save the answers to")
+    record.set_defaults(run=bench_record)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process metrics, exposed in the Prometheus text format (https://prometheus.io/docs/instrumenting/exposition_formats/).
+
+Histograms, counters and gauges keep one set of numbers per combination of label values.  Recording
+is a bisect and a few additions under a lock, so it is cheap enough to leave on for every request,
+upstream call and SQL statement.  Numbers that other objects already keep (like cache stats) are
+read by collectors when /metrics is scraped rather than being recorded twice.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds in seconds, from a quick cached SQLite read to a slow Gemini answer
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=""):
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if (extra):
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value):
+    if (value == float("inf")):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def label_order(item):
+    # label values can be a mix of types, so sort them as the strings they are rendered as
+    return tuple(str(value) for value in item[0])
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def header(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+                                for key, value in sorted(values.items(), key=label_order)]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values):
+        self.inc(*label_values, amount=-1)
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+    @contextmanager
+    def track(self, *label_values):
+        # count a block as in progress while it runs
+        self.inc(*label_values)
+        try:
+            yield
+        finally:
+            self.dec(*label_values)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if (counts is None):
+                # one count per bucket plus +Inf, then the sum
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += seconds
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        lines = self.header()
+        for key, counts in sorted(values.items(), key=label_order):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Every metric, and the collectors that make more of them when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def collector(self, fn):
+        """
+        Add a function that returns metrics to render alongside the registered ones, made fresh each scrape.
+        """
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collect in self.collectors:
+            for metric in collect():
+                lines += metric.render()
+        return "\n".join(lines) + "\n"
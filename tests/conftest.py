@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# the service lives at the top of the repo, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# nothing in the tests should reach the real db.transport, or wait on the rate budget
+os.environ.setdefault("TRANSPORT_BASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("UPSTREAM_RATE", "1000000")
+os.environ.setdefault("UPSTREAM_BURST", "1000000")
+
+
+@pytest.fixture(scope="session")
+def service():
+    import z5390780
+    return z5390780
+
+
+@pytest.fixture(scope="session")
+def app(service, tmp_path_factory):
+    # one app for the whole run, on its own db file
+    return service.create_app({"DATABASE": str(tmp_path_factory.mktemp("db") / "test.db"), "TESTING": True})
@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def pool(service, tmp_path):
+    return service.ConnectionManager(str(tmp_path / "pool.db"), pool_size=2, pool_timeout=0.2)
+
+
+def in_thread(fn):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(fn()))
+    thread.start()
+    thread.join()
+    return results[0]
+
+
+def test_connections_are_reused_by_other_threads(pool):
+    def query():
+        conn = pool.connection()
+        conn.execute("SELECT 1")
+        pool.release()
+        return conn
+
+    assert in_thread(query) is in_thread(query)
+
+
+def test_connection_goes_back_when_its_thread_ends(pool):
+    first = in_thread(pool.connection)
+    assert in_thread(pool.connection) is first
+
+
+def test_pool_is_bounded(pool):
+    held = threading.Event()
+    done = threading.Event()
+
+    def hold():
+        pool.connection()
+        held.set()
+        done.wait()
+        pool.release()
+
+    holders = [threading.Thread(target=hold) for _ in range(2)]
+    for thread in holders:
+        held.clear()
+        thread.start()
+        held.wait()
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="in use"):
+            pool.connection()
+    finally:
+        done.set()
+        for thread in holders:
+            thread.join()
+    assert pool.connection() is not None
+
+
+def test_nested_write_is_refused(pool):
+    with pool.write() as cursor:
+        cursor.execute("CREATE TABLE t (x INTEGER)")
+    with pytest.raises(RuntimeError, match="inside another write"):
+        with pool.write() as cursor:
+            cursor.execute("INSERT INTO t VALUES (1)")
+            with pool.write() as inner:
+                inner.execute("INSERT INTO t VALUES (2)")
+    assert not pool.connection().in_transaction
+    assert pool.connection().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+
+
+def test_failed_commit_is_rolled_back(service, pool, monkeypatch):
+    with pool.write() as cursor:
+        cursor.execute("CREATE TABLE t (x INTEGER)")
+
+    def commit(conn):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(service.TimedConnection, "commit", commit)
+    with pytest.raises(sqlite3.OperationalError):
+        with pool.write() as cursor:
+            cursor.execute("INSERT INTO t VALUES (1)")
+    assert not pool.connection().in_transaction
+    assert pool.connection().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
@@ -0,0 +1,29 @@
+import pytest
+
+
+def test_second_app_with_another_database(service, app, tmp_path):
+    client = app.test_client()
+    response = client.post("/stops/import", json={"stops": [
+        {"stop_id": 900001, "name": "Factory Test", "latitude": 52.5, "longitude": 13.4},
+    ]})
+    assert response.status_code in (200, 201)
+
+    # the db is shared by the whole process, so an app on another file would move the first one too
+    with pytest.raises(RuntimeError, match="DATABASE"):
+        service.create_app({"DATABASE": str(tmp_path / "other.db")})
+
+    # and the first app still sees what it just wrote
+    response = client.get("/stops/900001?include=name")
+    assert response.status_code == 200
+    assert response.get_json()["name"] == "Factory Test"
+
+    # an app with the same settings shares everything, so that is fine
+    same = service.create_app({"DATABASE": app.config["DATABASE"]})
+    assert same.test_client().get("/stops/900001?include=name").get_json()["name"] == "Factory Test"
+    assert service.app is app
+
+
+def test_second_app_with_another_transport(service, app):
+    with pytest.raises(RuntimeError, match="TRANSPORT_BASE_URL"):
+        service.create_app({"TRANSPORT_BASE_URL": "http://127.0.0.1:1"})
+    assert service.transport.base_url != "http://127.0.0.1:1"
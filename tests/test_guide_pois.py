@@ -0,0 +1,38 @@
+import pytest
+
+
+@pytest.fixture
+def nearby(service, app, monkeypatch):
+    # every stop reaches every other, and db.transport's nearby endpoint answers with each response in turn
+    responses = []
+    monkeypatch.setattr(service.transport, "journeys",
+                        lambda source, destination, priority="bulk": (200, {"journeys": [{"legs": []}]}))
+    monkeypatch.setattr(service.transport, "nearby",
+                        lambda latitude, longitude, poi=True, priority="bulk": responses.pop(0))
+    client = app.test_client()
+    client.post("/stops/import", json={"stops": [
+        {"stop_id": 100, "name": "Guide Source", "latitude": 52.5, "longitude": 13.4},
+        {"stop_id": 101, "name": "Guide Destination", "latitude": 52.6, "longitude": 13.5},
+    ]})
+    with service.db.write() as cursor:
+        cursor.execute("DELETE FROM poi_cache")
+    return responses
+
+
+def cached_pois(service):
+    return service.db.connection().execute("SELECT stop_id, pois FROM poi_cache").fetchall()
+
+
+@pytest.mark.parametrize("failure", [(429, None), (502, None), (200, None)])
+def test_upstream_failure_is_503_and_not_cached(service, app, nearby, failure):
+    nearby.append(failure)
+    response = app.test_client().get("/guide")
+    assert response.status_code == 503
+    assert cached_pois(service) == []
+
+
+def test_nothing_nearby_is_404_and_cached(service, app, nearby):
+    nearby += [(200, []), (200, [])]
+    response = app.test_client().get("/guide")
+    assert response.status_code == 404
+    assert len(cached_pois(service)) == 2
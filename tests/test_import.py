@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.mark.parametrize("queries, index", [
+    ([123], 0),
+    (["Berlin", None], 1),
+    (["Berlin", "Hamburg", ["Bonn"]], 2),
+    ([" "], 0),
+])
+def test_bad_query_is_rejected(app, queries, index):
+    response = app.test_client().post("/stops/import", json={"queries": queries})
+    assert response.status_code == 400
+    assert f"query {index}" in response.get_json()["Message"]
+
+
+def test_import_again_updates_the_stop(app):
+    client = app.test_client()
+    response = client.post("/stops/import", json={"stops": [
+        {"stop_id": 900201, "name": "Old Name", "latitude": 52.5, "longitude": 13.4},
+    ]})
+    assert response.status_code == 201
+
+    response = client.post("/stops/import", json={"stops": [
+        {"stop_id": 900201, "name": "New Name", "latitude": 48.1, "longitude": 11.6},
+    ]})
+    assert response.status_code == 200
+    assert response.get_json()["created"] == 0
+
+    stop = client.get("/stops/900201?include=name,latitude,longitude").get_json()
+    assert (stop["name"], stop["latitude"], stop["longitude"]) == ("New Name", 48.1, 11.6)
+    # and the indexes follow it
+    nearby = client.get("/stops/nearby?lat=48.1&lon=11.6&k=1").get_json()
+    assert [stop["stop_id"] for stop in nearby["stops"]] == [900201]
+    found = client.get("/stops/search?q=new+name").get_json()
+    assert 900201 in [stop["stop_id"] for stop in found["stops"]]
@@ -0,0 +1,17 @@
+import pytest
+
+
+def test_normalise_query(service):
+    assert service.normalise_query("  berlin   HBF") == service.normalise_query("Berlin Hbf")
+
+
+@pytest.mark.parametrize("q", [123, None, ["Berlin"]])
+def test_normalise_query_needs_a_string(service, q):
+    with pytest.raises(ValueError, match="string"):
+        service.normalise_query(q)
+
+
+@pytest.mark.parametrize("q", [123, None, ["Berlin"], "", "  "])
+def test_bad_query_is_not_looked_up(service, monkeypatch, q):
+    monkeypatch.setattr(service.transport, "locations", lambda *args, **kwargs: pytest.fail("asked upstream"))
+    assert service.query_upstream_stops(q) == (400, [])
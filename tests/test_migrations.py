@@ -0,0 +1,26 @@
+import multiprocessing
+import sqlite3
+
+
+def migrate_when_started(service, path, start):
+    conn = sqlite3.connect(path, isolation_level=None, timeout=5)
+    start.wait()
+    service.migrate(conn)
+
+
+def test_workers_migrating_a_new_file_at_once(service, tmp_path):
+    # like several server processes starting on the same db file
+    context = multiprocessing.get_context("fork")
+    for attempt in range(10):
+        path = str(tmp_path / f"fresh{attempt}.db")
+        start = context.Barrier(4)
+        workers = [context.Process(target=migrate_when_started, args=(service, path, start)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert [worker.exitcode for worker in workers] == [0, 0, 0, 0]
+        conn = sqlite3.connect(path)
+        assert conn.execute("SELECT version FROM schema_version").fetchall() == [(len(service.MIGRATIONS),)]
+        conn.close()
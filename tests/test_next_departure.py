@@ -0,0 +1,36 @@
+import time
+from datetime import datetime, timezone
+
+
+def departure(departs_at, platform, direction):
+    return {"when": datetime.fromtimestamp(departs_at, timezone.utc).isoformat(), "platform": platform,
+            "direction": direction, "line": {"name": "S1", "operator": {"name": "S-Bahn Berlin"}}}
+
+
+def test_departure_that_has_left_is_not_reported(service, app):
+    client = app.test_client()
+    client.post("/stops/import", json={"stops": [
+        {"stop_id": 900301, "name": "Departures Test", "latitude": 52.5, "longitude": 13.4},
+    ]})
+    now = time.time()
+    service.store_departures(900301, 120, {"departures": [
+        departure(now + 0.5, "1", "Wannsee"),
+        departure(now + 600, "2", "Oranienburg"),
+    ]})
+    assert client.get("/stops/900301?include=next_departure").get_json()["next_departure"] == "Platform 1 towards Wannsee"
+
+    # the stored departures are still fresh, but the first one has gone
+    time.sleep(1)
+    assert client.get("/stops/900301?include=next_departure").get_json()["next_departure"] == "Platform 2 towards Oranienburg"
+    batch = client.get("/stops/batch?ids=900301&include=next_departure").get_json()
+    assert batch["results"][0]["body"]["next_departure"] == "Platform 2 towards Oranienburg"
+
+
+def test_next_departure_cannot_be_put(app):
+    client = app.test_client()
+    client.post("/stops/import", json={"stops": [
+        {"stop_id": 900302, "name": "Departures Test", "latitude": 52.5, "longitude": 13.4},
+    ]})
+    response = client.put("/stops/900302", json={"next_departure": "Platform 9 towards Nowhere"})
+    assert response.status_code == 400
+    assert "next_departure" in response.get_json()["Message"]
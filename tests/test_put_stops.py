@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.fixture
+def locations(service, app, monkeypatch):
+    # stand in for db.transport's locations endpoint, answering with each response in turn
+    responses = []
+
+    def fake_locations(q, results=5, priority="interactive"):
+        return responses.pop(0)
+
+    monkeypatch.setattr(service.transport, "locations", fake_locations)
+    return responses
+
+
+@pytest.mark.parametrize("status_code", [429, 500, 502, 503])
+def test_upstream_failure_is_503(app, locations, status_code):
+    locations.append((status_code, None))
+    response = app.test_client().put(f"/stops?query=failing{status_code}")
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+
+
+def test_upstream_failures_are_not_remembered(app, locations):
+    locations += [(502, None), (429, None), (200, [])]
+    client = app.test_client()
+    assert client.put("/stops?query=flaky").status_code == 503
+    assert client.put("/stops?query=flaky").status_code == 503
+    # only an answer that found nothing is a 404
+    assert client.put("/stops?query=flaky").status_code == 404
+
+
+def test_bad_query_upstream_is_400(app, locations):
+    locations.append((400, None))
+    assert app.test_client().put("/stops?query=bad").status_code == 400
@@ -0,0 +1,60 @@
+import pytest
+
+
+@pytest.fixture
+def journeys(service, app, monkeypatch):
+    # stand in for db.transport's journeys endpoint, answering with each response in turn
+    responses = []
+    calls = []
+
+    def fake_journeys(source, destination, priority="bulk"):
+        calls.append((source, destination))
+        return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    monkeypatch.setattr(service.transport, "journeys", fake_journeys)
+    with service.db.write() as cursor:
+        cursor.execute("DELETE FROM reachability")
+    return responses, calls
+
+
+def stored_reachability(service):
+    return service.db.connection().execute("SELECT from_stop_id, to_stop_id, reachable FROM reachability").fetchall()
+
+
+@pytest.mark.parametrize("status_code, routes, expected", [
+    (200, {"journeys": [{"legs": []}]}, 200),
+    (200, {"journeys": []}, 400),
+    (404, None, 400),
+    (429, None, 503),
+    (500, None, 503),
+    (502, None, 503),
+    (503, None, 503),
+    (200, None, 503),
+])
+def test_journey_status(service, status_code, routes, expected):
+    assert service.journey_status(status_code, routes) == expected
+
+
+def test_transient_failure_is_not_cached(service, journeys):
+    responses, calls = journeys
+    responses += [(502, None), (200, {"journeys": [{"legs": []}]})]
+
+    # upstream is failing, so the guide can't be checked, and nothing is remembered about the stops
+    assert service.check_strong_connectivity([1, 2], concurrency=1) == 503
+    assert stored_reachability(service) == []
+
+    # once upstream recovers the stops are checked again, and found to be connected
+    assert service.check_strong_connectivity([1, 2], concurrency=1) is None
+    assert sorted(stored_reachability(service)) == [(1, 2, 1), (2, 1, 1)]
+
+
+def test_no_journey_is_cached(service, journeys):
+    responses, calls = journeys
+    responses.append((200, {"journeys": []}))
+
+    assert service.check_strong_connectivity([1, 2], concurrency=1) == 400
+    checked = len(calls)
+
+    # a definite answer is trusted for REACHABILITY_TTL, so upstream isn't asked again
+    assert service.check_strong_connectivity([1, 2], concurrency=1) == 400
+    assert len(calls) == checked
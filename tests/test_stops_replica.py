@@ -0,0 +1,86 @@
+import threading
+
+
+def test_stop_written_while_it_is_read(service, app, monkeypatch):
+    client = app.test_client()
+    response = client.post("/stops/import", json={"stops": [
+        {"stop_id": 900101, "name": "Replica Test", "latitude": 52.5, "longitude": 13.4},
+    ]})
+    assert response.status_code in (200, 201)
+
+    replica = service.StopsReplica(enabled=True, check_interval=60)
+    replica.check_version()
+
+    class RacingConnection:
+        # reads the row, then lets a write to the stop commit before get() decides whether to keep it
+        def execute(self, sql, params=()):
+            monkeypatch.undo()
+            row = service.db.connection().execute(sql, params).fetchone()
+            with service.db.write() as cursor:
+                before = service.stops_version(cursor)
+                cursor.execute("UPDATE stops SET name = ? WHERE stop_id = ?", ("Replica Test Renamed", 900101))
+                after = service.stops_version(cursor)
+            replica.changed([900101], before, after)
+            return type("Cursor", (), {"fetchone": lambda cursor: row})()
+
+    monkeypatch.setattr(service.db, "connection", RacingConnection)
+    assert replica.get(900101).name == "Replica Test"
+
+    # the row read before the write wasn't kept, so the next read sees the new name
+    assert replica.get(900101).name == "Replica Test Renamed"
+
+
+def import_stops(app, *stop_ids):
+    response = app.test_client().post("/stops/import", json={"stops": [
+        {"stop_id": stop_id, "name": f"Replica {stop_id}", "latitude": 52.5, "longitude": 13.4} for stop_id in stop_ids
+    ]})
+    assert response.status_code in (200, 201)
+
+
+def test_write_only_drops_the_stops_it_changed(service, app, monkeypatch):
+    import_stops(app, 900110, 900120, 900130, 900140)
+    replica = service.StopsReplica(enabled=True, check_interval=0)
+    monkeypatch.setattr(service, "stops_replica", replica)
+    replica.get_many([900110, 900120, 900130, 900140])
+
+    # a rename only touches that stop
+    app.test_client().put("/stops/900110", json={"name": "Replica Renamed"})
+    assert set(replica.records) == {900120, 900130, 900140}
+    assert replica.get(900110).name == "Replica Renamed"
+
+    # a new stop between two others moves their links too
+    import_stops(app, 900125)
+    assert set(replica.records) == {900110, 900140}
+    assert replica.get(900120).next_link.endswith("/900125")
+
+    # and a delete moves its neighbours' links
+    app.test_client().delete("/stops/900125")
+    assert 900120 not in replica.records and 900130 not in replica.records
+    assert replica.get(900130).prev_link.endswith("/900120")
+
+
+def test_write_from_another_process_drops_everything(service, app):
+    import_stops(app, 900150, 900160)
+    replica = service.StopsReplica(enabled=True, check_interval=0)
+    replica.get_many([900150, 900160])
+    # as if another process had written, the version moves on without changed() being called
+    with service.db.write() as cursor:
+        cursor.execute("UPDATE stops SET name = ? WHERE stop_id = ?", ("Replica Elsewhere", 900150))
+    assert replica.get(900150).name == "Replica Elsewhere"
+    assert set(replica.records) == {900150}
+
+
+def test_hits_and_misses_are_all_counted(service, app):
+    import_stops(app, 900170)
+    replica = service.StopsReplica(enabled=True, check_interval=60)
+
+    def read():
+        for _ in range(2000):
+            replica.get(900170)
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert replica.hits + replica.misses == 16000
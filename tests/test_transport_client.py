@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+import pytest
+
+from transport_client import AsyncTransportClient, TransportClient
+
+
+def test_calls_of_different_priorities_are_not_coalesced():
+    client = TransportClient(base_url="http://upstream.invalid")
+    release_bulk = threading.Event()
+    bulk_started = threading.Event()
+    fetched = []
+
+    def fake_fetch(endpoint, url, priority="interactive"):
+        fetched.append(priority)
+        if (priority == "bulk"):
+            bulk_started.set()
+            assert release_bulk.wait(5)
+        return 200, {"priority": priority}
+
+    client.fetch = fake_fetch
+    results = {}
+    bulk = threading.Thread(target=lambda: results.update(bulk=client.departures(1, 120, priority="bulk")))
+    bulk.start()
+    assert bulk_started.wait(5)
+
+    # the same url, asked for interactively while the bulk call is still in flight, gets its own call
+    assert client.departures(1, 120, priority="interactive") == (200, {"priority": "interactive"})
+    assert bulk.is_alive()
+
+    release_bulk.set()
+    bulk.join(5)
+    assert results["bulk"] == (200, {"priority": "bulk"})
+    assert sorted(fetched) == ["bulk", "interactive"]
+    assert client.stats()["coalesced"] == 0
+
+
+def test_calls_of_the_same_priority_are_coalesced():
+    client = TransportClient(base_url="http://upstream.invalid")
+    release = threading.Event()
+    started = threading.Event()
+
+    def fake_fetch(endpoint, url, priority="interactive"):
+        started.set()
+        assert release.wait(5)
+        return 200, {}
+
+    client.fetch = fake_fetch
+    first = threading.Thread(target=client.departures, args=(1, 120))
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=client.departures, args=(1, 120))
+    second.start()
+    while (client.stats()["coalesced"] == 0 and second.is_alive()):
+        second.join(0.01)
+
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert client.stats()["executed"] == 1
+    assert client.stats()["coalesced"] == 1
+
+
+def test_async_calls_of_different_priorities_are_not_coalesced():
+    pytest.importorskip("aiohttp")
+
+    async def run():
+        client = AsyncTransportClient(base_url="http://upstream.invalid")
+        release_bulk = asyncio.Event()
+
+        async def fake_fetch(endpoint, url, priority="interactive"):
+            if (priority == "bulk"):
+                await release_bulk.wait()
+            return 200, {"priority": priority}
+
+        client.fetch = fake_fetch
+        bulk = asyncio.ensure_future(client.departures(1, 120, priority="bulk"))
+        await asyncio.sleep(0)
+        interactive = await asyncio.wait_for(client.departures(1, 120, priority="interactive"), 5)
+        assert not bulk.done()
+        release_bulk.set()
+        return interactive, await bulk, client.stats()
+
+    interactive, bulk, stats = asyncio.run(run())
+    assert interactive == (200, {"priority": "interactive"})
+    assert bulk == (200, {"priority": "bulk"})
+    assert stats["coalesced"] == 0
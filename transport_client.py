@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+
+"""
+Client for the db.transport REST API (https://v6.db.transport.rest).
+
+Every call goes through one pooled keep-alive requests.Session, with connect/read timeouts per
+endpoint, a bounded number of retries with jittered exponential backoff on 429s, 5xxs and network
+errors, and a circuit breaker that stops calling upstream for a while once it keeps failing.
+Identical calls of the same priority that are made at the same time share one request.
+
+Clients can share a RateBudget, a token bucket that keeps every upstream call within db.transport's
+rate limit.  Each call has a priority (interactive, background or bulk) and waits for a token behind
+the calls of the same or a higher priority, or is shed with UpstreamBusy if that wait would be too long.
+
+Every method returns a (status_code, payload) tuple, where payload is the decoded JSON body (None
+if there isn't one).  When the circuit is open, or a call still fails after its retries because of
+a network error, the status code is 503 so that the handlers answer with 503 straight away.
+
+AsyncTransportClient does the same on an asyncio event loop with aiohttp (which is only needed for
+the async serving mode), and its methods are coroutines.
+
+requests and aiohttp are imported, and the session opened, by the first upstream call, so that
+making a client costs nothing when a worker never goes upstream.
+"""
+
+import asyncio
+import heapq
+import math
+import random
+import threading
+import time
+from urllib.parse import urlencode
+
+
+# status codes that are worth trying again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# (connect, read) timeouts in seconds for each endpoint, journeys are the slowest to compute upstream
+DEFAULT_TIMEOUTS = {
+    "locations": (3.05, 10),
+    "departures": (3.05, 10),
+    "journeys": (3.05, 20),
+    "nearby": (3.05, 10),
+}
+
+# the priorities calls can have, most important first
+PRIORITIES = ("interactive", "background", "bulk")
+
+# the longest a call of each priority waits for a token before it is shed, in seconds
+DEFAULT_MAX_WAIT = {
+    "interactive": 2,
+    "background": 5,
+    "bulk": 30,
+}
+
+# the most calls of each priority that can be waiting for a token at once
+DEFAULT_MAX_QUEUE = {
+    "interactive": 100,
+    "background": 20,
+    "bulk": 500,
+}
+
+
+class UpstreamBusy(Exception):
+    """
+    Raised instead of calling upstream when the rate budget can't fit a call in soon enough.
+    retry_after is about how many seconds it would take to.
+    """
+
+    def __init__(self, priority, retry_after):
+        super().__init__(f"no upstream budget for a {priority} call, retry after {retry_after}s")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class RateBudget:
+    """
+    A token bucket for upstream calls, `rate` calls a second with bursts of up to `burst`, that can
+    be shared by threads and event loops.
+
+    When there is no token free, callers queue for one in priority order (first come first served
+    within a priority). A call is shed, with UpstreamBusy, straight away if its priority's queue is
+    full or it would wait longer than its priority's max_wait, and later if it is still waiting once
+    max_wait has gone by (because higher priority calls kept going first). So a caller always knows
+    within max_wait, instead of timing out.
+
+    Only the caller at the front of the queue waits for the next token, the rest wait to be woken
+    when they get to the front.
+    """
+
+    class Waiter:
+        def __init__(self, priority, seq, deadline, wake):
+            self.key = (PRIORITIES.index(priority), seq)
+            self.priority = priority
+            self.deadline = deadline
+            self.wake = wake
+            # granted or given up on, it is left in the heap until it gets to the top
+            self.done = False
+
+        def __lt__(self, other):
+            return self.key < other.key
+
+    def __init__(self, rate, burst, max_wait=None, max_queue=None):
+        self.rate = rate
+        # a call needs a whole token, so a bucket smaller than one would never let anything through
+        self.burst = max(burst, 1)
+        self.max_wait = dict(DEFAULT_MAX_WAIT, **(max_wait or {}))
+        self.max_queue = dict(DEFAULT_MAX_QUEUE, **(max_queue or {}))
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiters = []
+        self.seq = 0
+        self.queued = {priority: 0 for priority in PRIORITIES}
+        self.granted = {priority: 0 for priority in PRIORITIES}
+        self.shed = {priority: 0 for priority in PRIORITIES}
+
+    def acquire(self, priority="interactive"):
+        # take a token, blocking this thread until there is one, or raise UpstreamBusy
+        woken = threading.Event()
+        waiter = self.admit(priority, woken.set)
+        try:
+            while (waiter is not None):
+                delay = self.poll(waiter)
+                if (delay == 0):
+                    return
+                woken.wait(delay)
+                woken.clear()
+        except BaseException:
+            self.cancel(waiter)
+            raise
+
+    async def acquire_async(self, priority="interactive"):
+        # acquire() for a coroutine, which waits on its event loop instead of blocking it
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        waiter = self.admit(priority, lambda: loop.call_soon_threadsafe(woken.set))
+        try:
+            while (waiter is not None):
+                delay = self.poll(waiter)
+                if (delay == 0):
+                    return
+                try:
+                    await asyncio.wait_for(woken.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                woken.clear()
+        except BaseException:
+            self.cancel(waiter)
+            raise
+
+    def admit(self, priority, wake):
+        """
+        Take a token straight away if one is free and nobody is queued, and return None. Otherwise
+        queue a waiter, that wake() is called for when it gets to the front, and return it. Raises
+        UpstreamBusy if the call can't be queued.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            if (self.front() is None and self.tokens >= 1):
+                self.tokens -= 1
+                self.granted[priority] += 1
+                return None
+
+            # everything queued at the same or a higher priority goes first
+            rank = PRIORITIES.index(priority)
+            ahead = sum(self.queued[other] for other in PRIORITIES[:rank + 1])
+            wait = (ahead + 1 - self.tokens) / self.rate
+            if (self.queued[priority] >= self.max_queue[priority] or wait > self.max_wait[priority]):
+                self.shed[priority] += 1
+                raise UpstreamBusy(priority, max(1, math.ceil(wait)))
+
+            self.seq += 1
+            waiter = RateBudget.Waiter(priority, self.seq, now + self.max_wait[priority], wake)
+            heapq.heappush(self.waiters, waiter)
+            self.queued[priority] += 1
+            return waiter
+
+    def poll(self, waiter):
+        """
+        Give a queued waiter its token if it is at the front and there is one, and return 0. Otherwise
+        return how long it should wait before polling again (unless woken first). Raises UpstreamBusy
+        once it has waited its max_wait.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            front = self.front()
+            if (front is waiter and self.tokens >= 1):
+                self.tokens -= 1
+                self.granted[waiter.priority] += 1
+                self.leave(waiter)
+                return 0
+            if (now >= waiter.deadline):
+                self.shed[waiter.priority] += 1
+                self.leave(waiter)
+                raise UpstreamBusy(waiter.priority, max(1, math.ceil(sum(self.queued.values()) / self.rate)))
+            if (front is waiter):
+                return min((1 - self.tokens) / self.rate, waiter.deadline - now)
+            return waiter.deadline - now
+
+    def cancel(self, waiter):
+        # a waiter that was interrupted gives up its place
+        if (waiter is None):
+            return
+        with self.lock:
+            if (not waiter.done):
+                self.leave(waiter)
+
+    def leave(self, waiter):
+        # caller must hold the lock. if it was at the front, the next one in line has to start watching for tokens
+        was_front = self.front() is waiter
+        waiter.done = True
+        self.queued[waiter.priority] -= 1
+        if (was_front):
+            front = self.front()
+            if (front is not None):
+                front.wake()
+
+    def front(self):
+        # caller must hold the lock
+        while (self.waiters and self.waiters[0].done):
+            heapq.heappop(self.waiters)
+        return self.waiters[0] if self.waiters else None
+
+    def refill(self, now):
+        # caller must hold the lock
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def stats(self):
+        with self.lock:
+            self.refill(time.monotonic())
+            return {
+                "tokens": self.tokens,
+                "queued": dict(self.queued),
+                "granted": dict(self.granted),
+                "shed": dict(self.shed),
+            }
+
+
+class SingleFlight:
+    """
+    Makes concurrent calls for the same key share one execution.
+
+    The first caller for a key runs the function, anyone who asks for the same key while it is still
+    running waits for it and gets the same result (or exception). Counts how many calls were executed
+    and how many were coalesced onto one that was already in flight.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if (leader):
+                call = self.in_flight[key] = SingleFlight.Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        # someone else is already fetching this, wait for their result
+        if (not leader):
+            call.done.wait()
+            if (call.error is not None):
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "in_flight": len(self.in_flight),
+            }
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop, callers for the same key await the same task.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        task = self.in_flight.get(key)
+        if (task is None):
+            task = self.in_flight[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        # one caller being cancelled shouldn't cancel the call for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+        }
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` upstream failures in a row and rejects calls for `reset_timeout`
+    seconds. After that one trial call is let through, which closes the circuit again if it works.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.rejected = 0
+
+    def allow(self):
+        with self.lock:
+            if (self.opened_at is None):
+                return True
+            # still cooling down, or someone is already making the trial call
+            if (time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_progress):
+                self.rejected += 1
+                return False
+            self.trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if (self.opened_at is not None or self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+
+    def state(self):
+        with self.lock:
+            if (self.opened_at is None):
+                return "closed"
+            if (time.monotonic() - self.opened_at < self.reset_timeout):
+                return "open"
+            return "half-open"
+
+
+class TransportClient:
+    def __init__(self, base_url="https://v6.db.transport.rest", timeouts=None, max_retries=2,
+                 backoff_base=0.25, backoff_cap=2.0, pool_size=32, failure_threshold=5, reset_timeout=30,
+                 breaker=None, observer=None, budget=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.pool_size = pool_size
+
+        # one keep-alive connection pool shared by every request thread, opened when it is first needed
+        self.session = None
+        self.session_lock = threading.Lock()
+
+        # clients can share a breaker, so that they agree on whether upstream is degraded
+        self.breaker = breaker or CircuitBreaker(failure_threshold, reset_timeout)
+        self.flight = SingleFlight()
+        # the rate budget every upstream request takes a token from, if there is one
+        self.budget = budget
+        # called with the endpoint, the status code (as a string) and the seconds taken, after every upstream call
+        self.observer = observer
+
+    def open_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def locations(self, query, results=5, priority="interactive"):
+        return self.get("locations", "/locations",
+                        {"poi": "false", "addresses": "false", "query": query, "results": results}, priority)
+
+    def departures(self, stop_id, duration, priority="interactive"):
+        return self.get("departures", f"/stops/{stop_id}/departures", {"duration": duration}, priority)
+
+    def journeys(self, from_id, to_id, priority="bulk"):
+        return self.get("journeys", "/journeys", {"from": from_id, "to": to_id}, priority)
+
+    def nearby(self, latitude, longitude, poi=True, priority="bulk"):
+        return self.get("nearby", "/locations/nearby",
+                        {"latitude": latitude, "longitude": longitude, "poi": "true" if poi else "false"}, priority)
+
+    def get(self, endpoint, path, params, priority="interactive"):
+        """
+        GET an upstream path, sharing the request with any identical one of the same priority already in flight.
+
+        Calls of different priorities aren't shared, otherwise an interactive call could end up waiting
+        in the budget's bulk queue (and being shed after the bulk max_wait) behind the call it joined.
+        The payload may be shared with other callers, so it must not be modified. Raises UpstreamBusy
+        if the rate budget sheds the call.
+        """
+        url = f"{self.base_url}{path}?{urlencode(params)}"
+        return self.flight.do((url, priority), lambda: self.fetch(endpoint, url, priority))
+
+    def fetch(self, endpoint, url, priority="interactive"):
+        start = time.perf_counter()
+        status_code, payload = self.fetch_with_retries(endpoint, url, priority)
+        if (self.observer is not None):
+            self.observer(endpoint, str(status_code), time.perf_counter() - start)
+        return status_code, payload
+
+    def fetch_with_retries(self, endpoint, url, priority="interactive"):
+        import requests
+
+        # wait our turn before asking the breaker, a shed call mustn't leave a trial call hanging
+        if (self.budget is not None):
+            self.budget.acquire(priority)
+        # fail fast while upstream is known to be degraded
+        if (not self.breaker.allow()):
+            return 503, None
+
+        if (self.session is None):
+            with self.session_lock:
+                if (self.session is None):
+                    self.session = self.open_session()
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                res = self.session.get(url, timeout=self.timeouts[endpoint])
+            except requests.RequestException:
+                res = None
+            else:
+                if (res.status_code not in RETRY_STATUSES):
+                    self.breaker.record_success()
+                    return res.status_code, decode(res)
+                retry_after = res.headers.get("Retry-After")
+
+            if (attempt < self.max_retries):
+                time.sleep(self.backoff(attempt, retry_after))
+                # a retry is another request, if the budget has no room for it we have run out of retries
+                try:
+                    if (self.budget is not None):
+                        self.budget.acquire(priority)
+                except UpstreamBusy:
+                    break
+
+        # out of retries, this counts towards opening the circuit
+        self.breaker.record_failure()
+        if (res is None):
+            return 503, None
+        return res.status_code, decode(res)
+
+    def backoff(self, attempt, retry_after=None):
+        # honour a short Retry-After from upstream, otherwise exponential backoff with full jitter
+        if (retry_after is not None and retry_after.isdigit()):
+            return min(float(retry_after), self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def stats(self):
+        return {
+            "circuit": self.breaker.state(),
+            "rejected": self.breaker.rejected,
+            **self.flight.stats(),
+        }
+
+
+class AsyncTransportClient(TransportClient):
+    """
+    TransportClient for an asyncio event loop, every endpoint method returns a coroutine.
+
+    The aiohttp session is opened on first use, because it has to be made inside the running loop,
+    and close() should be awaited when the loop is shutting down.
+    """
+
+    def __init__(self, *args, **kwargs):
+        try:
+            import aiohttp
+        except ImportError:
+            raise RuntimeError("aiohttp is needed for the async serving mode, pip install aiohttp")
+        super().__init__(*args, **kwargs)
+        self.flight = AsyncSingleFlight()
+
+    def open_session(self):
+        import aiohttp
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+
+    async def get(self, endpoint, path, params, priority="interactive"):
+        url = f"{self.base_url}{path}?{urlencode(params)}"
+        # by priority too, as in TransportClient.get
+        return await self.flight.do((url, priority), lambda: self.fetch(endpoint, url, priority))
+
+    async def fetch(self, endpoint, url, priority="interactive"):
+        start = time.perf_counter()
+        status_code, payload = await self.fetch_with_retries(endpoint, url, priority)
+        if (self.observer is not None):
+            self.observer(endpoint, str(status_code), time.perf_counter() - start)
+        return status_code, payload
+
+    async def fetch_with_retries(self, endpoint, url, priority="interactive"):
+        import aiohttp
+
+        # wait our turn before asking the breaker, a shed call mustn't leave a trial call hanging
+        if (self.budget is not None):
+            await self.budget.acquire_async(priority)
+        # fail fast while upstream is known to be degraded
+        if (not self.breaker.allow()):
+            return 503, None
+
+        # only one coroutine runs at a time on the loop, so this doesn't need the lock
+        if (self.session is None):
+            self.session = self.open_session()
+        connect_timeout, read_timeout = self.timeouts[endpoint]
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        for attempt in range(self.max_retries + 1):
+            status_code, payload, retry_after = None, None, None
+            try:
+                async with self.session.get(url, timeout=timeout) as res:
+                    status_code = res.status
+                    retry_after = res.headers.get("Retry-After")
+                    payload = await decode_async(res)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            else:
+                if (status_code not in RETRY_STATUSES):
+                    self.breaker.record_success()
+                    return status_code, payload
+
+            if (attempt < self.max_retries):
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+                # a retry is another request, if the budget has no room for it we have run out of retries
+                try:
+                    if (self.budget is not None):
+                        await self.budget.acquire_async(priority)
+                except UpstreamBusy:
+                    break
+
+        # out of retries, this counts towards opening the circuit
+        self.breaker.record_failure()
+        if (status_code is None):
+            return 503, None
+        return status_code, payload
+
+    async def close(self):
+        if (self.session is not None):
+            await self.session.close()
+            self.session = None
+
+
+def decode(res):
+    try:
+        return res.json()
+    except ValueError:
+        return None
+
+
+async def decode_async(res):
+    try:
+        return await res.json(content_type=None)
+    except ValueError:
+        return None
@@ -75,14 +75,35 @@ from pathlib import Path
 # that they've been used in the weekly labs, or specified in this assignment,
 # and their versions match.
 from dotenv import load_dotenv          # Needed to load the environment variables from the .env file
-import google.generativeai as genai     # Needed to access the Generative AI API
-from flask import Flask, jsonify, request, send_file
-from flask_restx import Resource, Api, fields, reqparse, inputs
-import requests
+# google.generativeai (needed to access the Generative AI API) is only imported when gemini is first used, see LazyGemini
+import click
+from flask import Flask, Response, g, jsonify, request, send_file, stream_with_context
+from flask_restx import Resource, Api, Namespace, fields, reqparse, inputs
+from werkzeug.wsgi import ClosingIterator
 from datetime import datetime
 import sqlite3
 import pprint
 import random
+import threading
+from contextlib import contextmanager
+import csv
+import functools
+import hashlib
+import io
+import itertools
+import json
+import math
+import re
+import sys
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
+
+# the client for the db.transport API and the metrics live next to this file
+from metrics import Counter, Gauge, Registry
+from transport_client import RateBudget, TransportClient, UpstreamBusy
 
 studentid = Path(__file__).stem         # Will capture your zID from the filename.
 db_file   = f"{studentid}.db"           # Use this variable when referencing the SQLite database file.
@@ -92,50 +113,1427 @@ txt_file  = f"{studentid}.txt"          # Use this variable when referencing the
 # Load the environment variables from the .env file
 load_dotenv()
 
-# Configure the API key
-genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
 
-# Create a Gemini Pro model
-gemini = genai.GenerativeModel('gemini-pro')
+# everything GET /metrics reports, the caches' numbers are collected when it's asked for (see collect_metrics)
+registry = Registry()
+request_duration = registry.histogram("http_request_duration_seconds", "Time taken to answer a request, by route and status code",
+                                      ["route", "method", "status"])
+requests_in_flight = registry.gauge("http_requests_in_flight", "Requests being answered right now, by route", ["route"])
+upstream_duration = registry.histogram("upstream_request_duration_seconds",
+                                       "Time taken by db.transport (including retries) and Gemini calls, by endpoint and status code",
+                                       ["endpoint", "status"])
+statement_duration = registry.histogram("db_statement_duration_seconds",
+                                        "Time taken to execute SQL statements, by statement type and table", ["statement"])
 
-# Initialise flask app
-app = Flask(__name__)
-api = Api(app)
 
-# initalise db
-conn = sqlite3.connect(db_file, check_same_thread=False)
+class LazyGemini:
+    """
+    A Gemini model that is only imported, configured and created the first time it is used.
 
-# initialise cursor
-cursor = conn.cursor()
+    google.generativeai is by far the slowest thing this module imports, and only some routes need
+    it, so importing the module (or starting a worker) doesn't need it or a GOOGLE_API_KEY at all.
+    Anything asked of it, like generate_content, is passed on to the model.
+    """
 
-# create table
-cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stops'")
-existing_table = cursor.fetchone()
-if existing_table is None:
-    cursor.execute("""CREATE TABLE stops (
+    def __init__(self, model_name, api_key=None):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.lock = threading.Lock()
+        self.model = None
+
+    def get(self):
+        if (self.model is None):
+            with self.lock:
+                if (self.model is None):
+                    import google.generativeai as genai
+                    # Configure the API key
+                    genai.configure(api_key=self.api_key or os.environ["GOOGLE_API_KEY"])
+                    self.model = genai.GenerativeModel(self.model_name)
+        return self.model
+
+    def generate_content(self, *args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self.get().generate_content(*args, **kwargs)
+            status = "200"
+            return response
+        finally:
+            upstream_duration.observe(time.perf_counter() - start, "gemini", status)
+
+    async def generate_content_async(self, *args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self.get().generate_content_async(*args, **kwargs)
+            status = "200"
+            return response
+        finally:
+            upstream_duration.observe(time.perf_counter() - start, "gemini", status)
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+# Create a Gemini Pro model (when it's first needed)
+gemini = LazyGemini('gemini-pro')
+
+# every route is on this namespace, create_app adds it to each app it makes
+ns = Namespace('stops', description='Stops, their departures and operators, and guides between them', path='/')
+
+# statement type and table of each SQL statement seen, e.g. "SELECT stops", so they're only worked out once
+statement_classes = {}
+TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)", re.IGNORECASE)
+
+
+def statement_class(sql):
+    label = statement_classes.get(sql)
+    if (label is None):
+        words = sql.split(None, 2)
+        verb = words[0].upper() if words else ""
+        match = TABLE_PATTERN.search(sql)
+        # schema changes only happen in the migrations, so just the kind of change is enough for them
+        if (verb in ("CREATE", "DROP", "ALTER") and len(words) > 1):
+            label = f"{verb} {words[1].upper()}"
+        else:
+            label = f"{verb} {match.group(1)}" if match else verb
+        # statements with a variable number of placeholders could fill this up, so stop remembering at some point
+        if (len(statement_classes) < 1024):
+            statement_classes[sql] = label
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+    # a cursor that records how long each statement takes to execute (reading the rows afterwards isn't included)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            statement_duration.observe(time.perf_counter() - start, statement_class(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            statement_duration.observe(time.perf_counter() - start, statement_class(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    # a connection whose statements and commits are all timed
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            statement_duration.observe(time.perf_counter() - start, "COMMIT")
+
+
+class Lease:
+    # a connection checked out of a ConnectionManager's pool by one thread. It goes back with release(), or
+    # when the thread ends without calling that, since the thread's local data (and this with it) is dropped then
+
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def give_back(self):
+        conn, self.conn = self.conn, None
+        if (conn is not None):
+            self.pool.checkin(conn)
+
+    def __del__(self):
+        self.give_back()
+
+
+class ConnectionManager:
+    """
+    A bounded pool of SQLite connections, so Flask's request threads never share a cursor, and
+    don't each open and set up a connection of their own.
+
+    A thread checks a connection out with its first query and keeps it until it calls release(),
+    which happens at the end of every request and around every step of a flow, so a connection
+    (and its statement cache) goes on to serve other threads. At most pool_size are open at once,
+    a thread that needs one while they are all checked out waits up to pool_timeout seconds.
+
+    Every connection is opened in WAL mode, so readers on other threads are not blocked while a
+    write is in progress. Writes go through write(), which holds a process wide lock and starts the
+    transaction with BEGIN IMMEDIATE, so concurrent writers queue up rather than failing with
+    'database is locked'. busy_timeout covers any other process that has the db file open.
+    """
+
+    def __init__(self, path, synchronous="NORMAL", busy_timeout_ms=5000, setup=None, pool_size=16, pool_timeout=30):
+        self.path = path
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.slots = threading.BoundedSemaphore(pool_size)
+        # the connections that aren't checked out, the most recently used last
+        self.idle = []
+        self.idle_lock = threading.Lock()
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        # run on the first connection to the file, before anyone uses it (e.g. the migrations)
+        self.setup = setup
+        self.setup_lock = threading.Lock()
+        self.ready = False
+
+    def open(self):
+        # isolation_level=None so transactions are only started by write() and the migrations, and
+        # check_same_thread=False since a connection serves whichever thread has it checked out
+        conn = sqlite3.connect(self.path, isolation_level=None, timeout=self.busy_timeout_ms / 1000,
+                               factory=TimedConnection, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.path = self.path
+        return conn
+
+    def checkout(self):
+        if (not self.slots.acquire(timeout=self.pool_timeout)):
+            raise sqlite3.OperationalError(f"all {self.pool_size} db connections have been in use for {self.pool_timeout}s")
+        try:
+            with self.idle_lock:
+                while (self.idle):
+                    conn = self.idle.pop()
+                    if (conn.path == self.path):
+                        return conn
+                    conn.close()
+            return self.open()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn):
+        # back into the pool, without anything left uncommitted, unless the db has been switched to another file since
+        try:
+            if (conn.in_transaction):
+                conn.rollback()
+            with self.idle_lock:
+                if (conn.path == self.path):
+                    self.idle.append(conn)
+                    return
+            conn.close()
+        finally:
+            self.slots.release()
+
+    def connection(self):
+        # the connection this thread has checked out, checking one out if it hasn't got one to the current file
+        lease = getattr(self.local, "lease", None)
+        if (lease is not None and lease.conn.path != self.path):
+            self.release()
+            lease = None
+        if (lease is None):
+            lease = self.local.lease = Lease(self, self.checkout())
+        conn = lease.conn
+        if (not self.ready):
+            with self.setup_lock:
+                if (not self.ready and self.setup is not None):
+                    self.setup(conn)
+                self.ready = True
+        return conn
+
+    def release(self):
+        """
+        Give this thread's connection back to the pool, if it has one. Call when done with the db for now,
+        anything read through it (cursors, rows not fetched yet) mustn't be used afterwards.
+        """
+        lease = getattr(self.local, "lease", None)
+        if (lease is not None):
+            self.local.lease = None
+            lease.give_back()
+
+    def use(self, path):
+        # switch to another db file, each thread checks out a connection to it (and the file is set up) on its next query
+        with self.setup_lock:
+            self.path = path
+            self.ready = False
+
+    @contextmanager
+    def write(self):
+        """
+        Run a block of writes as one transaction, committing if it finishes and rolling back if it
+        (or the commit) raises. Can't be nested in another write() or a snapshot() on the same thread.
+        """
+        conn = self.connection()
+        if (conn.in_transaction):
+            raise RuntimeError("db.write() can't be used inside another write() or snapshot() on the same thread")
+        with self.write_lock:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                if (conn.in_transaction):
+                    conn.rollback()
+                raise
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Run a block of reads against one consistent view of the db, even if other threads write meanwhile.
+        """
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+
+# SQLite builds before 3.32 allow at most 999 variables in a statement, so IN lists are sent this many at a time
+IN_CHUNK_SIZE = 500
+
+
+def select_in(conn, sql, values, params=()):
+    """
+    Run a query with an IN list for any number of values, yielding every row.
+
+    sql has "{placeholders}" where the list of ?s goes, e.g. "SELECT ... WHERE stop_id IN ({placeholders})",
+    and is run once per chunk of IN_CHUNK_SIZE values, with params for any ?s after the list. conn can be a
+    connection or a write() cursor.
+    """
+    values = list(values)
+    for i in range(0, len(values), IN_CHUNK_SIZE):
+        chunk = values[i:i + IN_CHUNK_SIZE]
+        yield from conn.execute(sql.format(placeholders=", ".join("?" * len(chunk))), chunk + list(params))
+
+
+# schema migrations, each one upgrades the db by a single version and they are run in order
+# the version the db file is currently at is kept in the schema_version table
+def migration_create_stops(cursor):
+    # the original stops table, only created if this is a brand new db file
+    cursor.execute("""CREATE TABLE IF NOT EXISTS stops (
                        stop_id INTEGER,
-                   name TEXT,
-                   latitude REAL,
-                   longitude REAL,
-                   last_updated TEXT,
-                   self_link TEXT,
-                   prev_link TEXT,
-                   next_link TEXT
-                    )""")
-
-# Commit command
-conn.commit()
+                       name TEXT,
+                       latitude REAL,
+                       longitude REAL,
+                       last_updated TEXT,
+                       self_link TEXT,
+                       prev_link TEXT,
+                       next_link TEXT
+                   )""")
+
+
+def migration_stops_primary_key(cursor):
+    # rebuild stops with stop_id as the primary key so lookups by stop_id use the rowid b-tree
+    cursor.execute("""CREATE TABLE stops_new (
+                       stop_id INTEGER PRIMARY KEY,
+                       name TEXT,
+                       latitude REAL,
+                       longitude REAL,
+                       last_updated TEXT,
+                       self_link TEXT,
+                       prev_link TEXT,
+                       next_link TEXT
+                   )""")
+    # older versions stored stop_ids as text and missing links as the string 'None'
+    cursor.execute("""INSERT OR REPLACE INTO stops_new
+                      SELECT CAST(stop_id AS INTEGER), name, latitude, longitude, last_updated, self_link,
+                             NULLIF(prev_link, 'None'), NULLIF(next_link, 'None')
+                      FROM stops WHERE stop_id IS NOT NULL""")
+    cursor.execute("DROP TABLE stops")
+    cursor.execute("ALTER TABLE stops_new RENAME TO stops")
+
+
+def migration_reachability(cursor):
+    # results of upstream journey checks between two stops, reused by /guide until they are too old
+    cursor.execute("""CREATE TABLE reachability (
+                       from_stop_id INTEGER NOT NULL,
+                       to_stop_id INTEGER NOT NULL,
+                       reachable INTEGER NOT NULL,
+                       checked_at REAL NOT NULL,
+                       PRIMARY KEY (from_stop_id, to_stop_id)
+                   ) WITHOUT ROWID""")
+
+
+def migration_operator_profiles(cursor):
+    # Gemini's summary of each operator, per version of the prompt that produced it
+    cursor.execute("""CREATE TABLE operator_profiles (
+                       operator_name TEXT NOT NULL,
+                       prompt_version INTEGER NOT NULL,
+                       information TEXT NOT NULL,
+                       created_at REAL NOT NULL,
+                       PRIMARY KEY (operator_name, prompt_version)
+                   ) WITHOUT ROWID""")
+
+
+def migration_table_versions(cursor):
+    # a counter per table that goes up on every change to it, so clients can tell when it has changed
+    cursor.execute("""CREATE TABLE table_versions (
+                       name TEXT PRIMARY KEY,
+                       version INTEGER NOT NULL
+                   )""")
+    cursor.execute("INSERT INTO table_versions (name, version) VALUES ('stops', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""CREATE TRIGGER stops_version_{event.lower()} AFTER {event} ON stops
+                           BEGIN
+                               UPDATE table_versions SET version = version + 1 WHERE name = 'stops';
+                           END""")
+
+
+def migration_spatial_index(cursor):
+    # an R*Tree over where the stops are, kept in step with the stops table by triggers
+    cursor.execute("CREATE VIRTUAL TABLE stops_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    cursor.execute("""INSERT INTO stops_rtree SELECT stop_id, latitude, latitude, longitude, longitude
+                      FROM stops WHERE latitude IS NOT NULL AND longitude IS NOT NULL""")
+    cursor.execute("""CREATE TRIGGER stops_rtree_insert AFTER INSERT ON stops
+                      WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL
+                      BEGIN
+                          INSERT INTO stops_rtree VALUES (new.stop_id, new.latitude, new.latitude, new.longitude, new.longitude);
+                      END""")
+    cursor.execute("""CREATE TRIGGER stops_rtree_update AFTER UPDATE OF stop_id, latitude, longitude ON stops
+                      BEGIN
+                          DELETE FROM stops_rtree WHERE id = old.stop_id;
+                          INSERT INTO stops_rtree SELECT new.stop_id, new.latitude, new.latitude, new.longitude, new.longitude
+                          WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+                      END""")
+    cursor.execute("""CREATE TRIGGER stops_rtree_delete AFTER DELETE ON stops
+                      BEGIN
+                          DELETE FROM stops_rtree WHERE id = old.stop_id;
+                      END""")
+
+    # points of interest seen in upstream nearby lookups, with an R*Tree of their own
+    cursor.execute("""CREATE TABLE pois (
+                       id INTEGER PRIMARY KEY,
+                       poi_id TEXT NOT NULL UNIQUE,
+                       name TEXT NOT NULL,
+                       latitude REAL NOT NULL,
+                       longitude REAL NOT NULL
+                   )""")
+    cursor.execute("CREATE VIRTUAL TABLE pois_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    cursor.execute("""CREATE TRIGGER pois_rtree_insert AFTER INSERT ON pois
+                      BEGIN
+                          INSERT INTO pois_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+                      END""")
+    cursor.execute("""CREATE TRIGGER pois_rtree_update AFTER UPDATE OF latitude, longitude ON pois
+                      BEGIN
+                          UPDATE pois_rtree SET min_lat = new.latitude, max_lat = new.latitude,
+                                                min_lon = new.longitude, max_lon = new.longitude
+                          WHERE id = new.id;
+                      END""")
+    cursor.execute("""CREATE TRIGGER pois_rtree_delete AFTER DELETE ON pois
+                      BEGIN
+                          DELETE FROM pois_rtree WHERE id = old.id;
+                      END""")
+
+
+def migration_poi_cache(cursor):
+    # the POIs upstream found near each stop, as a JSON list, dropped when the stop moves or goes
+    cursor.execute("""CREATE TABLE poi_cache (
+                       stop_id INTEGER PRIMARY KEY,
+                       pois TEXT NOT NULL,
+                       fetched_at REAL NOT NULL
+                   )""")
+    cursor.execute("""CREATE TRIGGER poi_cache_stop_moved AFTER UPDATE OF latitude, longitude ON stops
+                      BEGIN
+                          DELETE FROM poi_cache WHERE stop_id = old.stop_id;
+                      END""")
+    cursor.execute("""CREATE TRIGGER poi_cache_stop_deleted AFTER DELETE ON stops
+                      BEGIN
+                          DELETE FROM poi_cache WHERE stop_id = old.stop_id;
+                      END""")
+
+
+def migration_departures(cursor):
+    # the departures upstream returned for each stop, one row per departure with a known time
+    cursor.execute("""CREATE TABLE departures (
+                       stop_id INTEGER NOT NULL,
+                       departs_at REAL NOT NULL,
+                       platform TEXT,
+                       direction TEXT,
+                       line TEXT,
+                       operator TEXT
+                   )""")
+    cursor.execute("CREATE INDEX departures_stop_departs_at ON departures (stop_id, departs_at)")
+    cursor.execute("""CREATE TRIGGER departures_stop_deleted AFTER DELETE ON stops
+                      BEGIN
+                          DELETE FROM departures WHERE stop_id = old.stop_id;
+                      END""")
+    # the next departure worked out from them, kept on the stop so reading a stop gets it for free
+    cursor.execute("ALTER TABLE stops ADD COLUMN next_departure TEXT")
+    # GET /stops doesn't list next_departure, so refreshing it shouldn't change the listing's ETag
+    cursor.execute("DROP TRIGGER stops_version_update")
+    cursor.execute("""CREATE TRIGGER stops_version_update
+                      AFTER UPDATE OF stop_id, last_updated, name, latitude, longitude, self_link, prev_link, next_link ON stops
+                      BEGIN
+                          UPDATE table_versions SET version = version + 1 WHERE name = 'stops';
+                      END""")
+
+
+def migration_stop_search(cursor):
+    # names in case insensitive order, for finding the names that start with something
+    cursor.execute("CREATE INDEX stops_name ON stops (name COLLATE NOCASE)")
+    # full text indexes over the stop names, one by word (with prefixes of 2 and 3 characters indexed
+    # for autocomplete) and one by trigram for fuzzy matching. both read the names from stops itself
+    cursor.execute("""CREATE VIRTUAL TABLE stops_search USING fts5(
+                       name, content='stops', content_rowid='stop_id',
+                       tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                   )""")
+    cursor.execute("""CREATE VIRTUAL TABLE stops_trigrams USING fts5(
+                       name, content='stops', content_rowid='stop_id', tokenize='trigram'
+                   )""")
+    for index in ("stops_search", "stops_trigrams"):
+        cursor.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+        # an external content index has to be told the old name to remove it
+        cursor.execute(f"""CREATE TRIGGER {index}_insert AFTER INSERT ON stops
+                           BEGIN
+                               INSERT INTO {index}(rowid, name) VALUES (new.stop_id, new.name);
+                           END""")
+        cursor.execute(f"""CREATE TRIGGER {index}_update AFTER UPDATE OF stop_id, name ON stops
+                           BEGIN
+                               INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.stop_id, old.name);
+                               INSERT INTO {index}(rowid, name) VALUES (new.stop_id, new.name);
+                           END""")
+        cursor.execute(f"""CREATE TRIGGER {index}_delete AFTER DELETE ON stops
+                           BEGIN
+                               INSERT INTO {index}({index}, rowid, name) VALUES ('delete', old.stop_id, old.name);
+                           END""")
+
+
+def migration_drop_next_departure(cursor):
+    # the next departure is worked out from the departures table whenever a stop is read now, so it can't
+    # be one that has already left. SQLite before 3.35 can't drop a column, there it is just left unused
+    if (sqlite3.sqlite_version_info >= (3, 35, 0)):
+        cursor.execute("ALTER TABLE stops DROP COLUMN next_departure")
+
+
+MIGRATIONS = [
+    migration_create_stops,
+    migration_stops_primary_key,
+    migration_reachability,
+    migration_operator_profiles,
+    migration_table_versions,
+    migration_spatial_index,
+    migration_poi_cache,
+    migration_departures,
+    migration_stop_search,
+    migration_drop_next_departure,
+]
+
+
+def migrate(conn):
+    """
+    Bring the db file up to the latest schema version, running any migrations it has not had yet.
+
+    Each migration runs in its own transaction together with the version bump, so a failed
+    upgrade leaves the db at the last version that completed. The transactions are started with
+    BEGIN IMMEDIATE and the version is read inside them, so when several processes open the same
+    file at once, each migration is run by whichever gets there first and skipped by the others.
+    """
+    cursor = conn.cursor()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+            row = cursor.execute("SELECT version FROM schema_version").fetchone()
+            if (row is None):
+                cursor.execute("INSERT INTO schema_version (version) VALUES (0)")
+                row = (0,)
+            if (row[0] < version):
+                migration(cursor)
+                cursor.execute("UPDATE schema_version SET version = ?", (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# initalise db, the synchronous level, busy timeout and pool size can be changed in the .env file
+# nothing is opened until the first query, which creates or upgrades the tables
+db = ConnectionManager(
+    db_file,
+    synchronous=os.environ.get("DB_SYNCHRONOUS", "NORMAL"),
+    busy_timeout_ms=int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000")),
+    setup=migrate,
+    pool_size=int(os.environ.get("DB_POOL_SIZE", "16")),
+    pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+)
+
+
+def stops_version(conn):
+    # the stops table's version in table_versions, every write to stops (from any process) moves it on
+    return conn.execute("SELECT version FROM table_versions WHERE name = 'stops'").fetchone()[0]
+
+
+def update_neighbour_links(cursor, stop_ids):
+    """
+    Re-link the stops around each of the given stop_ids after they have been inserted or deleted.
+
+    Only the given stops (if they are still in the db) and their immediate neighbours by stop_id
+    are touched, so the cost does not grow with the size of the table. Runs on the cursor of the
+    caller's write transaction, which commits once the whole change has been made. Returns the
+    stop_ids it re-linked.
+    """
+    affected_stop_ids = set()
+    for stop_id in stop_ids:
+        # the stop itself, if it was inserted rather than deleted
+        affected_stop_ids.update(row[0] for row in cursor.execute(
+            "SELECT stop_id FROM stops WHERE stop_id = ?", (stop_id,)))
+        # the stop right before it
+        affected_stop_ids.update(row[0] for row in cursor.execute(
+            "SELECT stop_id FROM stops WHERE stop_id < ? ORDER BY stop_id DESC LIMIT 1", (stop_id,)))
+        # the stop right after it
+        affected_stop_ids.update(row[0] for row in cursor.execute(
+            "SELECT stop_id FROM stops WHERE stop_id > ? ORDER BY stop_id LIMIT 1", (stop_id,)))
+
+    # point each affected stop at its current neighbours, the first stop has no prev and the last has no next
+    cursor.executemany("""UPDATE stops SET
+                              prev_link = (SELECT s.self_link FROM stops s WHERE s.stop_id < stops.stop_id
+                                           ORDER BY s.stop_id DESC LIMIT 1),
+                              next_link = (SELECT s.self_link FROM stops s WHERE s.stop_id > stops.stop_id
+                                           ORDER BY s.stop_id LIMIT 1)
+                          WHERE stop_id = ?""", [(stop_id,) for stop_id in affected_stop_ids])
+    return affected_stop_ids
+
+
+class TTLCache:
+    """
+    A small thread-safe in-process cache whose entries expire after a time-to-live.
+
+    Expired entries are kept for a further stale_ttl seconds, during which lookup() still returns
+    them (marked as stale) so a caller can serve them while it refreshes them. When there are more
+    than max_entries entries, or their estimated size goes over max_bytes, the least recently used
+    ones are evicted. Hits, stale hits, misses and evictions are counted.
+    """
+
+    def __init__(self, ttl, max_entries=1024, max_bytes=16 * 1024 * 1024, stale_ttl=0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (expires_at, size, value), in least to most recently used order
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if there isn't one or it has expired.
+        """
+        value, fresh = self.lookup(key)
+        return value if fresh else None
+
+    def lookup(self, key):
+        """
+        Return the cached value for key and whether it is still fresh.
+
+        The value is None if there isn't one, or it has been expired for longer than stale_ttl.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            now = time.monotonic()
+            if (entry is not None and entry[0] + self.stale_ttl < now):
+                self._remove(key)
+                entry = None
+            if (entry is None):
+                self.misses += 1
+                return None, False
+            self.entries.move_to_end(key)
+            if (entry[0] < now):
+                self.stale_hits += 1
+                return entry[2], False
+            self.hits += 1
+            return entry[2], True
+
+    def expires_in(self, key):
+        """
+        Seconds until the entry for key stops being fresh (negative once it has), None if there isn't one.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else entry[0] - time.monotonic()
+
+    def set(self, key, value, ttl=None):
+        # the size is estimated from the value's JSON encoding, which is what the values here are made of
+        size = len(json.dumps(value, default=str))
+        with self.lock:
+            if (key in self.entries):
+                self._remove(key)
+            # anything bigger than the whole cache is not worth keeping
+            if (size > self.max_bytes):
+                return
+            expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self.entries[key] = (expires_at, size, value)
+            self.total_bytes += size
+            # evict the least recently used entries until we are back under both limits
+            while (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if (key in self.entries):
+                self._remove(key)
+
+    def _remove(self, key):
+        # caller must hold the lock
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            }
+
+
+# db.transport allows about 100 requests a minute, and every call to it takes a token from this budget.
+# Stop lookups go before background refreshes, which go before guides and imports
+upstream_budget = RateBudget(
+    rate=float(os.environ.get("UPSTREAM_RATE", str(100 / 60))),
+    burst=float(os.environ.get("UPSTREAM_BURST", "20")),
+    max_wait={
+        "interactive": float(os.environ.get("UPSTREAM_INTERACTIVE_MAX_WAIT", "2")),
+        "background": float(os.environ.get("UPSTREAM_BACKGROUND_MAX_WAIT", "5")),
+        "bulk": float(os.environ.get("UPSTREAM_BULK_MAX_WAIT", "30")),
+    },
+)
+
+# all calls to db.transport go through the one pooled client
+transport = TransportClient(
+    base_url=os.environ.get("TRANSPORT_BASE_URL", "https://v6.db.transport.rest"),
+    max_retries=int(os.environ.get("TRANSPORT_MAX_RETRIES", "2")),
+    failure_threshold=int(os.environ.get("TRANSPORT_FAILURE_THRESHOLD", "5")),
+    reset_timeout=float(os.environ.get("TRANSPORT_RESET_TIMEOUT", "30")),
+    observer=lambda endpoint, status, seconds: upstream_duration.observe(seconds, endpoint, status),
+    budget=upstream_budget,
+)
+
+
+def upstream_busy(error):
+    # the upstream budget shed a call this request needed, so say when it is worth trying again
+    return {
+        "Error": 503,
+        "Message": "Service unavailable, too many requests to db.transport right now"
+    }, 503, {"Retry-After": str(error.retry_after)}
+
+
+def upstream_answered(status_code):
+    # whether a db.transport status is an answer about what was asked: a 200, or a 4xx other than 429. A 429 or
+    # 5xx (still failing after the retries) or a network failure or open circuit (503) only says upstream couldn't
+    return status_code == 200 or (400 <= status_code < 500 and status_code != 429)
+
+
+def upstream_unavailable():
+    # db.transport couldn't answer, so say when it's worth trying again: once the circuit would let a call through
+    return {
+        "Error": 503,
+        "Message": "Service unavailable"
+    }, 503, {"Retry-After": str(int(transport.breaker.reset_timeout))}
+
+
+def shed_when_busy(view):
+    """
+    Answer with upstream_busy when a route's upstream call is shed. Done around every route rather
+    than as an error handler, which would log a traceback for each one.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except UpstreamBusy as e:
+            return upstream_busy(e)
+    return wrapper
+
+
+ns.decorators.append(shed_when_busy)
+
+
+# The steps of a route that go upstream are written once, as flows shared with the async server
+# (async_server.py). A flow is a generator that yields a Step for each piece of I/O it needs and is
+# sent back its result (or has its exception thrown in). run_flow makes the calls here, blocking
+# the thread, and the async server makes the same calls on its event loop with its own transport.
+Step = namedtuple("Step", ["kind", "target", "args", "kwargs"])
+
+
+def upstream(method, *args, **kwargs):
+    # a step that calls db.transport, e.g. upstream("departures", stop_id, window)
+    return Step("upstream", method, args, kwargs)
+
+
+def in_db(fn, *args):
+    # a step that runs fn, which reads or writes the db (the async server runs these on its db threads)
+    return Step("db", fn, args, {})
+
+
+def concurrently(flows, limit, until=None):
+    """
+    A step that runs several flows at once, a dict of them by key, with at most `limit` running at a time.
+
+    Its result is a list of (key, result) in the order they finished. As soon as one's result makes
+    until(result) true, the flows that haven't finished are dropped and the list stops there.
+    """
+    return Step("concurrently", flows, (limit, until), {})
+
+
+def run_flow(flow):
+    """
+    Run a flow on this thread, returning what it returns.
+    """
+    result, error = None, None
+    while True:
+        try:
+            step = flow.throw(error) if error is not None else flow.send(result)
+        except StopIteration as e:
+            return e.value
+        result, error = None, None
+        try:
+            # a db connection is only kept for as long as a db step runs, not while waiting on anything else
+            if (step.kind == "upstream"):
+                db.release()
+                result = getattr(transport, step.target)(*step.args, **step.kwargs)
+            elif (step.kind == "concurrently"):
+                db.release()
+                result = run_concurrently(step.target, *step.args)
+            else:
+                try:
+                    result = step.target(*step.args, **step.kwargs)
+                finally:
+                    db.release()
+        except Exception as e:
+            error = e
+
+
+def run_concurrently(flows, limit, until=None):
+    # the concurrently step for run_flow, each flow runs on a thread of its own
+    if (not flows):
+        return []
+    cancelled = threading.Event()
+    skipped = object()
+
+    def run(flow):
+        # a flow that was already picked up by a worker when `until` was met is skipped
+        if (cancelled.is_set()):
+            flow.close()
+            return skipped
+        return run_flow(flow)
+
+    executor = ThreadPoolExecutor(max_workers=min(limit, len(flows)))
+    futures = {executor.submit(run, flow): key for key, flow in flows.items()}
+    finished = []
+    try:
+        for future in as_completed(futures):
+            result = future.result()
+            if (result is skipped):
+                continue
+            finished.append((futures[future], result))
+            if (until is not None and until(result)):
+                break
+        return finished
+    finally:
+        # don't wait for the flows still running, their results are no longer needed
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# upstream departures are stored in the departures table, and departures_cache tracks how wide a window
+# was stored for each stop and whether it is still fresh. The window fetched is always at least
+# DEPARTURES_WINDOW minutes so that narrower windows (like the 90 min operator query) are answered from it.
+# Once expired, a window is still used for DEPARTURES_STALE_TTL seconds while it is refreshed in the background
+DEPARTURES_WINDOW = 120
+departures_cache = TTLCache(
+    ttl=float(os.environ.get("DEPARTURES_CACHE_TTL", "30")),
+    max_entries=int(os.environ.get("DEPARTURES_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.environ.get("DEPARTURES_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    stale_ttl=float(os.environ.get("DEPARTURES_STALE_TTL", "60")),
+)
+
+
+class DeparturesRefresher:
+    """
+    Refreshes cached departures in the background.
+
+    Counts how often each stop's departures are asked for (halving the counts every interval, so
+    stops that go quiet cool down) and, every `interval` seconds, refreshes the `hot_stops` most
+    asked for stops whose cache entry would expire before the next round. Stale entries that are
+    served get refreshed straight away through refresh_async(). The background thread is only
+    started once the first departures are asked for.
+    """
+
+    def __init__(self, hot_stops=50, interval=10, workers=4):
+        self.hot_stops = hot_stops
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.refreshing = set()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="departures-refresh")
+        self.thread = None
+        self.refreshes = 0
+
+    def record(self, stop_id):
+        with self.lock:
+            self.requests[stop_id] = self.requests.get(stop_id, 0) + 1
+            if (self.thread is None and self.hot_stops > 0):
+                self.thread = threading.Thread(target=self.run, name="departures-refresher", daemon=True)
+                self.thread.start()
+
+    def refresh_async(self, stop_id):
+        # only one refresh per stop at a time
+        with self.lock:
+            if (stop_id in self.refreshing):
+                return
+            self.refreshing.add(stop_id)
+        self.executor.submit(self.refresh, stop_id)
+
+    def refresh(self, stop_id):
+        try:
+            fetch_departures(stop_id, DEPARTURES_WINDOW, priority="background")
+        finally:
+            with self.lock:
+                self.refreshing.discard(stop_id)
+                self.refreshes += 1
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.refresh_hot_stops()
+
+    def refresh_hot_stops(self):
+        with self.lock:
+            hot = sorted(self.requests, key=self.requests.get, reverse=True)[:self.hot_stops]
+            self.requests = {stop_id: count / 2 for stop_id, count in self.requests.items() if count / 2 >= 0.1}
+
+        for stop_id in hot:
+            # refresh anything that would go stale before we next look at it
+            expires_in = departures_cache.expires_in(stop_id)
+            if (expires_in is None or expires_in < self.interval):
+                self.refresh_async(stop_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "tracked_stops": len(self.requests),
+                "refreshing": len(self.refreshing),
+                "refreshes": self.refreshes,
+            }
+
+
+departures_refresher = DeparturesRefresher(
+    hot_stops=int(os.environ.get("DEPARTURES_HOT_STOPS", "50")),
+    interval=float(os.environ.get("DEPARTURES_REFRESH_INTERVAL", "10")),
+)
+
+
+def departure_time(departure):
+    # the realtime departure time, or the planned one if there is no realtime data (e.g. cancelled), as a unix time
+    when = departure.get('when') or departure.get('plannedWhen')
+    return datetime.fromisoformat(when).timestamp() if when else None
+
+
+def fetch_departures(stop_id, window, priority="interactive"):
+    """
+    Fetch the departures from a stop for the next `window` minutes from db.transport and store them.
+
+    Returns the upstream status code.
+    """
+    return run_flow(fetch_departures_flow(stop_id, window, priority))
+
+
+def fetch_departures_flow(stop_id, window, priority="interactive"):
+    # fetch_departures as a flow
+    status_code, payload = yield upstream("departures", stop_id, window, priority=priority)
+    if (status_code == 200):
+        yield in_db(store_departures, stop_id, window, payload)
+    return status_code
+
+
+def store_departures(stop_id, window, payload):
+    """
+    Store an upstream departures response for the next `window` minutes from a stop.
+
+    The departures replace the stop's rows in the departures table, and departures_cache records
+    that the stop has a window this wide stored.
+    """
+    rows = []
+    for departure in payload['departures']:
+        departs_at = departure_time(departure)
+        if (departs_at is None):
+            continue
+        line = departure.get('line') or {}
+        rows.append((stop_id, departs_at, departure.get('platform') or None, departure.get('direction') or None,
+                     line.get('name'), (line.get('operator') or {}).get('name')))
+
+    with db.write() as cursor:
+        cursor.execute("DELETE FROM departures WHERE stop_id = ?", (stop_id,))
+        cursor.executemany("""INSERT INTO departures (stop_id, departs_at, platform, direction, line, operator)
+                              VALUES (?, ?, ?, ?, ?, ?)""", rows)
+
+    departures_cache.set(stop_id, {"duration": window})
+
+
+def ensure_departures_flow(stop_id, duration):
+    """
+    Make sure the departures table holds the departures from a stop for (at least) the next `duration` minutes.
+
+    Returns 200, or the upstream status code if they had to be fetched and that failed.
+    """
+    window = departures_window_needed(stop_id, duration)
+    if (window is None):
+        return 200
+    return (yield from fetch_departures_flow(stop_id, window))
+
+
+def unless_busy(flow):
+    # a flow whose upstream call was shed by the budget ends with 503, like when upstream is down
+    try:
+        return (yield from flow)
+    except UpstreamBusy:
+        return 503
+
+
+def departures_window_needed(stop_id, duration):
+    """
+    The window (in minutes) that has to be fetched for a stop before its next `duration` minutes of
+    departures can be read, or None if they are already stored.
+
+    Nothing is needed if departures_cache says a window at least that wide was stored within its
+    TTL. A stale window is used as is while it is refreshed in the background.
+    """
+    departures_refresher.record(stop_id)
+    cached, fresh = departures_cache.lookup(stop_id)
+    if (cached is None or cached['duration'] < duration):
+        return max(duration, DEPARTURES_WINDOW)
+    if (not fresh):
+        departures_refresher.refresh_async(stop_id)
+    return None
+
+
+def get_operators(stop_id, duration):
+    # the distinct operators departing from a stop in the next `duration` minutes, in order of first departure
+    now = time.time()
+    rows = db.connection().execute("""SELECT operator FROM departures
+                                      WHERE stop_id = ? AND departs_at BETWEEN ? AND ? AND operator IS NOT NULL
+                                      GROUP BY operator ORDER BY MIN(departs_at)""",
+                                   (stop_id, now, now + duration * 60))
+    return [row[0] for row in rows]
+
+
+def make_stop(stop_id, name, latitude, longitude):
+    """
+    Put a stop in the format that is defined by spec, along with the name and location we also keep in the db.
+    """
+    return {
+        "stop_id": int(stop_id),
+        "name": name,
+        "latitude": latitude,
+        "longitude": longitude,
+        "last_updated": datetime.now().strftime("%Y-%m-%d-%H:%M:%S"),
+        "_links": {
+            "self": {
+                "href": f"http://localhost:5000/stops/{int(stop_id)}",
+            },
+        },
+    }
+
+
+# what upstream found for each query, so repeated queries (like the same import run again) skip the round trip.
+# queries that found nothing are remembered too, for less time since a stop may be added upstream
+locations_cache = TTLCache(
+    ttl=float(os.environ.get("LOCATIONS_CACHE_TTL", str(60 * 60))),
+    max_entries=int(os.environ.get("LOCATIONS_CACHE_MAX_ENTRIES", "4096")),
+    max_bytes=int(os.environ.get("LOCATIONS_CACHE_MAX_BYTES", str(4 * 1024 * 1024))),
+)
+LOCATIONS_NEGATIVE_TTL = float(os.environ.get("LOCATIONS_NEGATIVE_TTL", "300"))
+
+
+def normalise_query(q):
+    # "  berlin   HBF" and "Berlin Hbf" are the same question to upstream
+    if (not isinstance(q, str)):
+        raise ValueError(f"a query has to be a string, not {type(q).__name__}")
+    return " ".join(unicodedata.normalize("NFKC", q).casefold().split())
+
+
+def cached_query_stops(q):
+    """
+    The stops upstream found for this query, if it was asked recently enough, otherwise None.
+
+    They are made fresh each time so that their last_updated is now, as if upstream had just been asked.
+    """
+    found = locations_cache.get(normalise_query(q))
+    if (found is None):
+        return None
+    return [make_stop(*stop) for stop in found]
+
+
+def remember_query_stops(q, stops):
+    # only what is needed to make the stops again, an empty list is kept for LOCATIONS_NEGATIVE_TTL
+    locations_cache.set(normalise_query(q),
+                        [(stop['stop_id'], stop['name'], stop['latitude'], stop['longitude']) for stop in stops],
+                        ttl=None if stops else LOCATIONS_NEGATIVE_TTL)
+
+
+def query_upstream_stops(q, priority="interactive"):
+    """
+    Ask db.transport for the stops matching a query, or the locations cache if it was asked recently.
+
+    Returns the upstream status code and the matching stops (stations are left out) sorted by stop_id.
+    The list is empty unless the status code is 200.
+    """
+    return run_flow(query_upstream_stops_flow(q, priority))
+
+
+def query_upstream_stops_flow(q, priority="interactive"):
+    # query_upstream_stops as a flow, a query that isn't a non-empty string is a bad request without asking anyone
+    if (not isinstance(q, str) or not q.strip()):
+        return 400, []
+    cached = cached_query_stops(q)
+    if (cached is not None):
+        return 200, cached
+    status_code, payload = yield upstream("locations", q, results=5, priority=priority)
+    if (status_code != 200):
+        return status_code, []
+    stops = parse_upstream_stops(payload)
+    remember_query_stops(q, stops)
+    return 200, stops
+
+
+def parse_upstream_stops(payload):
+    # remove all the items that are not stops (removes stations)
+    l = [item for item in payload if item['type'] == 'stop']
+
+    # put the data in the format that is defined by spec and sort list by stop_id
+    formatted_list = [
+        make_stop(item['id'], item['name'], item['location']['latitude'], item['location']['longitude'])
+        for item in l
+    ]
+    return sorted(formatted_list, key=lambda x: x['stop_id'])
+
+
+def upsert_stops(stops):
+    """
+    Store a batch of stops in one transaction.
+
+    Stops that are not in the db yet are inserted, stops that already exist have their last_updated
+    time refreshed, and their name, latitude and longitude too if those have changed. Returns the
+    stop_ids that were new to the db, sorted.
+    """
+    stop_ids = [stop['stop_id'] for stop in stops]
+    with db.write() as cursor:
+        version_before = stops_version(cursor)
+        # find out which stops are already stored
+        existing_stop_ids = {row[0] for row in select_in(cursor, "SELECT stop_id FROM stops WHERE stop_id IN ({placeholders})",
+                                                         stop_ids)}
+
+        # insert every stop, or just refresh last_updated when it's already there
+        cursor.executemany("""INSERT INTO stops(stop_id, name, latitude, longitude, last_updated, self_link)
+                              VALUES (?, ?, ?, ?, ?, ?)
+                              ON CONFLICT(stop_id) DO UPDATE SET last_updated = excluded.last_updated""",
+                           [(stop['stop_id'], stop['name'], stop['latitude'], stop['longitude'],
+                             stop['last_updated'], stop['_links']['self']['href']) for stop in stops])
+        # then update the existing stops whose details have changed, only those so that the search and spatial
+        # indexes (and the POIs cached near a stop) aren't touched for stops that are the same as before
+        cursor.executemany("""UPDATE stops SET name = ?, latitude = ?, longitude = ?
+                              WHERE stop_id = ? AND (name IS NOT ? OR latitude IS NOT ? OR longitude IS NOT ?)""",
+                           [(stop['name'], stop['latitude'], stop['longitude'], stop['stop_id'],
+                             stop['name'], stop['latitude'], stop['longitude'])
+                            for stop in stops if stop['stop_id'] in existing_stop_ids])
+
+        # only the new stops and the stops either side of them need their links updated
+        inserted_stop_ids = sorted(set(stop_ids) - existing_stop_ids)
+        relinked_stop_ids = update_neighbour_links(cursor, inserted_stop_ids)
+        version_after = stops_version(cursor)
+
+    stops_replica.changed(relinked_stop_ids.union(stop_ids), version_before, version_after)
+    return inserted_stop_ids
+
+
+# metres in one degree of latitude, and the furthest apart two points on earth can be
+METRES_PER_DEGREE = 111320
+MAX_DISTANCE = 20038000
+
+# what a nearby search looks through, the R*Tree narrows it down to a bounding box (north, south, east, west)
+SPATIAL_QUERIES = {
+    "stops": """SELECT s.stop_id, s.name, s.latitude, s.longitude, s.self_link
+                FROM stops_rtree r JOIN stops s ON s.stop_id = r.id
+                WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?""",
+    "pois": """SELECT p.poi_id, p.name, p.latitude, p.longitude
+               FROM pois_rtree r JOIN pois p ON p.id = r.id
+               WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ?""",
+}
+
+
+def distance_between(lat1, lon1, lat2, lon2):
+    # great circle distance in metres (haversine)
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+def find_nearby(kind, latitude, longitude, radius=None, k=None):
+    """
+    Find the stored stops or POIs (kind is "stops" or "pois") closest to a location, nearest first.
+
+    With a radius (in metres) everything within it is returned, up to k of them. Without one the k
+    nearest are returned, searching a box that grows until it is sure to hold them. Each result
+    is a dict of the row's columns plus its "distance" in metres.
+    """
+    conn = db.connection()
+    search_radius = radius if radius is not None else 1000
+    while True:
+        # the bounding box around the location that contains the search radius
+        lat_delta = search_radius / METRES_PER_DEGREE
+        lon_delta = search_radius / (METRES_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        cursor = conn.execute(SPATIAL_QUERIES[kind], (latitude + lat_delta, latitude - lat_delta,
+                                                       longitude + lon_delta, longitude - lon_delta))
+        columns = [column[0] for column in cursor.description]
+
+        # the box's corners are further away than the radius, so only keep what's inside the radius
+        found = []
+        for row in cursor:
+            result = dict(zip(columns, row))
+            result['distance'] = distance_between(latitude, longitude, result['latitude'], result['longitude'])
+            if (result['distance'] <= search_radius):
+                found.append(result)
+
+        # everything within search_radius has been seen, so if that's at least k results they are the nearest k
+        if (radius is not None or len(found) >= k or search_radius >= MAX_DISTANCE):
+            break
+        search_radius *= 4
+
+    found.sort(key=lambda result: result['distance'])
+    return found[:k] if k else found
+
+
+def store_pois(pois):
+    # add POIs from an upstream nearby lookup to the local index, or update the ones we already have
+    with db.write() as cursor:
+        cursor.executemany("""INSERT INTO pois (poi_id, name, latitude, longitude) VALUES (?, ?, ?, ?)
+                              ON CONFLICT(poi_id) DO UPDATE SET name = excluded.name,
+                                  latitude = excluded.latitude, longitude = excluded.longitude""",
+                           [(str(poi['id']), poi['name'], poi['latitude'], poi['longitude']) for poi in pois])
+
+
+# how close to a stop a POI has to be to be used in its guide, in metres
+GUIDE_POI_RADIUS = float(os.environ.get("GUIDE_POI_RADIUS", "1000"))
+# how long the POIs found near a stop are kept for, in seconds
+POI_CACHE_TTL = float(os.environ.get("POI_CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+
+class HitCounter:
+    """
+    Thread-safe count of how a cache lookup was answered, e.g. "hit" or "miss".
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        lookups = sum(counts.values())
+        counts['hit_ratio'] = counts.get('hit', 0) / lookups if lookups else 0.0
+        return counts
+
+
+# hit: answered from poi_cache, local: from the spatial index, miss: had to ask upstream
+poi_cache_counter = HitCounter()
+
+
+def fetch_pois_for_stop(stop_id, latitude, longitude):
+    """
+    Ask db.transport for the POIs near a stop, and keep them in poi_cache and the spatial index.
+
+    Returns the status code and the list of POIs, nearest first.
+    """
+    return run_flow(fetch_pois_for_stop_flow(stop_id, latitude, longitude))
+
+
+def fetch_pois_for_stop_flow(stop_id, latitude, longitude):
+    # fetch_pois_for_stop as a flow, nothing is stored unless upstream answered with a list of locations
+    status_code, nearby = yield upstream("nearby", latitude, longitude)
+    if (status_code != 200):
+        return status_code, []
+    if (not isinstance(nearby, list)):
+        return 503, []
+    return 200, (yield in_db(store_pois_for_stop, stop_id, nearby))
+
+
+def store_pois_for_stop(stop_id, nearby):
+    # keep the POIs from an upstream nearby response in poi_cache and the spatial index, and return them
+    # keep the locations that have a 'poi' value of true
+    pois = [{"id": str(location['id']), "name": location['name'],
+             "latitude": location['latitude'], "longitude": location['longitude']}
+            for location in nearby
+            if location.get('type') == 'location' and location.get('poi') == True]
+
+    if (pois):
+        store_pois(pois)
+    with db.write() as cursor:
+        cursor.execute("INSERT OR REPLACE INTO poi_cache (stop_id, pois, fetched_at) VALUES (?, ?, ?)",
+                       (stop_id, json.dumps(pois), time.time()))
+    return pois
+
+
+def find_poi_near_stop_flow(stop_id, latitude, longitude):
+    """
+    Find a point of interest near a stop for the guide.
+
+    Looks in poi_cache for what upstream found near this stop within POI_CACHE_TTL first, then for
+    the nearest POI in the spatial index within GUIDE_POI_RADIUS, and only then asks db.transport.
+    Returns the status code and the POI (a dict with at least a name), which is None if there isn't one.
+    """
+    found, poi = yield in_db(find_known_poi, stop_id, latitude, longitude)
+    if (found):
+        return 200, poi
+
+    status_code, pois = yield from fetch_pois_for_stop_flow(stop_id, latitude, longitude)
+    return status_code, pois[0] if pois else None
+
+
+def find_known_poi(stop_id, latitude, longitude):
+    """
+    The part of find_poi_near_stop_flow that doesn't ask upstream.
+
+    Returns True and the POI (or None if upstream found none near the stop) if poi_cache or the spatial
+    index could answer, otherwise False and None, and then upstream has to be asked.
+    """
+    row = db.connection().execute("SELECT pois FROM poi_cache WHERE stop_id = ? AND fetched_at >= ?",
+                                  (stop_id, time.time() - POI_CACHE_TTL)).fetchone()
+    if (row is not None):
+        poi_cache_counter.count("hit")
+        pois = json.loads(row[0])
+        return True, pois[0] if pois else None
+
+    local = find_nearby("pois", latitude, longitude, radius=GUIDE_POI_RADIUS, k=1)
+    if (local):
+        poi_cache_counter.count("local")
+        return True, local[0]
+
+    poi_cache_counter.count("miss")
+    return False, None
+
 
 # initialise q1 parser
 q1_parser = reqparse.RequestParser()
 # add a query arg to q1_parser
 q1_parser.add_argument('query', type=str)
+q1_parser.add_argument('local_first', type=inputs.boolean, required=False,
+                       help='Answer from the stored stops without asking upstream, if they are fresh enough')
+
+# with local_first, PUT /stops answers from the db when every stored match was refreshed this many seconds ago or less
+LOCAL_FIRST_MAX_AGE = int(os.environ.get("LOCAL_FIRST_MAX_AGE", "86400"))
 
 
+# the stops collection is paged by stop_id, this many stops a page unless asked for fewer
+STOPS_PAGE_SIZE = int(os.environ.get("STOPS_PAGE_SIZE", "20"))
+STOPS_MAX_PAGE_SIZE = int(os.environ.get("STOPS_MAX_PAGE_SIZE", "100"))
 
-@api.route('/stops')
+# parser for listing stops
+list_parser = reqparse.RequestParser()
+list_parser.add_argument('after', type=int, required=False, help='Only return stops with a stop_id greater than this')
+list_parser.add_argument('limit', type=inputs.int_range(1, STOPS_MAX_PAGE_SIZE), required=False)
+list_parser.add_argument('include', type=str, required=False)
+
+
+@ns.route('/stops')
 class QueryStops(Resource):
-    @api.doc(responses={
+    @ns.doc(responses={
+        200: 'Success',
+        304: 'Not Modified',
+        400: 'Bad Request',
+    },
+    description='List the stored stops in stop_id order, a page at a time. Pass the last stop_id of a page as '
+                '"after" to get the next one. Responses carry an ETag that changes whenever the stops change.')
+    @ns.expect(list_parser)
+    def get(self):
+        args = list_parser.parse_args()
+        after = args.get('after')
+        limit = args.get('limit') or STOPS_PAGE_SIZE
+        q = args.get('include')
+
+        # same include semantics as a single stop, except the next departure which needs an upstream call per stop
+        params = ["last_updated", "name", "latitude", "longitude"]
+        if (q):
+            params, error = parse_include(q)
+            if (error):
+                return {
+                    "Error": 400,
+                    "Message": error
+                }, 400
+            if ("next_departure" in params):
+                return {
+                    "Error": 400,
+                    "Message": "Bad request, next_departure can only be included when getting a single stop"
+                }, 400
+
+        with db.snapshot() as conn:
+            # the page can only have changed if the stops table has, so the table's version makes the ETag
+            version = stops_version(conn)
+            etag = hashlib.sha256(json.dumps([version, after, limit, q]).encode("utf-8")).hexdigest()[:32]
+            if (request.if_none_match.contains(etag)):
+                return None, 304, {"ETag": f'"{etag}"'}
+
+            # one more than the page size, to know if there is a next page
+            rows = conn.execute("""SELECT stop_id, last_updated, name, latitude, longitude, self_link, prev_link, next_link
+                                   FROM stops WHERE stop_id > ? ORDER BY stop_id LIMIT ?""",
+                                (after if after is not None else -1, limit + 1)).fetchall()
+
+        stops = []
+        for row in rows[:limit]:
+            stop = {"stop_id": row[0]}
+            stored_fields = dict(zip(["last_updated", "name", "latitude", "longitude"], row[1:5]))
+            for param in params:
+                stop[param] = stored_fields[param]
+            stop["_links"] = {
+                "self": {
+                    "href": row[5]
+                },
+                "next": {
+                    "href": row[7]
+                },
+                "prev": {
+                    "href": row[6]
+                }
+            }
+            stops.append(stop)
+
+        # link to the page after this one, keeping the same limit and include
+        next_page = None
+        if (len(rows) > limit):
+            next_page = f"http://localhost:5000/stops?{urlencode({'after': stops[-1]['stop_id'], 'limit': limit, **({'include': q} if q else {})})}"
+
+        return {
+            "stops": stops,
+            "count": len(stops),
+            "_links": {
+                "next": {
+                    "href": next_page
+                }
+            }
+        }, 200, {"ETag": f'"{etag}"'}
+
+    @ns.doc(responses={
         200: 'Success',
         201: 'Created',
         400: 'Bad Request',
@@ -143,174 +1541,643 @@ class QueryStops(Resource):
         503: 'Service Unavailable',
     },
     description='Get all stops matching the query.')
-    @api.expect(q1_parser)
+    @ns.expect(q1_parser)
     def put(self):
         args = q1_parser.parse_args()
-        q = args.get('query') 
-        # this should return a 400 error if somehow query is mispelt
-        if (not q):
-            return {
-                "Error Code": 404,
-                "Message": "Bad Request" 
-            }, 400
-        res = requests.get(f"http://v6.db.transport.rest/locations?poi=false&addresses=false&query={q}&results=5")
+        return run_flow(put_stops_flow(args.get('query'), args.get('local_first')))
+
 
-        # response codes 400 and 503
-        if (res.status_code == 400):
+def put_stops_flow(q, local_first):
+    # PUT /stops once its args are parsed, as a flow
+    # this should return a 400 error if somehow query is mispelt
+    if (not q):
+        return {
+            "Error Code": 404,
+            "Message": "Bad Request"
+        }, 400
+    if (local_first):
+        local = yield in_db(local_queried_stops, q)
+        if (local is not None):
+            return local
+    status_code, sorted_list = yield from query_upstream_stops_flow(q)
+    return (yield in_db(save_queried_stops, status_code, sorted_list))
+
+
+def local_queried_stops(q):
+    """
+    Answer a PUT /stops query from the stored stops, the way PUT /stops would after asking upstream.
+
+    Only if the name search finds stops for it and all of them are fresh (refreshed from upstream in
+    the last LOCAL_FIRST_MAX_AGE seconds), otherwise returns None and upstream has to be asked.
+    Upstream may know of matching stops that were never stored, that's the trade for not asking it.
+    """
+    stops = search_stops(q, limit=5, fuzzy=False)
+    if (not stops):
+        return None
+    for stop in stops:
+        try:
+            age = datetime.now() - datetime.strptime(stop['last_updated'], "%Y-%m-%d-%H:%M:%S")
+        except (TypeError, ValueError):
+            return None
+        if (age.total_seconds() > LOCAL_FIRST_MAX_AGE):
+            return None
+
+    stops.sort(key=lambda stop: stop['stop_id'])
+    return [{
+        "stop_id": stop['stop_id'],
+        "last_updated": stop['last_updated'],
+        "_links": stop['_links'],
+    } for stop in stops], 200
+
+
+def save_queried_stops(status_code, sorted_list):
+    """
+    The rest of PUT /stops once upstream has been asked for the stops matching the query: store them
+    and make the response.
+    """
+    # response codes 400 and 503, a query upstream couldn't answer mustn't look like one that found nothing
+    if (status_code != 200):
+        if (upstream_answered(status_code)):
             return 'Bad Request', 400
-        elif (res.status_code == 503):
-            return 'Service unavailable', 503
-        
-        l = res.json()
-        # remove all the items that are not stops (removes stations)
-        for index, ret in enumerate(l):
-            if (ret['type'] != 'stop'):
-                l.pop(index)
-
-        # Empty so 404 (nothing found by querying)
-        if (len(l) == 0):
-            return 'Not found', 404
-
-        # put the data in the format that is defined by spec
-        formatted_list = []
-        if (len(l) > 0):
-            for item in l:
-                thisItem = {
-                    "stop_id": item['id'],
-                    "name": item['name'],
-                    "latitude": item['location']['latitude'],
-                    "longitude": item['location']['longitude'],
-                    "last_updated": datetime.now().strftime("%Y-%m-%d-%H:%M:%S"),
-                    "_links": {
-                        "self": {
-                            "href": f"http://localhost:5000/stops/{item['id']}",
-                        },
-                    },
-                }
-                formatted_list.append(thisItem)
-        
-        
-        # sort list by stop_id
-        sorted_list = sorted(formatted_list, key=lambda x: x['stop_id'])
-
-        # boolean to keep track if a new value is to be added into the db (helpful for response code)
-        new_value_added = False
-
-        # iterate through returned array of stops
-        for stop in sorted_list:
-            # check if the stop already exists in the db
-            check_if_stop_exists = cursor.execute(f"SELECT stop_id from stops WHERE stop_id='{stop['stop_id']}'")
-            check_if_stop_exists = check_if_stop_exists.fetchone()
-            # if it does not exist in the database, then add it
-            if (check_if_stop_exists is None):
-                print(f"This {stop['stop_id']} does not exist in the db, so we\'ll add it in")
-                cursor.execute(f"""INSERT INTO stops(stop_id, name, latitude, longitude, last_updated, self_link)
-                               VALUES ('{stop['stop_id']}', '{stop['name']}', '{stop['latitude']}', '{stop['longitude']}', '{stop['last_updated']}', '{stop['_links']['self']['href']}')""")
-                # set boolean to True cause a new value is added
-                new_value_added = True
-                
-                conn.commit()
+        return upstream_unavailable()
+
+    # Empty so 404 (nothing found by querying)
+    if (len(sorted_list) == 0):
+        return 'Not found', 404
+
+    # write the whole batch in one go, the stops that were new decide the response code
+    inserted_stop_ids = upsert_stops(sorted_list)
+    for stop_id in inserted_stop_ids:
+        print(f"This {stop_id} did not exist in the db, so we added it in")
+
+    # remove unnecessary fields for spec (latitude, longitude, name) from the response
+    # even though these fields aren't need for q1, helpful to store them in db
+    response_list = []
+    for bahn in sorted_list:
+        response_list.append({
+            "stop_id": bahn['stop_id'],
+            "last_updated": bahn['last_updated'],
+            "_links": bahn['_links'],
+        })
+
+    # Response code when a new value is added to the database is 201 Created
+    if (inserted_stop_ids):
+        return response_list, 201
+    else:
+        return response_list, 200
+
+
+def parse_stop_records(records):
+    """
+    Turn stop records from an import into stops, raising ValueError with a message if one is malformed.
+
+    Each record needs a stop_id, name, latitude and longitude.
+    """
+    stops = []
+    for index, record in enumerate(records):
+        try:
+            stops.append(make_stop(int(record['stop_id']), str(record['name']),
+                                   float(record['latitude']), float(record['longitude'])))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Record {index} needs an integer stop_id, a name, and a numeric latitude and longitude")
+    return stops
+
+
+@ns.route('/stops/import')
+class ImportStops(Resource):
+    @ns.doc(responses={
+        200: 'Success',
+        201: 'Created',
+        400: 'Bad Request',
+    },
+    description='Import many stops at once, from a JSON body with a list of "queries" to look up and/or a list of '
+                '"stops" records, or from an uploaded "file" of stop records as JSON or CSV '
+                '(stop_id, name, latitude, longitude).')
+    def post(self):
+        queries = []
+        records = []
+        if ('file' in request.files):
+            # a file of stop records, either CSV with a header row or a JSON list
+            upload = request.files['file']
+            content = upload.read().decode('utf-8')
+            if (upload.filename.lower().endswith('.csv')):
+                records = list(csv.DictReader(io.StringIO(content)))
             else:
-                # The Stop exists in our database, so we update the last_updated time
-                cursor.execute(f"""UPDATE stops SET last_updated='{datetime.now().strftime("%y-%m-%d-%H:%M:%S")}' WHERE stop_id='{stop['stop_id']}'""")
-                conn.commit()
+                try:
+                    records = json.loads(content)
+                except ValueError:
+                    return {
+                        "Error": 400,
+                        "Message": "Bad request, the uploaded file is not valid JSON or CSV"
+                    }, 400
+        else:
+            payload = request.get_json(silent=True)
+            if (isinstance(payload, list)):
+                records = payload
+            elif (isinstance(payload, dict)):
+                queries = payload.get('queries') or []
+                records = payload.get('stops') or []
+            else:
+                return {
+                    "Error": 400,
+                    "Message": "Bad request, expected a JSON body with 'queries' and/or 'stops', or a file upload"
+                }, 400
 
-        # remove unnecessary fields for spec (latitude, longitude, name)
-        # even though these fields aren't need for q1, helpful to store them in db
-        for bahn in sorted_list:
-            del bahn['latitude']
-            del bahn['longitude']
-            del bahn['name']
-
-        # update links of all the rows
-        current_rows = []
-        # Get all the table records of stops ordered by stop_id
-        cursor.execute("SELECT * FROM stops ORDER BY stop_id")
-        rows = cursor.fetchall()
-        # convert the tuples that fetchall returns into dictionaries
-        for row in rows:
-            convert_row_to_dict = {
-                "stop_id": row[0], # the first item should be a stop_id
-                "name": row[1], # second item should be name of the stop
-                "latitude": row[2], # third item should be latitude
-                "longitude": row[3], # 4th item should be longitude
-                "last_updated": row[4], # 5th item should be last_updated
-                "self_link": row[5], # self link
-                "prev_link": row[6], # prev link
-                "next_link": row[7], # next link
-            }
-            current_rows.append(convert_row_to_dict)
-
-        # iterate through the list of dictionaries
-        # set prev_link to the row index before it
-        # set the next_link to the row index after it
-        # for the last dictionary set next_link to Null
-        # for the first dictioanry set prev_link to Null
-        for index, element in enumerate(current_rows):
-            # for first item in the list, set the prev_link to Null
-            if (index == 0 and len(current_rows) > 1):
-                element['prev_link'] = None
-                element['next_link'] = f"{current_rows[index+1]['self_link']}"
-            elif (index + 1 < len(current_rows)):
-                element['prev_link'] = f"{current_rows[index-1]['self_link']}"
-                element['next_link'] = f"{current_rows[index+1]['self_link']}"
-            elif (index == len(current_rows) - 1):
-                element['prev_link'] = f"{current_rows[index-1]['self_link']}"
-                element['next_link'] = None
-
-
-            # update it in the db
-            cursor.execute(f"""UPDATE stops SET next_link='{element['next_link']}' where stop_id='{element['stop_id']}'""")
-            cursor.execute(f"""UPDATE stops SET prev_link='{element['prev_link']}' where stop_id='{element['stop_id']}'""")
-            conn.commit()
-                
-        
+        if (not isinstance(queries, list) or not isinstance(records, list) or (not queries and not records)):
+            return {
+                "Error": 400,
+                "Message": "Bad request, nothing to import"
+            }, 400
+
+        for index, q in enumerate(queries):
+            if (not isinstance(q, str) or not q.strip()):
+                return {
+                    "Error": 400,
+                    "Message": f"Bad request, query {index} needs to be a non-empty string"
+                }, 400
+
+        try:
+            stops = parse_stop_records(records)
+        except ValueError as e:
+            return {
+                "Error": 400,
+                "Message": f"Bad request, {e}"
+            }, 400
+
+        # look up every query upstream and add its stops to the batch
+        query_results = []
+        for q in queries:
+            status_code, found = query_upstream_stops(q, priority="bulk")
+            query_results.append({
+                "query": q,
+                "status": status_code if (status_code != 200 or found) else 404,
+                "stops": len(found),
+            })
+            stops.extend(found)
+
+        # the whole import is written in one transaction
+        inserted_stop_ids = upsert_stops(stops) if stops else []
+
+        ret = {
+            "imported": len({stop['stop_id'] for stop in stops}),
+            "created": len(inserted_stop_ids),
+            "queries": query_results,
+        }
         # Response code when a new value is added to the database is 201 Created
-        if (new_value_added == True):
-            return sorted_list, 201
+        if (inserted_stop_ids):
+            return ret, 201
         else:
-            return sorted_list, 200
-        
+            return ret, 200
+
 
 # add include arg to q2_parser
 q2_parser = reqparse.RequestParser()
 q2_parser.add_argument('include', type=str, required=False)
 
+# the columns of a stop that the replica keeps, in StopRecord's order
+STOP_RECORD_COLUMNS = "stop_id, last_updated, name, latitude, longitude, self_link, prev_link, next_link"
+
+
+class StopRecord:
+    # one stop as the replica keeps it, __slots__ so there's no per record __dict__
+    __slots__ = ("stop_id", "last_updated", "name", "latitude", "longitude", "self_link", "prev_link", "next_link")
+
+    def __init__(self, stop_id, last_updated, name, latitude, longitude, self_link, prev_link, next_link):
+        self.stop_id = stop_id
+        self.last_updated = last_updated
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.self_link = self_link
+        self.prev_link = prev_link
+        self.next_link = next_link
+
+    def formatted(self):
+        # the stop the way read_stop_for_response formats it, without the next departure
+        return {
+            "stop_id": self.stop_id,
+            "last_updated": self.last_updated,
+            "name": self.name,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "next_departure": None,
+            "self_link": self.self_link,
+            "prev_link": self.prev_link,
+            "next_link": self.next_link,
+        }
+
+
+class StopsReplica:
+    """
+    A read-through copy of the stops table in memory, so reading a stop doesn't need a query.
+
+    A stop is read from the db the first time it is asked for (or every stop at once by load()),
+    and kept as a StopRecord by stop_id. Every write to stops in this process calls changed()
+    afterwards with the stop_ids it wrote, which drops just those records. Writes from other
+    processes are noticed by checking the stops version in table_versions, at most every
+    check_interval seconds, and drop every record. Departures aren't kept here, they are read
+    from the departures table as of when they're asked for.
+
+    A read that started before a write mustn't keep what it read, so the replica counts writes and
+    remembers the count each stop was last written at, and a full drop bumps the generation.
+    """
+
+    def __init__(self, enabled=False, check_interval=1.0):
+        self.enabled = enabled
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.records = {}
+        self.generation = 0
+        self.writes = 0
+        # the number of writes there had been when each stop was last written, since the generation began
+        self.written_at = {}
+        self.version = None
+        self.checked_at = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, stop_id):
+        """
+        The StopRecord for stop_id, or None if there is no such stop.
+        """
+        self.check_version()
+        with self.lock:
+            record = self.records.get(stop_id)
+            if (record is not None):
+                self.hits += 1
+                return record
+            self.misses += 1
+            generation, writes = self.generation, self.writes
+
+        # stops that don't exist aren't remembered, so asking for made up stop_ids can't fill the memory
+        row = db.connection().execute(f"SELECT {STOP_RECORD_COLUMNS} FROM stops WHERE stop_id = ?", (stop_id,)).fetchone()
+        if (row is None):
+            return None
+        record = StopRecord(*row)
+        with self.lock:
+            # the stop may have been written since the row was read, then it is already out of date
+            if (self.unchanged_since(stop_id, generation, writes)):
+                self.records[stop_id] = record
+        return record
+
+    def get_many(self, stop_ids):
+        """
+        The StopRecord of each of stop_ids that exists, by stop_id, with one query for those that aren't kept yet.
+        """
+        self.check_version()
+        found = {}
+        missing = []
+        with self.lock:
+            for stop_id in stop_ids:
+                record = self.records.get(stop_id)
+                if (record is not None):
+                    found[stop_id] = record
+                else:
+                    missing.append(stop_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+            generation, writes = self.generation, self.writes
+
+        if (missing):
+            loaded = {row[0]: StopRecord(*row) for row in select_in(
+                db.connection(), f"SELECT {STOP_RECORD_COLUMNS} FROM stops WHERE stop_id IN ({{placeholders}})", missing)}
+            with self.lock:
+                # as in get(), rows read before their stop was written mustn't be kept
+                for stop_id, record in loaded.items():
+                    if (self.unchanged_since(stop_id, generation, writes)):
+                        self.records[stop_id] = record
+            found.update(loaded)
+        return found
+
+    def unchanged_since(self, stop_id, generation, writes):
+        # whether nothing has dropped stop_id's record since the generation and write count a read started at
+        return generation == self.generation and self.written_at.get(stop_id, 0) <= writes
+
+    def load(self):
+        # read every stop in one go, rather than one at a time as they are asked for
+        self.check_version()
+        with self.lock:
+            generation, writes = self.generation, self.writes
+        with db.snapshot() as conn:
+            version = stops_version(conn)
+            records = {row[0]: StopRecord(*row) for row in conn.execute(f"SELECT {STOP_RECORD_COLUMNS} FROM stops")}
+        with self.lock:
+            # the records are of this version, so the next version check mustn't drop them
+            if (generation == self.generation and writes == self.writes and version == self.version):
+                self.records = records
+        return len(records)
+
+    def check_version(self):
+        now = time.monotonic()
+        if (now - self.checked_at < self.check_interval):
+            return
+        version = stops_version(db.connection())
+        with self.lock:
+            self.checked_at = now
+            if (version != self.version):
+                self.version = version
+                self.drop_all()
+
+    def drop_all(self):
+        # with the lock held
+        self.generation += 1
+        self.records = {}
+        self.written_at = {}
+
+    def changed(self, stop_ids, version_before, version_after):
+        """
+        Call after a write to stops has been committed, with the stop_ids whose rows it changed (including
+        any whose links it moved) and the stops version at the start and the end of its transaction.
+        """
+        with self.lock:
+            self.writes += 1
+            for stop_id in stop_ids:
+                self.records.pop(stop_id, None)
+                self.written_at[stop_id] = self.writes
+            if (version_before == self.version):
+                # no other process has written since the version was last checked, so the records kept
+                # are all of the version this write left behind
+                self.version = version_after
+            else:
+                # look at the version again on the next read, which drops everything
+                self.checked_at = 0
+
+    def footprint(self, sample=1000):
+        """
+        Roughly how much memory the records take: the dict plus each record and the values only it
+        holds, worked out from the first `sample` records and scaled up.
+        """
+        with self.lock:
+            records = self.records
+            sampled = list(itertools.islice(records.values(), sample))
+            hits, misses = self.hits, self.misses
+        per_record = 0
+        if (sampled):
+            for record in sampled:
+                # None is shared, everything else (even the stop_id, which is also the key) is the record's own
+                values = [getattr(record, name) for name in StopRecord.__slots__]
+                per_record += sys.getsizeof(record) + sum(sys.getsizeof(value) for value in values if value is not None)
+            per_record /= len(sampled)
+        total = sys.getsizeof(records) + len(records) * per_record
+        return {
+            "records": len(records),
+            "bytes": int(total),
+            "bytes_per_record": int(per_record),
+            "hits": hits,
+            "misses": misses,
+        }
+
+
+# keep a copy of the stops in memory for GET /stops/<stop_id> and batches, off unless STOPS_REPLICA is set
+stops_replica = StopsReplica(
+    enabled=os.environ.get("STOPS_REPLICA", "0").lower() in ("1", "true", "yes"),
+    check_interval=float(os.environ.get("STOPS_REPLICA_CHECK_INTERVAL", "1")),
+)
+
+
+def read_next_departure(stop_id):
+    # the first stored departure from the stop with a platform and direction that hasn't left yet
+    row = db.connection().execute("""SELECT platform, direction, MIN(departs_at) FROM departures
+                                     WHERE stop_id = ? AND departs_at >= ? AND platform IS NOT NULL AND direction IS NOT NULL""",
+                                  (stop_id, time.time())).fetchone()
+    return f"Platform {row[0]} towards {row[1]}" if row[2] is not None else None
+
+
+def read_next_departures(stop_ids):
+    # read_next_departure for many stops at once, by stop_id for those that have one
+    return {stop_id: f"Platform {platform} towards {direction}" for stop_id, platform, direction, departs_at in select_in(
+        db.connection(), """SELECT stop_id, platform, direction, MIN(departs_at) FROM departures
+                            WHERE stop_id IN ({placeholders}) AND departs_at >= ? AND platform IS NOT NULL AND direction IS NOT NULL
+                            GROUP BY stop_id""", stop_ids, (time.time(),))}
+
+
+# the fields of a stop that can be asked for with the include param
+INCLUDE_FIELDS = ["name", "last_updated", "latitude", "longitude", "next_departure"]
+
+
+def parse_include(q):
+    """
+    Split an include param by comma into the fields it asks for.
+
+    Returns the list of fields and None, or None and an error message if a field isn't allowed.
+    """
+    params = q.split(',')
+
+    # check for _links and _stop_id in query params, if they exist return error
+    if ("_links" in params or "stop_id" in params):
+        return None, "Bad request, '_links' and 'stop_id' not permitted parameters"
+
+    # go through params to check if given a param that is not allowed
+    for p in params:
+        if p not in INCLUDE_FIELDS:
+            return None, f"Bad request, {p} not permitted parameter"
+
+    return params, None
+
 # add selected method to update the field(s) of a stop
 q5_parser = reqparse.RequestParser()
-# the updatable fields are 'name', 'last_updated', 'latitude', 'longitude', 'next_departure'
+# the updatable fields are 'name', 'last_updated', 'latitude', 'longitude'
 q5_parser.add_argument('name', type=str, location='form')
 q5_parser.add_argument('last_updated', type=str, location='form')
 q5_parser.add_argument('latitude', type=str, location='form')
 q5_parser.add_argument('longitude', type=str, location='form')
-q5_parser.add_argument('next_departure', type=str, location='form')
 
-my_fields = api.model('MyModel', {
+my_fields = ns.model('MyModel', {
     'name': fields.String
 })
 
-@api.route('/stops/<int:stop_id>')
-class Stop(Resource):
-    @api.doc(responses={
+# parser for finding stops near a location
+nearby_parser = reqparse.RequestParser()
+nearby_parser.add_argument('lat', type=float, required=True)
+nearby_parser.add_argument('lon', type=float, required=True)
+nearby_parser.add_argument('radius', type=inputs.positive, required=False, help='Search radius in metres')
+nearby_parser.add_argument('k', type=inputs.int_range(1, 100), required=False, help='How many stops to return')
+
+
+@ns.route('/stops/nearby')
+class NearbyStops(Resource):
+    @ns.doc(responses={
         200: 'Success',
         400: 'Bad Request',
-        404: 'Not Found',
-        503: 'Service Unavailable',
     },
-    description="Get info about a singular stop in the database")
-    @api.expect(q2_parser)
-    def get(self, stop_id):
-        # check if the given stop_id is contained within the database
-        check_if_stop_exists = cursor.execute(f"SELECT stop_id, last_updated, name, latitude, longitude, self_link, prev_link, next_link FROM stops WHERE stop_id='{stop_id}'")
-        check_if_stop_exists = check_if_stop_exists.fetchall()
-        # the stop does not exist in the database, so 404 error
-        if (not check_if_stop_exists):
+    description='Find the stored stops nearest to a location: the k nearest (10 by default), '
+                'or those within radius metres of it.')
+    @ns.expect(nearby_parser)
+    def get(self):
+        args = nearby_parser.parse_args()
+        if (not (-90 <= args['lat'] <= 90 and -180 <= args['lon'] <= 180)):
             return {
-                "Error Code": 404,
-                "Message": f"The stop id of {stop_id} does not exist in the database"
-            }, 404
-        
-        # The stop exists so format the data into a dictionary
+                "Error": 400,
+                "Message": "Bad request, lat must be between -90 and 90 and lon between -180 and 180"
+            }, 400
+        k = args.get('k') or (None if args.get('radius') else 10)
+
+        stops = []
+        for stop in find_nearby("stops", args['lat'], args['lon'], radius=args.get('radius'), k=k):
+            stops.append({
+                "stop_id": stop['stop_id'],
+                "name": stop['name'],
+                "latitude": stop['latitude'],
+                "longitude": stop['longitude'],
+                "distance": round(stop['distance'], 1),
+                "_links": {
+                    "self": {
+                        "href": stop['self_link']
+                    }
+                }
+            })
+
+        return {
+            "stops": stops,
+            "count": len(stops),
+        }, 200
+
+
+# a fuzzy match has to share at least this share of the query's trigrams
+SEARCH_MIN_SIMILARITY = 0.3
+
+# how many stops a search returns unless asked for fewer, and at most
+SEARCH_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+
+
+def trigrams(text):
+    # the three character pieces of each word, the same way the trigram index splits names
+    words = re.findall(r"\w+", text.lower())
+    return {word[i:i + 3] for word in words for i in range(len(word) - 2)}
+
+
+def search_stops(q, limit=SEARCH_LIMIT, fuzzy=True):
+    """
+    Find stored stops by name, for autocomplete.
+
+    Names that start with the query come first, in name order, then names where every word of the
+    query starts one of their words (so "berl hb" finds "Berlin Hbf"). Neither has to rank every
+    match, so both stay fast when a word is in thousands of names. Only if nothing matches like that
+    and fuzzy is set are names that share enough trigrams with the query looked for, to get past typos.
+
+    Returns a list of stop dicts, each with the kind of "match" that found it.
+    """
+    words = re.findall(r"\w+", q)
+    if (not words):
+        return []
+
+    conn = db.connection()
+    # the NOCASE index on name turns the LIKE into a range scan, so % and _ in the query are escaped
+    pattern = re.sub(r"([\\%_])", r"\\\1", q) + "%"
+    rows = conn.execute("""SELECT stop_id, name, latitude, longitude, self_link, last_updated FROM stops
+                           WHERE name LIKE ? ESCAPE '\\' ORDER BY name COLLATE NOCASE LIMIT ?""",
+                        (pattern, limit)).fetchall()
+    found = [(row, "prefix") for row in rows]
+
+    if (len(found) < limit):
+        # quoted so that words like AND or NOT aren't taken as operators, * makes each one a prefix
+        seen = {row[0] for row in rows}
+        rows = conn.execute("""SELECT s.stop_id, s.name, s.latitude, s.longitude, s.self_link, s.last_updated
+                               FROM (SELECT rowid FROM stops_search WHERE stops_search MATCH ? LIMIT ?) m
+                               JOIN stops s ON s.stop_id = m.rowid""",
+                            (" ".join(f'"{word}"*' for word in words), limit + len(seen))).fetchall()
+        found += [(row, "words") for row in rows if row[0] not in seen][:limit - len(found)]
+
+    query_trigrams = trigrams(q)
+    if (fuzzy and not found and query_trigrams):
+        # any stop sharing a trigram is a candidate, bm25 puts the ones sharing the rarest first
+        candidates = conn.execute("""SELECT s.stop_id, s.name, s.latitude, s.longitude, s.self_link, s.last_updated
+                                     FROM (SELECT rowid, rank FROM stops_trigrams WHERE stops_trigrams MATCH ?
+                                           ORDER BY rank LIMIT ?) m
+                                     JOIN stops s ON s.stop_id = m.rowid""",
+                                  (" OR ".join(f'"{trigram}"' for trigram in query_trigrams), limit * 4)).fetchall()
+        scored = []
+        for row in candidates:
+            similarity = len(query_trigrams & trigrams(row[1] or "")) / len(query_trigrams)
+            if (similarity >= SEARCH_MIN_SIMILARITY):
+                scored.append((similarity, row))
+        scored.sort(key=lambda item: -item[0])
+        found = [(row, "fuzzy") for _, row in scored[:limit]]
+
+    return [{
+        "stop_id": row[0],
+        "name": row[1],
+        "latitude": row[2],
+        "longitude": row[3],
+        "last_updated": row[5],
+        "match": match,
+        "_links": {
+            "self": {
+                "href": row[4]
+            }
+        }
+    } for row, match in found]
+
+
+# parser for searching stops by name
+search_parser = reqparse.RequestParser()
+search_parser.add_argument('q', type=str, required=True, help='The name, or the start of the name, of the stop')
+search_parser.add_argument('limit', type=inputs.int_range(1, SEARCH_MAX_LIMIT), required=False)
+search_parser.add_argument('fuzzy', type=inputs.boolean, required=False, help='Also find names that are spelt a bit differently (default true)')
+
+
+@ns.route('/stops/search')
+class SearchStops(Resource):
+    @ns.doc(responses={
+        200: 'Success',
+        304: 'Not Modified',
+        400: 'Bad Request',
+    },
+    description='Search the stored stops by name, for autocomplete. Each word of q matches the start of a word '
+                'in the name, and unless fuzzy is false, names with small spelling differences are found too.')
+    @ns.expect(search_parser)
+    def get(self):
+        args = search_parser.parse_args()
+        q = args['q'].strip()
+        if (not re.search(r"\w", q)):
+            return {
+                "Error": 400,
+                "Message": "Bad request, q needs at least one letter or number in it"
+            }, 400
+        limit = args.get('limit') or SEARCH_LIMIT
+        fuzzy = args.get('fuzzy') is not False
+
+        # the results can only change when the stops do, like the stops listing
+        version = stops_version(db.connection())
+        etag = hashlib.sha256(json.dumps([version, q, limit, fuzzy]).encode("utf-8")).hexdigest()[:32]
+        if (request.if_none_match.contains(etag)):
+            return None, 304, {"ETag": f'"{etag}"'}
+
+        stops = search_stops(q, limit, fuzzy)
+        return {
+            "query": q,
+            "stops": stops,
+            "count": len(stops),
+        }, 200, {"ETag": f'"{etag}"'}
+
+
+def read_stop_for_response(stop_id, q):
+    """
+    The part of GET /stops/<stop_id> that only needs the db, finding the stop and checking the include param.
+
+    Returns an error response and None, or None and (formatted_stop, params) where params is None if the
+    whole stop was asked for. The next departure is needed if params is None or includes it, and then
+    finish_stop_response needs the status code of ensure_departures_flow(stop_id, 120).
+    """
+    # check if the given stop_id is contained within the database (or the replica of it)
+    if (stops_replica.enabled):
+        record = stops_replica.get(stop_id)
+        check_if_stop_exists = [record] if record else []
+    else:
+        check_if_stop_exists = db.connection().execute("SELECT stop_id, last_updated, name, latitude, longitude, self_link, prev_link, next_link FROM stops WHERE stop_id = ?", (stop_id,))
+        check_if_stop_exists = check_if_stop_exists.fetchall()
+    # the stop does not exist in the database, so 404 error
+    if (not check_if_stop_exists):
+        return ({
+            "Error Code": 404,
+            "Message": f"The stop id of {stop_id} does not exist in the database"
+        }, 404), None
+
+    # The stop exists so format the data into a dictionary
+    if (stops_replica.enabled):
+        formatted_stop = check_if_stop_exists[0].formatted()
+    else:
         formatted_stop = {
             "stop_id": check_if_stop_exists[0][0],
             "last_updated": check_if_stop_exists[0][1],
@@ -323,225 +2190,287 @@ class Stop(Resource):
             "next_link": check_if_stop_exists[0][7],
         }
 
-        # if the include param is used
-        args = q2_parser.parse_args()
-        q = args.get('include')
-        # 'include param used
-        if (q):
-            # split the include params by comma to get all params
-            params = q.split(',')
-            
-            # check for _links and _stop_id in query params, if they exist return error
-            if ("_links" in params or "stop_id" in params):
-                return {
-                    "Error": 400,
-                    "Message": "Bad request, '_links' and 'stop_id' not permitted parameters"
-                }
-            
-            # go through params to check if given a param that is not allowed
-            allowed_params = ["name", "last_updated", "latitude", "longitude", "next_departure"]
-            for p in params:
-                if p not in allowed_params:
-                    return {
-                    "Error": 400,
-                    "Message": f"Bad request, {p} not permitted parameter"
-                }
-            
-            # make basic return dictionary for every include
-            param_formatted_stop = {
-                "stop_id": formatted_stop['stop_id'],
-                "_links": {
-                    "self": {
-                        "href": formatted_stop['self_link']
-                    },
-                    "next": {
-                        "href": formatted_stop['next_link']
-                    },
-                    "prev": {
-                        "href": formatted_stop['prev_link']
-                }
-                }
-            }
-
-            # if next_departure in params
-            if ("next_departure" in params):
-                res = requests.get(f"https://v6.db.transport.rest/stops/{formatted_stop['stop_id']}/departures?duration=120")
-                # if service unavailable
-                if (res.status_code == 503):
-                    return {
-                        "Error": 503,
-                        "Message": "Service unavailable"
-                    }
-                l = res.json()
-                l = l['departures']
-                if (len(l) == 0):
-                    return {
-                        "Error": 404,
-                        "Message": f"Did not find any departures from {formatted_stop['stop_id']} within 120 mins",
-                    }, 404
-                
-                # iterate through list and find the first one where the platform and direction is not none
-                found = False
-                for i in l:
-                    if (i['platform'] and i['direction']):
-                        param_formatted_stop['next_departure'] = f"Platform {i['platform']} towards {i['direction']}"
-                        found = True
-                        params.remove("next_departure")
-                        break
-                if (found == False):
-                    return {
-                            "Error": 404,
-                            "Message": f"Did not find any departures from {formatted_stop['stop_id']} within 120 mins",
-                        }, 404
+    # 'include param used
+    if (not q):
+        return None, (formatted_stop, None)
 
-            # go through params list and add required fields
-            for param in params:
-                param_formatted_stop[param] = formatted_stop[param]
-                pass
+    # split the include params by comma to get all params, and check they are all allowed
+    params, error = parse_include(q)
+    if (error):
+        return {
+            "Error": 400,
+            "Message": error
+        }, None
+    return None, (formatted_stop, params)
 
-            return param_formatted_stop, 200
-        
-        
 
+def finish_stop_response(formatted_stop, params, status_code):
+    # the rest of GET /stops/<stop_id>, once ensure_departures has been called if the next departure is needed
+    if (params is None or "next_departure" in params):
+        # if service unavailable
+        if (status_code != 200):
+            return {
+                "Error": 503,
+                "Message": "Service unavailable"
+            }, 503
 
-        # get next departure, duration is set to 120 mins max
-        res = requests.get(f"https://v6.db.transport.rest/stops/{formatted_stop['stop_id']}/departures?duration=120")
-        if (res.status_code == 503):
-                    return {
-                        "Error": 503,
-                        "Message": "Service unavailable"
-                    }
-        l = res.json()
-        l = l['departures']
-        if (len(l) == 0):
+        # the next departure with a platform and direction, a batch has already read them all in one go
+        if (formatted_stop['next_departure'] is None):
+            formatted_stop['next_departure'] = read_next_departure(formatted_stop['stop_id'])
+        if (formatted_stop['next_departure'] is None):
             return {
                 "Error": 404,
                 "Message": f"Did not find any departures from {formatted_stop['stop_id']} within 120 mins",
             }, 404
 
-        # iterate through list and find the first one where the platform and direction is not none
-        found = False
-        for i in l:
-            if (i['platform'] and i['direction']):
-                formatted_stop['next_departure'] = f"Platform {i['platform']} towards {i['direction']}"
-                found = True
-                break
-        if (found == False):
-                return {
-                        "Error": 404,
-                        "Message": f"Did not find any departures from {formatted_stop['stop_id']} within 120 mins",
-                    }, 404
-        
+    links = {
+        "self": {
+            "href": formatted_stop['self_link']
+        },
+        "next": {
+            "href": formatted_stop['next_link']
+        },
+        "prev": {
+            "href": formatted_stop['prev_link']
+        }
+    }
 
-       
-        return {
+    # make basic return dictionary for every include, and go through params list and add required fields
+    if (params is not None):
+        param_formatted_stop = {
             "stop_id": formatted_stop['stop_id'],
-            "last_updated": formatted_stop['last_updated'],
-            "name": formatted_stop['name'],
-            "latitude": formatted_stop['latitude'],
-            "longitude": formatted_stop['longitude'],
-            "next_departure": formatted_stop['next_departure'],
-            "_links": {
-                "self": {
-                    "href": formatted_stop['self_link']
-                },
-                "next": {
-                    "href": formatted_stop['next_link']
-                },
-                "prev": {
-                    "href": formatted_stop['prev_link']
-                }
+            "_links": links,
+        }
+        for param in params:
+            param_formatted_stop[param] = formatted_stop[param]
+        return param_formatted_stop, 200
+
+    return {
+        "stop_id": formatted_stop['stop_id'],
+        "last_updated": formatted_stop['last_updated'],
+        "name": formatted_stop['name'],
+        "latitude": formatted_stop['latitude'],
+        "longitude": formatted_stop['longitude'],
+        "next_departure": formatted_stop['next_departure'],
+        "_links": links,
+    }, 200
+
+
+# how many stops one batch can ask for, and how many of their departures are fetched from upstream at once
+BATCH_MAX_STOPS = int(os.environ.get("BATCH_MAX_STOPS", "100"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "8"))
+
+# parser for getting many stops at once
+batch_parser = reqparse.RequestParser()
+batch_parser.add_argument('ids', type=str, required=True, help='Comma separated stop_ids')
+batch_parser.add_argument('include', type=str, required=False)
+
+
+def parse_batch_ids(ids):
+    """
+    Split the ids param of a batch into stop_ids, in the order given and without repeats.
+
+    Returns the stop_ids and None, or None and an error response.
+    """
+    try:
+        stop_ids = list(dict.fromkeys(int(stop_id) for stop_id in (ids or "").split(",") if stop_id.strip()))
+    except ValueError:
+        return None, ({
+            "Error": 400,
+            "Message": "Bad request, ids must be a comma separated list of stop_ids"
+        }, 400)
+    if (not stop_ids or len(stop_ids) > BATCH_MAX_STOPS):
+        return None, ({
+            "Error": 400,
+            "Message": f"Bad request, ask for between 1 and {BATCH_MAX_STOPS} stops"
+        }, 400)
+    return stop_ids, None
+
+
+def read_stops_for_batch(stop_ids, q):
+    """
+    read_stop_for_response for many stops, with one query for all of them.
+
+    Returns an error response and None, or None and (formatted_stops, params) where formatted_stops
+    has the formatted stop for each stop_id that exists, and params is as for read_stop_for_response.
+    """
+    params = None
+    if (q):
+        params, error = parse_include(q)
+        if (error):
+            return ({
+                "Error": 400,
+                "Message": error
+            }, 400), None
+
+    formatted_stops = {}
+    if (stops_replica.enabled):
+        for stop_id, record in stops_replica.get_many(stop_ids).items():
+            formatted_stops[stop_id] = record.formatted()
+        return None, (formatted_stops, params)
+
+    for row in select_in(db.connection(), """SELECT stop_id, last_updated, name, latitude, longitude, self_link, prev_link, next_link
+                                             FROM stops WHERE stop_id IN ({placeholders})""", stop_ids):
+        formatted_stops[row[0]] = {
+            "stop_id": row[0],
+            "last_updated": row[1],
+            "name": row[2],
+            "latitude": row[3],
+            "longitude": row[4],
+            "next_departure": None,
+            "self_link": row[5],
+            "prev_link": row[6],
+            "next_link": row[7],
+        }
+    return None, (formatted_stops, params)
 
-            }
-        }, 200
-    
-    @api.doc(responses={
+
+def ensure_departures_for_stops_flow(stop_ids):
+    """
+    ensure_departures_flow(stop_id, 120) for many stops, up to BATCH_CONCURRENCY of them at once.
+
+    Returns the status code for each stop_id, a stop whose fetch was shed by the upstream budget gets a 503.
+    """
+    flows = {stop_id: unless_busy(ensure_departures_flow(stop_id, 120)) for stop_id in stop_ids}
+    return dict((yield concurrently(flows, BATCH_CONCURRENCY)))
+
+
+def finish_batch_response(stop_ids, formatted_stops, params, status_codes):
+    """
+    The rest of GET /stops/batch once the departures have been fetched, status_codes has the status
+    code of ensure_departures for each stop that needed them.
+
+    Each stop gets the response (body and status) GET /stops/<stop_id> would have given it.
+    """
+    if (params is None or "next_departure" in params):
+        # the refreshed next departures, all in one query
+        for stop_id, next_departure in read_next_departures(formatted_stops).items():
+            formatted_stops[stop_id]['next_departure'] = next_departure
+
+    results = []
+    for stop_id in stop_ids:
+        if (stop_id not in formatted_stops):
+            body, status = {
+                "Error Code": 404,
+                "Message": f"The stop id of {stop_id} does not exist in the database"
+            }, 404
+        else:
+            body, status = finish_stop_response(formatted_stops[stop_id], params, status_codes.get(stop_id, 200))
+        results.append({
+            "stop_id": stop_id,
+            "status": status,
+            "body": body,
+        })
+    return {
+        "results": results,
+        "count": len(results),
+    }, 200
+
+
+@ns.route('/stops/batch')
+class StopsBatch(Resource):
+    @ns.doc(responses={
+        200: 'Success',
+        400: 'Bad Request',
+    },
+    description='Get up to 100 stops at once, the same as getting each one from /stops/<stop_id>. Each stop '
+                'has its own status and body in the results, so one missing stop does not fail the rest.')
+    @ns.expect(batch_parser)
+    def get(self):
+        args = batch_parser.parse_args()
+        return run_flow(stops_batch_flow(args['ids'], args.get('include')))
+
+
+def stops_batch_flow(ids, include):
+    # GET /stops/batch once its args are parsed, as a flow
+    stop_ids, error = parse_batch_ids(ids)
+    if (error):
+        return error
+    error, found = yield in_db(read_stops_for_batch, stop_ids, include)
+    if (error):
+        return error
+    formatted_stops, params = found
+
+    # the departures of every stop that exists, fetched side by side
+    status_codes = {}
+    if (params is None or "next_departure" in params):
+        status_codes = yield from ensure_departures_for_stops_flow(list(formatted_stops))
+    return (yield in_db(finish_batch_response, stop_ids, formatted_stops, params, status_codes))
+
+
+def get_stop_flow(stop_id, include):
+    # GET /stops/<stop_id> once its args are parsed, as a flow
+    error, stop = yield in_db(read_stop_for_response, stop_id, include)
+    if (error):
+        return error
+    formatted_stop, params = stop
+
+    # get next departure, duration is set to 120 mins max
+    status_code = 200
+    if (params is None or "next_departure" in params):
+        status_code = yield from ensure_departures_flow(stop_id, 120)
+    return (yield in_db(finish_stop_response, formatted_stop, params, status_code))
+
+
+@ns.route('/stops/<int:stop_id>')
+class Stop(Resource):
+    @ns.doc(responses={
+        200: 'Success',
+        400: 'Bad Request',
+        404: 'Not Found',
+        503: 'Service Unavailable',
+    },
+    description="Get info about a singular stop in the database")
+    @ns.expect(q2_parser)
+    def get(self, stop_id):
+        args = q2_parser.parse_args()
+        return run_flow(get_stop_flow(stop_id, args.get('include')))
+
+    @ns.doc(responses={
         200: 'Success',
         400: 'Bad Request',
         404: 'Not Found',
     },
     description='Delete a given stop.')
     def delete(self, stop_id):
-        # query database for the given stop_id
-        # check if the given stop_id is contained within the database
-        check_if_stop_exists = cursor.execute(f"SELECT stop_id FROM stops WHERE stop_id='{stop_id}'")
-        check_if_stop_exists = check_if_stop_exists.fetchone()
+        # the delete and the link updates are committed together
+        with db.write() as cursor:
+            version_before = stops_version(cursor)
+            # delete the stop, if nothing was deleted then the stop_id was not in the database
+            cursor.execute("DELETE FROM stops WHERE stop_id = ?", (stop_id,))
+            stop_was_deleted = cursor.rowcount > 0
+
+            # the stops either side of the deleted one now point at each other
+            relinked_stop_ids = set()
+            if (stop_was_deleted):
+                relinked_stop_ids = update_neighbour_links(cursor, [stop_id])
+            version_after = stops_version(cursor)
+        stops_replica.changed(relinked_stop_ids | {stop_id}, version_before, version_after)
+
         # the stop does not exist in the database, so 404 error
-        if (not check_if_stop_exists):
+        if (not stop_was_deleted):
             return {
                 "message": f"The stop_id {stop_id} was not found in the database.",
                 "stop_id": f"{stop_id}",
             }, 404
-        # the stop exists in the database, so delete it
-        cursor.execute(f"""DELETE FROM stops WHERE stop_id='{stop_id}'""")
-        conn.commit()
-
-        
-        # update links of all the rows
-        current_rows = []
-        # Get all the table records of stops ordered by stop_id
-        cursor.execute("SELECT * FROM stops ORDER BY stop_id")
-        rows = cursor.fetchall()
-        # convert the tuples that fetchall returns into dictionaries
-        for row in rows:
-            convert_row_to_dict = {
-                "stop_id": row[0], # the first item should be a stop_id
-                "name": row[1], # second item should be name of the stop
-                "latitude": row[2], # third item should be latitude
-                "longitude": row[3], # 4th item should be longitude
-                "last_updated": row[4], # 5th item should be last_updated
-                "self_link": row[5], # self link
-                "prev_link": row[6], # prev link
-                "next_link": row[7], # next link
-            }
-            current_rows.append(convert_row_to_dict)
-
-        # iterate through the list of dictionaries
-        # set prev_link to the row index before it
-        # set the next_link to the row index after it
-        # for the last dictionary set next_link to Null
-        # for the first dictioanry set prev_link to Null
-        for index, element in enumerate(current_rows):
-            # for first item in the list, set the prev_link to Null
-            if (index == 0 and len(current_rows) > 1):
-                element['prev_link'] = None
-                element['next_link'] = f"{current_rows[index+1]['self_link']}"
-            elif (index == 0 and len(current_rows) == 1):
-                # there is only stop in the db
-                element['prev_link'] = None
-                element['next_link'] = None
-            elif (index + 1 < len(current_rows)):
-                element['prev_link'] = f"{current_rows[index-1]['self_link']}"
-                element['next_link'] = f"{current_rows[index+1]['self_link']}"
-            elif (index == len(current_rows) - 1):
-                element['prev_link'] = f"{current_rows[index-1]['self_link']}"
-                element['next_link'] = None
-
-
-            # update it in the db
-            cursor.execute(f"""UPDATE stops SET next_link='{element['next_link']}' where stop_id='{element['stop_id']}'""")
-            cursor.execute(f"""UPDATE stops SET prev_link='{element['prev_link']}' where stop_id='{element['stop_id']}'""")
-            conn.commit()
 
         return {
             "message": f"The stop_id {stop_id} was removed from the database",
             "stop_id": f"{stop_id}",
         }, 200
-    
 
-   
-    @api.doc(responses={
+    @ns.doc(responses={
         200: 'Success',
         400: 'Bad Request',
         404: 'Not Found',
     },
     description='Updating a given stop.',
-    body=api.model('Put Request Body', {
+    body=ns.model('Put Request Body', {
     }))
     def put(self, stop_id):
         # query database for the given stop_id
         # check if the given stop_id is contained within the database
-        check_if_stop_exists = cursor.execute(f"SELECT stop_id FROM stops WHERE stop_id='{stop_id}'")
+        check_if_stop_exists = db.connection().execute("SELECT stop_id FROM stops WHERE stop_id = ?", (stop_id,))
         check_if_stop_exists = check_if_stop_exists.fetchone()
         # the stop does not exist in the database, so 404 error
         if (not check_if_stop_exists):
@@ -549,20 +2478,27 @@ class Stop(Resource):
                 "message": f"The stop_id {stop_id} was not found in the database.",
                 "stop_id": f"{stop_id}",
             }, 404
-        
+
         # get the fields requested for updating
         payload = request.get_json()
         # list of allowable fields to be updated
-        allowable_fields = ["name", "last_updated", "latitude", "longitude", "next_departure"]
+        allowable_fields = ["name", "last_updated", "latitude", "longitude"]
         params =  {}
         for arg in payload:
+            # the next departure is worked out from db.transport's departures whenever it's read, it can't be set
+            if (arg == "next_departure"):
+                return {
+                    "Error": 400,
+                    "Message": "Bad request, next_departure comes from db.transport and can't be updated"
+                }, 400
+
             # check if the params are actually allowable fields to be updated
             if (arg not in allowable_fields):
                 return {
                     "Error": 400,
                     "Message": f"{arg} is not a permissable field to be updated"
                 }
-            
+
             # check for last_updated field
             if (arg == "last_updated" and payload[arg] == ""):
                 # if given empty string add it to params
@@ -579,7 +2515,7 @@ class Stop(Resource):
                     res = False
                 # given correct format so add it to params dictionary to be updated
                 if (res):
-                    params[arg] = payload[arg] 
+                    params[arg] = payload[arg]
                 else:
                 # given incorrect format, so return 400 bad request
                     return {
@@ -590,7 +2526,7 @@ class Stop(Resource):
             # get rid of param values that are empty strings
             if (payload[arg] != ""):
                 params[arg] = payload[arg]
-        
+
         # if no params provided
         if (not params):
             return {
@@ -601,13 +2537,17 @@ class Stop(Resource):
 
         # fields have been verified and 'params' dictionary holds values to be updated
         # so just go through the dictionary and update the fields in the database
-        for param in params:
-            cursor.execute(f"""UPDATE stops SET {param}='{params[param]}' WHERE stop_id='{stop_id}'""")
-            conn.commit()
+        # the column names come from allowable_fields above, only the values are user input
+        with db.write() as cursor:
+            version_before = stops_version(cursor)
+            for param in params:
+                cursor.execute(f"UPDATE stops SET {param} = ? WHERE stop_id = ?", (params[param], stop_id))
+            version_after = stops_version(cursor)
+        stops_replica.changed([stop_id], version_before, version_after)
 
         # get info ready for return
         # check if the given stop_id is contained within the database
-        updated_stop = cursor.execute(f"SELECT stop_id, last_updated, self_link FROM stops WHERE stop_id='{stop_id}'")
+        updated_stop = db.connection().execute("SELECT stop_id, last_updated, self_link FROM stops WHERE stop_id = ?", (stop_id,))
         updated_stop = updated_stop.fetchall()
         # the stop does not exist in the database, so 404 error
         if (not updated_stop):
@@ -615,7 +2555,7 @@ class Stop(Resource):
                 "Error Code": 404,
                 "Message": f"The stop id of {stop_id} does not exist in the database"
             }, 404
-        
+
         # The stop exists so format the data into a dictionary
         updated_stop_dict = {
             "stop_id": updated_stop[0][0],
@@ -635,8 +2575,96 @@ class Stop(Resource):
 
         return ret
 
-@api.route('/operator-profile/<int:stop_id>')
-@api.doc(responses={
+# bump this whenever the operator prompt changes, so profiles made with the old prompt aren't reused
+OPERATOR_PROMPT_VERSION = 1
+# how long a generated profile is reused for, in seconds, and how many are generated at once
+OPERATOR_PROFILE_TTL = float(os.environ.get("OPERATOR_PROFILE_TTL", str(30 * 24 * 60 * 60)))
+OPERATOR_PROFILE_CONCURRENCY = int(os.environ.get("OPERATOR_PROFILE_CONCURRENCY", "4"))
+
+
+def operator_question(operator):
+    # ask gemini for info about operator
+    return f"Give me a summary of the operator {operator}"
+
+
+def generate_operator_profile(operator):
+    # make gemini call
+    return gemini.generate_content(operator_question(operator)).text
+
+
+def get_operator_profiles(operators):
+    """
+    Get Gemini's profile of each operator as a dict of operator name to profile text.
+
+    Profiles generated with the current prompt within OPERATOR_PROFILE_TTL are read from the
+    operator_profiles table, the rest are generated concurrently and stored for next time.
+    """
+    profiles = read_operator_profiles(operators)
+    missing = [operator for operator in operators if operator not in profiles]
+    if (missing):
+        with ThreadPoolExecutor(max_workers=min(OPERATOR_PROFILE_CONCURRENCY, len(missing))) as executor:
+            generated = dict(zip(missing, executor.map(generate_operator_profile, missing)))
+        store_operator_profiles(generated)
+        profiles.update(generated)
+
+    return profiles
+
+
+def read_operator_profiles(operators):
+    # the stored profiles that can still be used, as a dict of operator name to profile text
+    profiles = {}
+    fresh_after = time.time() - OPERATOR_PROFILE_TTL
+    conn = db.connection()
+    for operator in operators:
+        row = conn.execute("""SELECT information FROM operator_profiles
+                              WHERE operator_name = ? AND prompt_version = ? AND created_at >= ?""",
+                           (operator, OPERATOR_PROMPT_VERSION, fresh_after)).fetchone()
+        if (row is not None):
+            profiles[operator] = row[0]
+    return profiles
+
+
+def store_operator_profiles(generated):
+    # keep newly generated profiles (a dict of operator name to profile text) for next time
+    now = time.time()
+    with db.write() as cursor:
+        cursor.executemany("""INSERT OR REPLACE INTO operator_profiles (operator_name, prompt_version, information, created_at)
+                              VALUES (?, ?, ?, ?)""",
+                           [(operator, OPERATOR_PROMPT_VERSION, information, now)
+                            for operator, information in generated.items()])
+
+
+def find_operator_stop(stop_id):
+    # the 404 response for /operator-profile if the stop isn't in the database, otherwise None
+    check_if_stop_exists = db.connection().execute("SELECT stop_id FROM stops WHERE stop_id = ?", (stop_id,))
+    check_if_stop_exists = check_if_stop_exists.fetchone()
+    # the stop does not exist in the database, so 404 error
+    if (not check_if_stop_exists):
+        return {
+            "message": f"The stop_id {stop_id} was not found in the database.",
+            "stop_id": f"{stop_id}",
+        }, 404
+    return None
+
+
+def operator_profiles_response(stop_id, operators, profiles):
+    # return obj
+    ret = {
+        "stop_id": stop_id,
+        "profiles": []
+    }
+    for operator in operators:
+        # add it to profiles list in return dict
+        ret['profiles'].append({
+            "operator_name": operator,
+            "information": profiles[operator],
+        })
+
+    return ret, 200
+
+
+@ns.route('/operator-profile/<int:stop_id>')
+@ns.doc(responses={
         200: 'Success',
         400: 'Bad Request',
         404: 'Not Found',
@@ -646,217 +2674,584 @@ class Stop(Resource):
     )
 class Operator(Resource):
     def get(self, stop_id):
-        # check if the given stop_id is contained within the database
-        check_if_stop_exists = cursor.execute(f"SELECT stop_id FROM stops WHERE stop_id='{stop_id}'")
-        check_if_stop_exists = check_if_stop_exists.fetchone()
-        # the stop does not exist in the database, so 404 error
-        if (not check_if_stop_exists):
-            return {
-                "message": f"The stop_id {stop_id} was not found in the database.",
-                "stop_id": f"{stop_id}",
-            }, 404
+        error, operators = run_flow(operator_stop_flow(stop_id))
+        if (error):
+            return error
 
-        # make api call with duration set to 90 mins max
-        res = requests.get(f'https://v6.db.transport.rest/stops/{stop_id}/departures?duration=90')
-        # if 503
-        if (res.status_code == 503):
-            return {
-                "Error": 503,
-                "Message": "Service unavailable",
-            }, 503
-        
-        l = res.json()
-        # isolate list of departures
-        l = l['departures']
+        # ask gemini about each of the unique operators, or reuse what it said last time
+        profiles = get_operator_profiles(operators)
+        return operator_profiles_response(stop_id, operators, profiles)
 
-        # list of distinct operator names
-        operators = []
-        for item in l:
-            # if the operator is not in the list, then add it in
-            if (item['line']['operator']['name'] not in operators):
-                operators.append(item['line']['operator']['name'])
 
+def operator_stop_flow(stop_id):
+    """
+    GET /operator-profile/<stop_id> up to asking gemini, as a flow.
 
-        # return obj
-        ret = {
-            "stop_id": stop_id,
-            "profiles": []
-        }
+    Returns an error response and None, or None and the operators departing in the next 90 mins.
+    """
+    # check if the given stop_id is contained within the database
+    error = yield in_db(find_operator_stop, stop_id)
+    if (error):
+        return error, None
+
+    # make sure we have the departures for the next 90 mins
+    status_code = yield from ensure_departures_flow(stop_id, 90)
+    # if 503
+    if (status_code != 200):
+        return ({
+            "Error": 503,
+            "Message": "Service unavailable",
+        }, 503), None
+
+    # list of distinct operator names
+    return None, (yield in_db(get_operators, stop_id, 90))
+
+
+# operator profile cache invalidation parser
+profile_cache_parser = reqparse.RequestParser()
+profile_cache_parser.add_argument('operator', type=str, required=False)
 
-        # for each of the unique operators
-        for operator in operators:
-            # make gemini call, ask gemini for info about operator
-            question = f"Give me a summary of the operator {operator}"
-            response = gemini.generate_content(question)
-            
-            # store response in dictionary
-            operator_profile = {
-                "operator_name": operator,
-                "information": response.text,
-            }
 
-            # add it to profiles list in return dict
-            ret['profiles'].append(operator_profile)
+@ns.route('/operator-profile/cache')
+class OperatorProfileCache(Resource):
+    @ns.doc(responses={
+        200: 'Success',
+    },
+    description='Forget the stored operator profiles, for one operator or for all of them, so they are generated again')
+    @ns.expect(profile_cache_parser)
+    def delete(self):
+        operator = profile_cache_parser.parse_args().get('operator')
+        with db.write() as cursor:
+            if (operator):
+                cursor.execute("DELETE FROM operator_profiles WHERE operator_name = ?", (operator,))
+            else:
+                cursor.execute("DELETE FROM operator_profiles")
+            removed = cursor.rowcount
 
-        return ret, 200
+        return {
+            "message": f"Removed {removed} stored operator profile(s)",
+            "operator": operator,
+        }, 200
 
-@api.route('/guide')
-@api.doc(responses={
+# how many journey checks /guide runs at the same time
+GUIDE_CONCURRENCY = int(os.environ.get("GUIDE_CONCURRENCY", "8"))
+
+
+def has_journey_flow(source, destination):
+    """
+    Ask db.transport for journeys from source to destination.
+
+    Returns 200 if there is at least one, 400 if there are none and 503 if upstream couldn't say.
+    """
+    status_code, routes = yield upstream("journeys", source, destination)
+    return journey_status(status_code, routes)
+
+
+def journey_status(status_code, routes):
+    """
+    What an upstream journeys response says about a pair of stops: 200 if there is a journey, 400 if
+    upstream answered that there isn't one, and 503 if it couldn't answer.
+
+    Only a 200 with an empty list of journeys or a 4xx (other than 429) is an answer. A 429 or 5xx
+    (still failing after the retries, or when the budget had no room left to retry) or a network
+    failure says nothing about the stops, so it is 503 and isn't stored.
+    """
+    if (not upstream_answered(status_code)):
+        return 503
+    if (status_code == 200):
+        journeys = routes.get('journeys') if isinstance(routes, dict) else None
+        if (not isinstance(journeys, list)):
+            return 503
+        return 200 if journeys else 400
+    return 400
+
+
+def check_journeys(pairs, concurrency=None):
+    """
+    Check whether each (source, destination) pair has a journey, running up to `concurrency` checks at once.
+
+    As soon as one pair fails, the checks that haven't started are cancelled. Returns the status code
+    of the first failure (400 or 503), or None when every pair has a journey, along with a dict of
+    the 200/400 result for each pair that was actually checked.
+    """
+    return run_flow(check_journeys_flow(pairs, concurrency))
+
+
+def check_journeys_flow(pairs, concurrency=None):
+    # check_journeys as a flow
+    flows = {pair: has_journey_flow(*pair) for pair in pairs}
+    finished = yield concurrently(flows, concurrency or GUIDE_CONCURRENCY, until=lambda status_code: status_code != 200)
+    results = {}
+    for pair, status_code in finished:
+        if (status_code != 503):
+            results[pair] = status_code
+        if (status_code != 200):
+            return status_code, results
+    return None, results
+
+
+# how long a journey check between two stops is trusted for, in seconds
+REACHABILITY_TTL = float(os.environ.get("REACHABILITY_TTL", str(24 * 60 * 60)))
+
+
+def check_strong_connectivity(stop_ids, concurrency=None):
+    """
+    Check that there is a journey from every stop to every other stop.
+
+    Journeys can be chained, so this holds if some root stop can reach every stop and every stop
+    can reach the root: that needs at most 2(N-1) upstream checks instead of N(N-1). Results are
+    stored in the reachability table, and any path already known from fresh stored results (not
+    just the direct pair) is not checked again, so adding a stop only needs checks to and from
+    that stop. The root is the stop with the most known journeys, so that those get reused.
+
+    Returns None when the stops are strongly connected, otherwise 400 (no journey) or 503.
+    """
+    return run_flow(check_strong_connectivity_flow(stop_ids, concurrency))
+
+
+def check_strong_connectivity_flow(stop_ids, concurrency=None):
+    # check_strong_connectivity as a flow
+    status_code, pairs = yield in_db(plan_strong_connectivity, stop_ids)
+    if (status_code is not None or not pairs):
+        return status_code
+
+    status_code, results = yield from check_journeys_flow(pairs, concurrency)
+    yield in_db(store_reachability, results)
+    return status_code
+
+
+def plan_strong_connectivity(stop_ids):
+    """
+    Work out which (source, destination) pairs check_strong_connectivity still has to check upstream.
+
+    Returns 400 and no pairs if a stored result already says two of the stops aren't connected,
+    otherwise None and the pairs (which are empty if the stored results are enough).
+    """
+    stop_set = set(stop_ids)
+    fresh_after = time.time() - REACHABILITY_TTL
+    rows = db.connection().execute(
+        "SELECT from_stop_id, to_stop_id, reachable FROM reachability WHERE checked_at >= ?", (fresh_after,))
+
+    # build the graph of journeys we already know about between the current stops
+    forward = {stop_id: set() for stop_id in stop_ids}
+    backward = {stop_id: set() for stop_id in stop_ids}
+    for from_stop_id, to_stop_id, reachable in rows:
+        if (from_stop_id not in stop_set or to_stop_id not in stop_set):
+            continue
+        # a direct check already found no journey between two of the stops
+        if (not reachable):
+            return 400, []
+        forward[from_stop_id].add(to_stop_id)
+        backward[to_stop_id].add(from_stop_id)
+
+    root = max(stop_ids, key=lambda stop_id: (len(forward[stop_id]) + len(backward[stop_id]), -stop_id))
+
+    # only check the root's journeys to and from the stops it isn't already known to be connected to
+    reached_from_root = reachable_from(root, forward)
+    reaching_root = reachable_from(root, backward)
+    pairs = [(root, stop_id) for stop_id in stop_ids if stop_id not in reached_from_root]
+    pairs += [(stop_id, root) for stop_id in stop_ids if stop_id not in reaching_root]
+    return None, pairs
+
+
+def store_reachability(results):
+    # remember what the journey checks found out, good or bad
+    if (results):
+        now = time.time()
+        with db.write() as cursor:
+            cursor.executemany("""INSERT OR REPLACE INTO reachability (from_stop_id, to_stop_id, reachable, checked_at)
+                                  VALUES (?, ?, ?, ?)""",
+                               [(source, destination, result == 200, now)
+                                for (source, destination), result in results.items()])
+
+
+def reachable_from(start, graph):
+    # every stop that can be reached from start by following the edges in graph, including start
+    seen = {start}
+    to_visit = [start]
+    while (to_visit):
+        for neighbour in graph[to_visit.pop()]:
+            if (neighbour not in seen):
+                seen.add(neighbour)
+                to_visit.append(neighbour)
+    return seen
+
+
+# finished guides are kept in this directory, named after their key
+guides_dir = os.path.abspath(f"{studentid}_guides")
+# bump this whenever the guide questions change, so guides made with the old ones aren't reused
+GUIDE_PROMPT_VERSION = 1
+# the text that goes before and after each of gemini's answers in a guide, in order
+GUIDE_SECTIONS = [
+    ("Source Info:\n", "\n"),
+    ("\nDestination Info:\n", "\n"),
+    ("Additional Tourist Info:\n", ""),
+]
+
+
+def make_guide_key(source_stop_id, dest_stop_id, source_poi_name, dest_poi_name):
+    # the same stops, POIs and prompts always make the same guide
+    content = json.dumps([GUIDE_PROMPT_VERSION, source_stop_id, dest_stop_id, source_poi_name, dest_poi_name])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+
+def write_guide(path, text):
+    # write to a temporary file first so that nobody ever sends a half written guide
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+@ns.route('/guide')
+@ns.doc(responses={
         200: 'Success',
         400: 'Bad Request',
         503: 'Service unavailable'
     },
     description='Returns a TXT file to help a tourist explore points of interest around a journey using stops from the database',
     )
-class Operator(Resource):
+class Guide(Resource):
     def get(self):
-        # if the database has less than two stops in it, return error
-        # check if the given stop_id is contained within the database
-        at_least_two_stops = cursor.execute(f"SELECT * FROM stops ORDER BY stop_id")
-        at_least_two_stops = at_least_two_stops.fetchall()
-        # the stop does not exist in the database, so 404 error
-        if (len(at_least_two_stops) < 2):
-            return {
-                "Error": 400,
-                "message": f"There is less than two stops in the database, so cannot create a guide",
-            }, 400
-        
-        # a list of just the stop_ids
-        stop_ids = []
-        for stop in at_least_two_stops:
-            stop_ids.append(stop[0])
-
-        # check if all stops in the database have a valid journey between them
-        for source in stop_ids:
-            for destination in stop_ids:
-                # if the same stop_id in the list, skip this iteration
-                if (source == destination):
-                    continue
-                
-                # check all stops have a route between them
-                routes = requests.get(f'https://v6.db.transport.rest/journeys?from={source}&to={destination}')
-                
-                if (routes.status_code == 503):
-                    return {
-                        "Error": 503,
-                        "Message": "Service unavailable"
-                    }
-
-                routes = routes.json()
-
-                if ('journeys' not in routes):
-                    return {
-                        "Error": 400,
-                        "Message": "No journey"
-                    }, 400
-
-                # isolate journeys array to routes variable
-                routes = routes['journeys']
-                # if no journeys between source and destination
-                if (len(routes) == 0):
-                    return {
-                        "Error": 400,
-                        "Message": "No journey"
-                    }, 400
-
-
-        # if we made it to here, then that means no error was returned with all stops having a route/journey between them
-
-        # spec says select any two stops in the database for information, I'm just picking the first two numerically by stop_id
-        source_stop_id = stop_ids[0]
-        dest_stop_id = stop_ids[1]
-
-        # get latitude and longitude for source
-        source_info = cursor.execute(f"SELECT stop_id, name, latitude, longitude FROM stops where stop_id='{source_stop_id}'")
-        source_info = source_info.fetchall()
-        
-        # format source_info into dictionary
-        source_info_dict = {
-            "stop_id": source_info[0][0],
-            "name": source_info[0][1],
-            "latitude": source_info[0][2],
-            "longitude": source_info[0][3],
-        }
-
-        # get latitude and longitude for source
-        dest_info = cursor.execute(f"SELECT stop_id, name, latitude, longitude FROM stops where stop_id='{dest_stop_id}'")
-        dest_info = dest_info.fetchall()
-        
-        # format source_info into dictionary
-        dest_info_dict = {
-            "stop_id": dest_info[0][0],
-            "name": dest_info[0][1],
-            "latitude": dest_info[0][2],
-            "longitude": dest_info[0][3],
-        }
-
-        # make API call to db.transport for POI near source
-        source_poi = requests.get(f"https://v6.db.transport.rest/locations/nearby?latitude={source_info_dict['latitude']}&longitude={source_info_dict['longitude']}&poi=true")
+        error, guide = run_flow(guide_flow())
+        if (error):
+            return error
+        guide_key, questions = guide
+        guide_path = os.path.join(guides_dir, f"{guide_key}.txt")
+
+        # this guide has been made before, so send the stored file (or a 304 if the client already has it)
+        if (os.path.exists(guide_path)):
+            return send_file(guide_path, mimetype="text/plain", as_attachment=True, download_name=txt_file,
+                             conditional=True, etag=guide_key)
+
+        # ask gemini all three questions at once
+        executor = ThreadPoolExecutor(max_workers=3)
+        futures = [executor.submit(gemini.generate_content, question) for question in questions]
+
+        def stream_guide():
+            # send each section as soon as it (and the ones before it) is ready
+            sections = []
+            try:
+                for (heading, ending), future in zip(GUIDE_SECTIONS, futures):
+                    section = heading + future.result().text + ending
+                    sections.append(section)
+                    yield section
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+            # the whole guide was sent, so keep it for the next request
+            write_guide(guide_path, "".join(sections))
+
+        return Response(stream_with_context(stream_guide()), mimetype="text/plain",
+                        headers=guide_headers(guide_key))
+
+
+def guide_flow():
+    """
+    GET /guide up to asking gemini, as a flow.
+
+    Returns an error response and None, or None and the guide's key with the questions for gemini.
+    """
+    error, stop_ids = yield in_db(guide_stop_ids)
+    if (error):
+        return error, None
+
+    # check if all stops in the database have a valid journey between them
+    error = guide_connectivity_error((yield from check_strong_connectivity_flow(stop_ids)))
+    if (error):
+        return error, None
+
+    # if we made it to here, then that means no error was returned with all stops having a route/journey between them
+
+    # spec says select any two stops in the database for information, I'm just picking the first two numerically by stop_id
+    source_info_dict = yield in_db(read_guide_stop, stop_ids[0])
+    dest_info_dict = yield in_db(read_guide_stop, stop_ids[1])
+
+    # find a POI near the source and the destination, from the local caches or else db.transport
+    poi_at_dest = None
+    status_code, poi_at_source = yield from find_poi_near_stop_flow(source_info_dict['stop_id'], source_info_dict['latitude'], source_info_dict['longitude'])
+    if (status_code == 200):
+        status_code, poi_at_dest = yield from find_poi_near_stop_flow(dest_info_dict['stop_id'], dest_info_dict['latitude'], dest_info_dict['longitude'])
+    error = guide_poi_error(status_code, poi_at_source, poi_at_dest)
+    if (error):
+        return error, None
+
+    # a finished guide is stored under a key made from everything that goes into it
+    guide_key = make_guide_key(source_info_dict['stop_id'], dest_info_dict['stop_id'], poi_at_source['name'], poi_at_dest['name'])
+    return None, (guide_key, guide_questions(poi_at_source, poi_at_dest))
+
+
+def guide_stop_ids():
+    """
+    The stop_ids a guide is made from, every stop in the database in order.
+
+    Returns an error response and None if there are less than two, otherwise None and the stop_ids.
+    """
+    # if the database has less than two stops in it, return error
+    at_least_two_stops = db.connection().execute("SELECT stop_id FROM stops ORDER BY stop_id")
+    at_least_two_stops = at_least_two_stops.fetchall()
+    if (len(at_least_two_stops) < 2):
+        return ({
+            "Error": 400,
+            "message": f"There is less than two stops in the database, so cannot create a guide",
+        }, 400), None
+
+    # a list of just the stop_ids
+    return None, [stop[0] for stop in at_least_two_stops]
+
+
+def guide_connectivity_error(status_code):
+    # the response for a failed check_strong_connectivity, or None if the stops are connected
+    if (status_code == 503):
+        return {
+            "Error": 503,
+            "Message": "Service unavailable"
+        }, 503
+    elif (status_code == 400):
+        return {
+            "Error": 400,
+            "Message": "No journey"
+        }, 400
+    return None
+
+
+def read_guide_stop(stop_id):
+    # get the name, latitude and longitude of a stop and format it into a dictionary
+    stop_info = db.connection().execute("SELECT stop_id, name, latitude, longitude FROM stops where stop_id = ?", (stop_id,))
+    stop_info = stop_info.fetchall()
+    return {
+        "stop_id": stop_info[0][0],
+        "name": stop_info[0][1],
+        "latitude": stop_info[0][2],
+        "longitude": stop_info[0][3],
+    }
+
+
+def guide_poi_error(status_code, poi_at_source, poi_at_dest):
+    # the response if the POIs for a guide couldn't be found, or None if there is one at both ends
+    # if upstream couldn't be asked, which doesn't mean there is nothing near the stops
+    if (status_code != 200):
+        return {
+            "Error": 503,
+            "Message": "Service unavailable"
+        }, 503
 
-        # if 503
-        if (source_poi.status_code == 503):
-            return {
-                "Error": 503,
-                "Message": "Service unavailable"
-            }
-        
-        source_poi = source_poi.json()
-        
-        poi_at_source = None
-        # iterate through list and get location that has a 'poi' value of true
-        for poi in source_poi:
-            if (poi['type'] == 'location'):
-                if (poi['poi'] == True):
-                    poi_at_source = poi
-                    break
-
-
-        # make API call to db.transport for POI near source
-        dest_poi = requests.get(f"https://v6.db.transport.rest/locations/nearby?latitude={dest_info_dict['latitude']}&longitude={dest_info_dict['longitude']}&poi=true")
-
-        # if 503
-        if (dest_poi.status_code == 503):
-            return {
-                "Error": 503,
-                "Message": "Service unavailable"
-            }
-        
-        dest_poi = dest_poi.json()
-        
-        poi_at_dest = None
-        # iterate through list and get location that has a 'poi' value of true
-        for poi in dest_poi:
-            if (poi['type'] == 'location'):
-                if (poi['poi'] == True):
-                    poi_at_dest = poi
-                    break
-
-        # questions to ask gemini for the chosen POI's
-        question_source_poi = f"Give me a summary of the POI {poi_at_source['name']}"
-        question_dest_poi = f"Give me a summary of the POI {poi_at_dest['name']}"
-
-        # responses from asking gemini about the respective POIs
-        response_source = gemini.generate_content(question_source_poi)
-        response_dest = gemini.generate_content(question_dest_poi)
-
-        # additional info to enhance the experience of a tourist
-        question_tourist_info = f"What advice would you give a tourist visiting the areas around {poi_at_source['name']} and {poi_at_dest['name']}? and any additional info you think is important"
-        response_tourist_info = gemini.generate_content(question_tourist_info)
-
-        # store the responses as text
-        res_source = response_source.text
-        res_dest = response_dest.text
-        res_tourist = response_tourist_info.text
-
-        all_text = "Source Info:\n" + res_source + "\n" + "\nDestination Info:\n" + res_dest + "\n" + 'Additional Tourist Info:\n' + res_tourist
-        # write the info into a txt file
-        f = open('z5390780.txt', "w")
-        f.write(all_text)
-        f.close()
-
-        # send the file as part of the API
-        send_file('z5390780.txt', download_name="z5390780.txt")
-        return {}, 200
+    # can't write a guide without something to see at both ends
+    if (poi_at_source is None or poi_at_dest is None):
+        return {
+            "Error": 404,
+            "Message": "Could not find a point of interest near both of the stops"
+        }, 404
+    return None
+
+
+def guide_questions(poi_at_source, poi_at_dest):
+    # questions to ask gemini for the chosen POI's, in the order of GUIDE_SECTIONS
+    question_source_poi = f"Give me a summary of the POI {poi_at_source['name']}"
+    question_dest_poi = f"Give me a summary of the POI {poi_at_dest['name']}"
+
+    # additional info to enhance the experience of a tourist
+    question_tourist_info = f"What advice would you give a tourist visiting the areas around {poi_at_source['name']} and {poi_at_dest['name']}? and any additional info you think is important"
+    return [question_source_poi, question_dest_poi, question_tourist_info]
+
+
+def guide_headers(guide_key):
+    # headers for a guide that is streamed as it is generated
+    return {
+        "Content-Disposition": f"attachment; filename={txt_file}",
+        "ETag": f'"{guide_key}"',
+    }
+
+
+def collect_metrics():
+    """
+    The numbers the caches, the transport client and the departures refresher keep themselves, as metrics.
+    """
+    lookups = Counter("cache_lookups_total", "Cache lookups, by cache and how they were answered", ["cache", "outcome"])
+    hit_ratio = Gauge("cache_hit_ratio", "Fraction of lookups answered from the cache", ["cache"])
+    entries = Gauge("cache_entries", "Entries in the cache", ["cache"])
+    size = Gauge("cache_bytes", "Approximate size of the cache's entries", ["cache"])
+    evictions = Counter("cache_evictions_total", "Entries evicted to keep the cache within its bounds", ["cache"])
+
+    for name, cache in (("departures", departures_cache), ("locations", locations_cache)):
+        stats = cache.stats()
+        for outcome, key in (("hit", "hits"), ("stale", "stale_hits"), ("miss", "misses")):
+            lookups.inc(name, outcome, amount=stats[key])
+        hit_ratio.set(name, value=stats['hit_ratio'])
+        entries.set(name, value=stats['entries'])
+        size.set(name, value=stats['bytes'])
+        evictions.inc(name, amount=stats['evictions'])
+
+    if (stops_replica.enabled):
+        replica = stops_replica.footprint()
+        lookups.inc("stops_replica", "hit", amount=replica['hits'])
+        lookups.inc("stops_replica", "miss", amount=replica['misses'])
+        looked_up = replica['hits'] + replica['misses']
+        hit_ratio.set("stops_replica", value=replica['hits'] / looked_up if looked_up else 0.0)
+        entries.set("stops_replica", value=replica['records'])
+        size.set("stops_replica", value=replica['bytes'])
+
+    pois = poi_cache_counter.stats()
+    for outcome in ("hit", "local", "miss"):
+        lookups.inc("pois", outcome, amount=pois.get(outcome, 0))
+    hit_ratio.set("pois", value=pois['hit_ratio'])
+
+    upstream = transport.stats()
+    calls = Counter("upstream_calls_total", "Calls to db.transport, executed or coalesced onto one already in flight",
+                    ["outcome"])
+    calls.inc("executed", amount=upstream['executed'])
+    calls.inc("coalesced", amount=upstream['coalesced'])
+    calls.inc("rejected", amount=upstream['rejected'])
+    in_flight = Gauge("upstream_requests_in_flight", "Calls to db.transport in progress right now")
+    in_flight.set(value=upstream['in_flight'])
+    circuit_open = Gauge("upstream_circuit_open", "1 if the circuit breaker is rejecting calls to db.transport")
+    circuit_open.set(value=1 if upstream['circuit'] == "open" else 0)
+
+    budget = upstream_budget.stats()
+    admissions = Counter("upstream_budget_calls_total", "Calls given a token by the upstream rate budget, or shed",
+                         ["priority", "outcome"])
+    queued = Gauge("upstream_budget_queued", "Calls waiting for an upstream budget token", ["priority"])
+    for priority in budget['queued']:
+        admissions.inc(priority, "granted", amount=budget['granted'][priority])
+        admissions.inc(priority, "shed", amount=budget['shed'][priority])
+        queued.set(priority, value=budget['queued'][priority])
+    tokens = Gauge("upstream_budget_tokens", "Tokens left in the upstream rate budget")
+    tokens.set(value=budget['tokens'])
+
+    refresher = departures_refresher.stats()
+    refreshes = Counter("departures_refreshes_total", "Background refreshes of departures")
+    refreshes.inc(amount=refresher['refreshes'])
+    tracked = Gauge("departures_tracked_stops", "Stops the departures refresher is keeping track of")
+    tracked.set(value=refresher['tracked_stops'])
+
+    return [lookups, hit_ratio, entries, size, evictions, calls, in_flight, circuit_open, admissions, queued, tokens,
+            refreshes, tracked]
+
+
+registry.collector(collect_metrics)
+
+
+@ns.route('/metrics')
+class Metrics(Resource):
+    @ns.doc(responses={
+        200: 'Success',
+    },
+    description='Latency histograms for every route, upstream endpoint and SQL statement, with cache hit ratios '
+                'and in-flight counts, in the Prometheus text format')
+    def get(self):
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def start_request_metrics():
+    # the route's rule, so /stops/1 and /stops/2 are counted together
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_start = time.perf_counter()
+    requests_in_flight.inc(g.metrics_route)
+
+
+def record_response_status(response):
+    g.metrics_status = str(response.status_code)
+    # a streamed response (like a guide) isn't finished until its last chunk has been sent, so time it until then
+    if (response.is_streamed and "metrics_start" in g):
+        route, method, status, start = g.metrics_route, request.method, g.metrics_status, g.pop("metrics_start")
+        response.response = ClosingIterator(response.response,
+                                            lambda: end_request_metrics(route, method, status, start))
+    return response
+
+
+def finish_request_metrics(error=None):
+    # streamed responses have already been dealt with, and so has a request this ran for before
+    start = g.pop("metrics_start", None)
+    if (start is not None):
+        end_request_metrics(g.metrics_route, request.method, g.get("metrics_status", "500"), start)
+
+
+def end_request_metrics(route, method, status, start):
+    requests_in_flight.dec(route)
+    request_duration.observe(time.perf_counter() - start, route, method, status)
+
+
+def release_db(error=None):
+    db.release()
+
+
+@click.command("warm-pois")
+def warm_pois():
+    """
+    Fetch the POIs near every stored stop that has none cached, so /guide doesn't have to.
+    """
+    stops = db.connection().execute("""SELECT stop_id, latitude, longitude FROM stops
+                                       WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+                                       AND stop_id NOT IN (SELECT stop_id FROM poi_cache WHERE fetched_at >= ?)""",
+                                    (time.time() - POI_CACHE_TTL,)).fetchall()
+    with ThreadPoolExecutor(max_workers=GUIDE_CONCURRENCY) as executor:
+        results = list(executor.map(lambda stop: fetch_pois_for_stop(*stop)[0], stops))
+    print(f"Fetched POIs for {results.count(200)} of {len(stops)} stops without fresh cached POIs")
+
+
+# the settings that point the shared db, Gemini and db.transport clients somewhere, and where the first
+# app create_app made pointed them, see create_app
+SHARED_SETTINGS = ("DATABASE", "GOOGLE_API_KEY", "TRANSPORT_BASE_URL")
+shared_settings = {}
+apps_lock = threading.Lock()
+first_app = None
+
+
+def create_app(config=None):
+    """
+    Make a Flask app serving every route, with the warm-pois command.
+
+    config goes into app.config. DATABASE (the SQLite file), GOOGLE_API_KEY and TRANSPORT_BASE_URL
+    in it point the db, Gemini and db.transport clients at them. Those clients (like the caches) are
+    shared by the whole process, so only one app per process is supported: another app can be made
+    with the same settings, but one that asks for a different DATABASE, GOOGLE_API_KEY or
+    TRANSPORT_BASE_URL raises RuntimeError rather than moving the first app along with it.
+
+    Nothing is connected to here, the db is opened and migrated by its first query, Gemini is imported
+    and set up by its first call and the HTTP session is opened by the first upstream request.
+    """
+    global first_app
+    app = Flask(__name__)
+    app.config.update(config or {})
+    if ("TRANSPORT_BASE_URL" in app.config):
+        app.config["TRANSPORT_BASE_URL"] = app.config["TRANSPORT_BASE_URL"].rstrip("/")
+
+    with apps_lock:
+        if (first_app is not None):
+            for name in SHARED_SETTINGS:
+                if (name in app.config and app.config[name] != shared_settings[name]):
+                    raise RuntimeError(f"{name} is already {shared_settings[name]!r} for this process's app, "
+                                       f"only one app per process is supported")
+        else:
+            if ("DATABASE" in app.config):
+                db.use(app.config["DATABASE"])
+            if ("GOOGLE_API_KEY" in app.config):
+                gemini.api_key = app.config["GOOGLE_API_KEY"]
+            if ("TRANSPORT_BASE_URL" in app.config):
+                transport.base_url = app.config["TRANSPORT_BASE_URL"]
+            shared_settings.update(DATABASE=db.path, GOOGLE_API_KEY=gemini.api_key, TRANSPORT_BASE_URL=transport.base_url)
+            first_app = app
+
+    api = Api(app)
+    api.add_namespace(ns)
+    app.cli.add_command(warm_pois)
+
+    # every request's latency goes into the metrics
+    app.before_request(start_request_metrics)
+    app.after_request(record_response_status)
+    app.teardown_request(finish_request_metrics)
+    # and its db connection goes back to the pool
+    app.teardown_appcontext(release_db)
+    return app
+
+
+def __getattr__(name):
+    # the flask app, for `flask --app z5390780 run` and the async server. It is only made when it's first
+    # asked for, so that whoever imports this module can make it with their own config with create_app first
+    if (name == "app"):
+        return first_app or create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
@@ -866,4 +3261,4 @@ if __name__ == "__main__":
     #print(question)
     #print(response.text)
 
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file